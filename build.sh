@@ -15,13 +15,8 @@ fi
 workdir=$(dirname $0)
 pushd $workdir
 
-if [[ ! -e build ]]; then
-    mkdir build
-fi
-
-datelabel=$(date  +%Y%m%dT%H%M%S)
-echo $datelabel > version
-zip -r build/mozilla-docker-$datelabel.zip . -x@zipexclude.lst
-zip -r build/mozilla-docker-$datelabel-public.zip . -x@zipexclude.lst
+# writes version and both zip files to build/ unless the tree is
+# unchanged since the last build, pass --force to rebuild anyway.
+python3 tools/package.py "$@"
 
 popd
@@ -4,8 +4,52 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+"""Container bootstrap.
+
+entrypoint.sh sources ~/.bashrc and execs this script, which prepares
+the worker's environment and configuration and then runs run_gw.py.
+The independent startup steps run concurrently and the time taken by
+each is written to STARTUP_PROFILE, since the container is restarted
+on every device recovery and the time to the first claimed task
+matters.
+
+"""
+
 import json
 import os
+import pwd
+import signal
+import subprocess
+import sys
+import threading
+import time
+from string import Template
+
+START_TIME = time.time()
+
+CONF_PATH = '/builds/taskcluster'
+# taskenv.py is shared with script.py, which lives in CONF_PATH, or in
+# ../taskcluster in a checkout.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'taskcluster'))
+sys.path.insert(0, CONF_PATH)
+import profiling  # noqa: E402
+import taskenv  # noqa: E402
+
+VERSION_FILE = '/builds/worker/version'
+ED25519_PRIVKEY = os.path.join(CONF_PATH, 'ed25519_private_key')
+GOOGLE_APPLICATION_CREDENTIALS = '/etc/google/stackdriver_credentials.json'
+STARTUP_PROFILE = os.path.join(CONF_PATH, 'startup-profile.json')
+SLOTS_DIR = '/builds/slots'
+TOOLTOOL_CACHE = '/builds/worker/tooltool-cache'
+WORKER_RUNNER_TEMPLATE = '/builds/taskcluster/worker-runner-config.yml.template'
+WORKER_RUNNER_CONFIG = '/builds/taskcluster/worker-runner-config.yml'
+# seconds to wait for the startup steps.
+STEP_DEADLINE = 120
+# ports used by the generic-worker of the first slot, later slots are
+# offset by SLOT_PORT_STRIDE.
+TASKCLUSTER_PROXY_PORT = 8099
+LIVELOG_PORT_BASE = 60098
+SLOT_PORT_STRIDE = 10
 
 
 def dump_scriptvars():
@@ -41,22 +85,291 @@ def dump_scriptvars():
         "USER",
     )
     variables = dict( (k, get_envvar(k)) for k in names )
+    write_scriptvars('/builds/taskcluster', variables)
+    return variables
 
-    with open('/builds/taskcluster/scriptvars.env', 'w') as scriptvarsb:
+
+def write_scriptvars(dirname, variables):
+    """Write the variables as scriptvars.env and scriptvars.json to
+    dirname, along with the task environment snapshot for script.py."""
+    with open(os.path.join(dirname, 'scriptvars.env'), 'w') as scriptvarsb:
         for item in variables:
             scriptvarsb.write("export %s=\"%s\"\n" % (item, variables[item]))
 
-    with open('/builds/taskcluster/scriptvars.json', 'w') as scriptvars:
+    with open(os.path.join(dirname, 'scriptvars.json'), 'w') as scriptvars:
         scriptvars.write(json.dumps(variables))
 
+    try:
+        with open(VERSION_FILE) as versionfile:
+            image_version = versionfile.read().strip()
+    except (IOError, OSError) as e:
+        # script.py falls back to reading the files itself.
+        print('%s reading %s, not writing task environment snapshot' % (e, VERSION_FILE))
+        return
+    # the device fingerprint is added by the first task, see taskenv.py.
+    taskenv.write(os.path.join(dirname, taskenv.FILENAME),
+                  taskenv.build(variables, image_version))
+
+
+def parse_device_pool(value):
+    """Parse DEVICE_POOL, a comma separated list of name=serial pairs,
+    into a list of (name, serial) tuples."""
+    pool = []
+    for item in value.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        if '=' not in item:
+            raise ValueError("DEVICE_POOL entry '%s' is not name=serial" % item)
+        name, serial = item.split('=', 1)
+        pool.append((name.strip(), serial.strip()))
+    return pool
+
+
+def render_slot_config(template, variables, slot_dir, index):
+    """Render the worker-runner config template for the slot in
+    slot_dir. Each slot's generic-worker gets its own config, task and
+    download directories and ports so that several can run in the same
+    container."""
+    text = Template(template).safe_substitute(variables)
+    proxy_port = TASKCLUSTER_PROXY_PORT + index * SLOT_PORT_STRIDE
+    livelog_port = LIVELOG_PORT_BASE + index * SLOT_PORT_STRIDE
+    lines = []
+    for line in text.splitlines():
+        key = line.strip().split(':', 1)[0]
+        if key == 'configPath':
+            line = '    configPath: %s' % os.path.join(slot_dir, 'generic-worker.yml')
+        elif key == 'taskclusterProxyPort':
+            line = '    taskclusterProxyPort:       %d' % proxy_port
+        lines.append(line)
+        if line == 'workerConfig:':
+            lines.append('    tasksDir:                   "%s"' % os.path.join(slot_dir, 'tasks'))
+            lines.append('    cachesDir:                  "%s"' % os.path.join(slot_dir, 'caches'))
+            lines.append('    downloadsDir:               "%s"' % os.path.join(slot_dir, 'downloads'))
+            lines.append('    livelogPortBase:            %d' % livelog_port)
+    return '\n'.join(lines) + '\n'
+
+
+def dump_slots(variables):
+    """
+    When DEVICE_POOL is set, create a slot directory under SLOTS_DIR
+    for each device containing its scriptvars and worker-runner config.
+
+    run_gw.py runs one generic-worker per slot and script.py finds the
+    slot's scriptvars.json from the task directory, which lives inside
+    the slot directory. All slots share the adb server and the tooltool
+    cache.
+
+    """
+    pool = parse_device_pool(get_envvar('DEVICE_POOL'))
+    with open(WORKER_RUNNER_TEMPLATE) as template_file:
+        template = template_file.read()
+    slot_dirs = []
+    for index, (name, serial) in enumerate(pool):
+        slot_dir = os.path.join(SLOTS_DIR, name)
+        for dirname in ('tasks', 'caches', 'downloads'):
+            if not os.path.isdir(os.path.join(slot_dir, dirname)):
+                os.makedirs(os.path.join(slot_dir, dirname))
+        slot_variables = dict(variables)
+        slot_variables['DEVICE_NAME'] = name
+        slot_variables['DEVICE_SERIAL'] = serial
+        slot_variables['DEVICE_POOL'] = get_envvar('DEVICE_POOL')
+        slot_variables['TOOLTOOL_CACHE'] = TOOLTOOL_CACHE
+        write_scriptvars(slot_dir, slot_variables)
+        config_variables = dict(os.environ)
+        config_variables.update(slot_variables)
+        with open(os.path.join(slot_dir, 'worker-runner-config.yml'), 'w') as config:
+            config.write(render_slot_config(template, config_variables, slot_dir, index))
+        slot_dirs.append(slot_dir)
+    if not os.path.isdir(TOOLTOOL_CACHE):
+        os.makedirs(TOOLTOOL_CACHE)
+    return slot_dirs
+
 # returns empty string if not defined
 def get_envvar(name):
     if name in os.environ:
         return os.environ[name]
     return ''
 
+
+class EnvironDefault(dict):
+    """Mapping for Template.substitute which, like envsubst, replaces
+    undefined variables with an empty string."""
+    def __missing__(self, key):
+        return ''
+
+
+def list_root():
+    """Log the contents of / and /test for debugging mounts."""
+    output = []
+    for path in ('/', '/test'):
+        if os.path.exists(path):
+            result = subprocess.run(['ls', '-la', path], stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT, universal_newlines=True)
+            output.append('ls -la %s\n%s' % (path, result.stdout))
+    return ''.join(output)
+
+
+def write_scriptvars_and_slots():
+    variables = dump_scriptvars()
+    if get_envvar('DEVICE_POOL'):
+        return dump_slots(variables)
+    return []
+
+
+def new_keypair():
+    subprocess.check_call(['generic-worker', 'new-ed25519-keypair', '--file', ED25519_PRIVKEY],
+                          cwd=get_envvar('HOME') or '/')
+    worker = pwd.getpwnam('worker')
+    os.chown(ED25519_PRIVKEY, worker.pw_uid, -1)
+
+
+def render_worker_runner_config():
+    with open(WORKER_RUNNER_TEMPLATE) as template_file:
+        template = template_file.read()
+    with open(WORKER_RUNNER_CONFIG, 'w') as config:
+        config.write(Template(template).substitute(EnvironDefault(os.environ)))
+
+
+def link_adbkey():
+    # bitbar mounts this file into root's homedir, but with g-w adb
+    # is looking for it worker's homedir
+    android_dir = '/builds/worker/.android'
+    adbkey = os.path.join(android_dir, 'adbkey')
+    try:
+        if not os.path.isdir(android_dir):
+            os.makedirs(android_dir)
+        if os.path.lexists(adbkey):
+            os.remove(adbkey)
+        os.symlink('/root/.android/adbkey', adbkey)
+    except OSError as e:
+        print('%s linking %s' % (e, adbkey))
+
+
+class Step(object):
+    """A startup step run in its own thread."""
+    def __init__(self, name, func):
+        self.name = name
+        self.func = func
+        self.result = None
+        self.error = None
+        self.start = None
+        self.end = None
+        self.thread = threading.Thread(target=self.run, name=name)
+        self.thread.daemon = True
+
+    def run(self):
+        self.start = time.time()
+        try:
+            self.result = self.func()
+        except Exception as e:
+            self.error = '%s: %s' % (e.__class__.__name__, e)
+        self.end = time.time()
+
+    def profile(self):
+        return {
+            'name': self.name,
+            'start': round(self.start - START_TIME, 3) if self.start else None,
+            'duration': round(self.end - self.start, 3) if self.end else None,
+            'error': self.error if self.end else 'did not finish',
+        }
+
+
+def run_steps(steps, deadline=STEP_DEADLINE):
+    """Run the independent steps concurrently, waiting at most deadline
+    seconds for all of them."""
+    for step in steps:
+        step.thread.start()
+    end = time.time() + deadline
+    for step in steps:
+        step.thread.join(max(0, end - time.time()))
+    return steps
+
+
+def write_profile(profile):
+    try:
+        with open(STARTUP_PROFILE, 'w') as f:
+            json.dump(profile, f, indent=2)
+    except (IOError, OSError) as e:
+        print('%s writing %s' % (e, STARTUP_PROFILE))
+    print('entrypoint.py: startup took %.2fs: %s' % (
+        profile['total'],
+        ', '.join('%s %.2fs' % (step['name'], step['duration'] or 0)
+                  for step in profile['steps'])))
+
+
+def slot_environ(environ, slot_dir, index):
+    """Return the environment of the run_gw.py of the slot in slot_dir.
+    The metrics of each slot are served on their own port and written to
+    their own file, named after the slot."""
+    env = dict(environ)
+    port = env.get('RUN_GW_METRICS_PORT')
+    if port and port.isdigit():
+        env['RUN_GW_METRICS_PORT'] = str(int(port) + index * SLOT_PORT_STRIDE)
+    path = env.get('RUN_GW_METRICS_FILE')
+    if path:
+        root, ext = os.path.splitext(path)
+        env['RUN_GW_METRICS_FILE'] = '%s-%s%s' % (root, os.path.basename(slot_dir), ext)
+    return env
+
+
+def run_slots(slot_dirs):
+    """Run one run_gw.py per slot, sharing this container's adb server
+    and tooltool cache, and forward SIGTERM and SIGINT to them."""
+    procs = [subprocess.Popen(['run_gw.py', slot_dir],
+                              env=slot_environ(os.environ, slot_dir, index))
+             for index, slot_dir in enumerate(slot_dirs)]
+
+    def forward(signum, frame):
+        for proc in procs:
+            if proc.poll() is None:
+                proc.send_signal(signum)
+
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+    rc = 0
+    for proc in procs:
+        rc = proc.wait() or rc
+    return rc
+
+
 def main():
-    dump_scriptvars()
+    os.environ['ED25519_PRIVKEY'] = ED25519_PRIVKEY
+    os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = GOOGLE_APPLICATION_CREDENTIALS
+    # generic-worker docker hack.
+    # see https://github.com/taskcluster/generic-worker/issues/151
+    os.environ['USER'] = 'root'
+
+    steps = run_steps([
+        Step('list_root', list_root),
+        Step('scriptvars', write_scriptvars_and_slots),
+        Step('keypair', new_keypair),
+        Step('worker_runner_config', render_worker_runner_config),
+        Step('adbkey', link_adbkey),
+    ])
+    if steps[0].result:
+        sys.stdout.write(steps[0].result)
+    profile = {
+        'start_time': START_TIME,
+        'total': time.time() - START_TIME,
+        'steps': [step.profile() for step in steps],
+    }
+    write_profile(profile)
+    # listing / is only informational.
+    failed = [step for step in steps[1:] if step.end is None or step.error]
+    if failed:
+        for step in failed:
+            print('entrypoint.py: startup step %s failed: %s' % (
+                step.name, step.profile()['error']))
+        return 1
+    sys.stdout.flush()
+
+    os.chdir(get_envvar('HOME') or '/')
+    slot_dirs = steps[1].result
+    if not slot_dirs:
+        profiling.stop()
+        os.execvp('run_gw.py', ['run_gw.py'])
+    return run_slots(slot_dirs)
 
 if __name__ == "__main__":
-    main()
+    sys.exit(profiling.run('entrypoint', main))
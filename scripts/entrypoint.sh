@@ -8,31 +8,6 @@ set -e
 
 source ~/.bashrc
 
-echo "ls -la /"
-ls -la /
-if [[ -e /test ]]; then
-    echo "ls -la /test"
-    ls -la /test
-fi
-
-CONF_PATH='/builds/taskcluster'
-export ED25519_PRIVKEY="$CONF_PATH/ed25519_private_key"
-export GOOGLE_APPLICATION_CREDENTIALS="/etc/google/stackdriver_credentials.json"
-# generic-worker docker hack.
-# see https://github.com/taskcluster/generic-worker/issues/151
-export USER=root
-
-# write a limited set of environment variables to file
-entrypoint.py
-
-cd $HOME
-generic-worker new-ed25519-keypair --file $ED25519_PRIVKEY
-chown worker $ED25519_PRIVKEY
-envsubst < $CONF_PATH/worker-runner-config.yml.template > $CONF_PATH/worker-runner-config.yml
-
-mkdir -p /builds/worker/.android/
-# bitbar mounts this file into root's homedir, but with g-w adb
-# is looking for it worker's homedir
-ln -sf /root/.android/adbkey /builds/worker/.android/adbkey || true
-
-run_gw.py
+# entrypoint.py writes the worker's environment and configuration, then
+# runs run_gw.py, one per device if DEVICE_POOL is set.
+exec entrypoint.py
@@ -1,85 +1,542 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
-import exceptions
+import collections
+import datetime
+import http.server
 import json
 import logging
 import os
+import signal
 import socket
 import subprocess
 import sys
+import threading
+import time
+
+# profiling.py is next to this script in the image, or in ../taskcluster
+# in a checkout.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'taskcluster'))
+import profiling  # noqa: E402
 
 script_name = sys.argv[0]
 
-try:
+# run g-w in a shell with an almost-empty environ
+# - print to stdout & stderr
+# - log to papertrail
+
+# with a slot directory argument, run the generic-worker for one
+# device of a DEVICE_POOL using the files entrypoint.py wrote there.
+
+hostname = socket.gethostname()
+log_prefix = hostname
+
+# lines are shipped to the log sink in batches from a background thread
+# so that a slow backend never blocks reading the worker's output.
+LOG_QUEUE_SIZE = 20000
+LOG_BATCH_SIZE = 500
+LOG_BATCH_INTERVAL = 1.0
+# with the sample overflow policy, once the queue is half full only
+# one in LOG_SAMPLE_RATE lines is kept.
+LOG_SAMPLE_RATE = 10
+
+
+class LoggingSink(object):
+    """Send lines through the logging module."""
+    def send(self, batch):
+        for _, message in batch:
+            logging.info(message)
+
+
+class StackdriverSink(object):
+    """Send each batch of lines to Stackdriver in a single request."""
+    def __init__(self, logger):
+        self.logger = logger
+
+    def send(self, batch):
+        stackdriver_batch = self.logger.batch()
+        for timestamp, message in batch:
+            stackdriver_batch.log_text(message, severity='INFO',
+                                       timestamp=datetime.datetime.utcfromtimestamp(timestamp))
+        stackdriver_batch.commit()
+
+
+class FileSink(object):
+    """Local stand-in for Stackdriver which appends lines to a file,
+    optionally sleeping for delay seconds per batch to simulate a slow
+    backend."""
+    def __init__(self, path, delay=0):
+        self.path = path
+        self.delay = delay
+
+    def send(self, batch):
+        time.sleep(self.delay)
+        with open(self.path, 'a') as f:
+            for timestamp, message in batch:
+                f.write('%.6f %s\n' % (timestamp, message))
+
+
+class LogShipper(object):
+    """Bounded queue of log lines shipped to sink in batches of up to
+    batch_size lines, or every interval seconds, by a background thread.
+
+    When the queue is full, new lines are dropped. With the 'sample'
+    overflow policy, only one in sample_rate lines is queued while the
+    queue is more than half full, so that a burst thins out rather than
+    losing its tail.
+
+    """
+    def __init__(self, sink, queue_size=LOG_QUEUE_SIZE, batch_size=LOG_BATCH_SIZE,
+                 interval=LOG_BATCH_INTERVAL, overflow='drop', sample_rate=LOG_SAMPLE_RATE):
+        self.sink = sink
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.interval = interval
+        self.overflow = overflow
+        self.sample_rate = sample_rate
+        self.counters = collections.Counter()
+        self.max_batch = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self._queue = collections.deque()
+        self._condition = threading.Condition()
+        self._closing = False
+        self._thread = threading.Thread(target=self._run, name='log-shipper')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, message):
+        with self._condition:
+            self.counters['received'] += 1
+            queued = len(self._queue)
+            if queued >= self.queue_size:
+                self.counters['dropped'] += 1
+                return
+            if self.overflow == 'sample' and queued >= self.queue_size // 2 and \
+               self.counters['received'] % self.sample_rate:
+                self.counters['sampled_out'] += 1
+                return
+            self._queue.append((time.time(), message))
+            if queued + 1 >= self.batch_size:
+                self._condition.notify()
+
+    def _next_batch(self):
+        with self._condition:
+            while True:
+                if self._queue:
+                    if len(self._queue) >= self.batch_size or self._closing:
+                        break
+                    wait = self._queue[0][0] + self.interval - time.time()
+                    if wait <= 0:
+                        break
+                elif self._closing:
+                    return None
+                else:
+                    wait = None
+                self._condition.wait(wait)
+            count = min(len(self._queue), self.batch_size)
+            return [self._queue.popleft() for _ in range(count)]
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            try:
+                self.sink.send(batch)
+            except Exception as e:
+                self.counters['send_errors'] += 1
+                self.counters['dropped'] += len(batch)
+                print("%s/WARNING: %s shipping %d log lines" % (script_name, e, len(batch)))
+                continue
+            self.counters['shipped'] += len(batch)
+            self.counters['batches'] += 1
+            self.max_batch = max(self.max_batch, len(batch))
+            self.last_lag = time.time() - batch[0][0]
+            self.max_lag = max(self.max_lag, self.last_lag)
+
+    def stats(self):
+        with self._condition:
+            stats = dict(self.counters)
+            stats['queued'] = len(self._queue)
+        stats['max_batch'] = self.max_batch
+        stats['last_lag'] = self.last_lag
+        stats['max_lag'] = self.max_lag
+        return stats
+
+    def close(self, timeout=30):
+        """Ship the remaining lines, waiting at most timeout seconds."""
+        with self._condition:
+            self._closing = True
+            self._condition.notify()
+        self._thread.join(timeout)
+
+
+def format_shipping_stats(stats):
+    return ("log shipping: %d lines shipped in %d batches (max %d), %d dropped, "
+            "%d sampled out, %d queued, lag %.2fs (max %.2fs)" % (
+                stats.get('shipped', 0), stats.get('batches', 0), stats['max_batch'],
+                stats.get('dropped', 0), stats.get('sampled_out', 0), stats['queued'],
+                stats['last_lag'], stats['max_lag']))
+
+
+def setup_logging():
+    """Return the sink for the worker's log lines.
+
+    RUN_GW_LOG_SINK selects it: 'stackdriver' (the default), 'logging'
+    or 'file:<path>' for a local stand-in, in which case
+    RUN_GW_LOG_SINK_DELAY seconds are spent per batch.
+
+    """
+    sink = os.environ.get('RUN_GW_LOG_SINK', 'stackdriver')
+    if sink.startswith('file:'):
+        return FileSink(sink[5:], float(os.environ.get('RUN_GW_LOG_SINK_DELAY', '0')))
+    if sink == 'logging':
+        return LoggingSink()
     try:
+        import google.auth.exceptions
         import google.cloud.logging
+    except ImportError:
+        print("%s/WARNING: Could not import google.cloud.logging! Stackdriver is not functional." % script_name)
+        return LoggingSink()
+    try:
         # setup stackdriver
         stackdriver_client = google.cloud.logging.Client()
-        stackdriver_client.setup_logging()
+        # the log name used by the handler installed by
+        # Client.setup_logging(), which earlier versions used.
+        return StackdriverSink(stackdriver_client.logger('python'))
     except google.auth.exceptions.DefaultCredentialsError:
         print("%s/WARNING: Stackdriver credentials missing. Stackdriver is not functional." % script_name)
-except exceptions.NameError, exceptions.ImportError:
-    print("%s/WARNING: Could not import google.cloud.logging! Stackdriver is not functional." % script_name)
+        return LoggingSink()
+
+
+# histogram buckets in seconds.
+LATENCY_BUCKETS = (0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300)
+RUN_BUCKETS = (10, 30, 60, 300, 600, 1800, 3600, 7200, 14400)
+METRICS_INTERVAL = 15
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+class Metrics(object):
+    """Worker lifecycle counters and histograms, rendered in the
+    Prometheus text format to a file every METRICS_INTERVAL seconds
+    and/or served over http for a host agent to scrape."""
+
+    HELP = {
+        'run_gw_tasks_total': ('counter', 'Worker runs, each of which claims one task.'),
+        'run_gw_superseded_total': ('counter', 'Tasks which were superseded.'),
+        'run_gw_worker_exits_total': ('counter', 'Worker exits by exit code.'),
+        'run_gw_worker_running': ('gauge', 'Number of workers currently running.'),
+        'run_gw_time_between_tasks_seconds': (
+            'histogram', "Time from a worker's last output to the next worker's first output."),
+        'run_gw_worker_startup_seconds': (
+            'histogram', "Time from spawning a worker to its first output."),
+        'run_gw_worker_run_seconds': ('histogram', 'Time from spawning a worker to its exit.'),
+        'run_gw_log_lines_total': ('counter', 'Worker log lines by shipping outcome.'),
+        'run_gw_log_shipping_lag_seconds': (
+            'gauge', 'Time the last shipped batch of log lines spent queued.'),
+        'run_gw_start_time_seconds': ('gauge', 'Time run_gw.py started.'),
+    }
+
+    def __init__(self, labels):
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.counters = collections.Counter()
+        self.exit_codes = collections.Counter()
+        self.running = 0
+        self.start_time = time.time()
+        self.histograms = {
+            'run_gw_time_between_tasks_seconds': Histogram(LATENCY_BUCKETS),
+            'run_gw_worker_startup_seconds': Histogram(LATENCY_BUCKETS),
+            'run_gw_worker_run_seconds': Histogram(RUN_BUCKETS),
+        }
+
+    def inc(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def observe(self, name, value):
+        with self.lock:
+            self.histograms[name].observe(value)
+
+    def worker_started(self):
+        with self.lock:
+            self.counters['run_gw_tasks_total'] += 1
+            self.running += 1
+
+    def worker_exited(self, rc, run_time):
+        with self.lock:
+            self.exit_codes[str(rc)] += 1
+            self.running -= 1
+            self.histograms['run_gw_worker_run_seconds'].observe(run_time)
+
+    def _labels(self, extra=None):
+        labels = dict(self.labels)
+        labels.update(extra or {})
+        return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('"', '\\"'))
+                                 for k, v in sorted(labels.items()))
+
+    def render(self):
+        shipping = log_shipper.stats() if log_shipper else {}
+        lines = []
+
+        def header(name):
+            kind, text = self.HELP[name]
+            lines.append('# HELP %s %s' % (name, text))
+            lines.append('# TYPE %s %s' % (name, kind))
+
+        with self.lock:
+            for name in ('run_gw_tasks_total', 'run_gw_superseded_total'):
+                header(name)
+                lines.append('%s%s %d' % (name, self._labels(), self.counters[name]))
+            header('run_gw_worker_exits_total')
+            for code, count in sorted(self.exit_codes.items()):
+                lines.append('run_gw_worker_exits_total%s %d' % (
+                    self._labels({'code': code}), count))
+            header('run_gw_worker_running')
+            lines.append('run_gw_worker_running%s %d' % (self._labels(), self.running))
+            for name, histogram in sorted(self.histograms.items()):
+                header(name)
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    lines.append('%s_bucket%s %d' % (name, self._labels({'le': bound}), count))
+                lines.append('%s_bucket%s %d' % (name, self._labels({'le': '+Inf'}),
+                                                 histogram.count))
+                lines.append('%s_sum%s %f' % (name, self._labels(), histogram.sum))
+                lines.append('%s_count%s %d' % (name, self._labels(), histogram.count))
+        header('run_gw_log_lines_total')
+        for outcome in ('shipped', 'dropped', 'sampled_out'):
+            lines.append('run_gw_log_lines_total%s %d' % (
+                self._labels({'outcome': outcome}), shipping.get(outcome, 0)))
+        header('run_gw_log_shipping_lag_seconds')
+        lines.append('run_gw_log_shipping_lag_seconds%s %f' % (
+            self._labels(), shipping.get('last_lag', 0.0)))
+        header('run_gw_start_time_seconds')
+        lines.append('run_gw_start_time_seconds%s %f' % (self._labels(), self.start_time))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        # write atomically so that a scraper never sees a partial file.
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            with open(tmp_path, 'w') as f:
+                f.write(self.render())
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print("%s/WARNING: %s writing metrics to '%s'" % (script_name, e, path))
+
+    def start_writer(self, path, interval=METRICS_INTERVAL):
+        def run():
+            while True:
+                self.write(path)
+                time.sleep(interval)
+        thread = threading.Thread(target=run, name='metrics-writer')
+        thread.daemon = True
+        thread.start()
+
+    def start_server(self, port):
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = http.server.HTTPServer(('', port), Handler)
+        thread = threading.Thread(target=server.serve_forever, name='metrics-server')
+        thread.daemon = True
+        thread.start()
+        return server
+
+
+log_shipper = None
+metrics = None
 
-# run g-w in a shell with an almost-empty environ
-# - print to stdout & stderr
-# - log to papertrail
 
 def log_to_pt(message, print_to_screen=False):
-    logging.info("%s: %s" % (hostname, message))
+    log_shipper.put("%s: %s" % (log_prefix, message))
     if print_to_screen:
         print(message)
 
-scriptvars_json_file = '/builds/taskcluster/scriptvars.json'
-tc_worker_runner_config_file = "/builds/taskcluster/worker-runner-config.yml"
-hostname = socket.gethostname()
 
-cmd_str = "start-worker %s" % tc_worker_runner_config_file
-cmd_arr = cmd_str.split(" ")
-# testing mode
-# cmd_arr = sys.argv[1:]
-
-# load json with env vars if it exists
-scriptvars_json = None
-if os.path.exists(scriptvars_json_file):
-    with open(scriptvars_json_file) as json_file:
-        scriptvars_json = json.load(json_file)
-else:
-    print("%s/INFO: '%s' does not exist." % (script_name, scriptvars_json_file))
-
-# continue until we run a non-superseded task
-while True:
-    superseded = False
-    rc = None
-
-    # see https://bugzilla.mozilla.org/show_bug.cgi?id=1375514
-    # prevents g-w from never reaching termination condition when we do our supersede reruns and device issues occur
-    # https://github.com/taskcluster/generic-worker/blob/d3dda694d0031e8f1cd085f06c3b0f810321dac2/main.go#L485
-    gw_resolved_count_file = "tasks-resolved-count.txt"
-    if os.path.exists(gw_resolved_count_file):
-        print("%s/INFO: removed gw_resolved_count_file at '%s'" % (script_name, gw_resolved_count_file))
-        os.remove(gw_resolved_count_file)
-
-    print("%s/INFO: command to run is: '%s'" % (script_name, " ".join(cmd_arr)))
-    # run command
-    proc = subprocess.Popen(cmd_arr,
-                            env=scriptvars_json,
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.STDOUT,
-                            )
-
-    while rc == None:
-        line = proc.stdout.readline()
-        stripped_line = line.rstrip()
-        log_to_pt(stripped_line)
-        if 'has been superseded' in stripped_line.lower():
-            superseded = True
-        rc = proc.poll()
-    sys.stdout.flush()
-    # exit if the rc is non-zero (even if superseded) or if we've processed a real job
-    # otherwise consume another task.
-    if rc != 0 or not superseded:
-        break
-    log_to_pt("%s/INFO: task was superseded, running again..." % script_name, print_to_screen=True)
-
-sys.exit(rc)
+class Supervisor(object):
+    """Run generic-worker until it processes a task which was not
+    superseded, forwarding SIGTERM and SIGINT to it.
+
+    The worker's output is read with blocking reads until EOF and the
+    worker is then reaped with wait(), so the supervisor sleeps in the
+    kernel instead of polling.
+
+    The worker for the next task is only started once the previous one
+    has been reaped, since both would use the same workerID, config,
+    ports and task directory.
+
+    """
+    def __init__(self, cmd_arr, env):
+        self.cmd_arr = cmd_arr
+        self.env = env
+        self.proc = None
+        self.stopping = False
+
+    def handle_signal(self, signum, frame):
+        # let the current worker shut down, but don't start another one.
+        self.stopping = True
+        proc = self.proc
+        if proc and proc.returncode is None:
+            try:
+                proc.send_signal(signum)
+            except OSError:
+                pass
+
+    def start_worker(self):
+        # see https://bugzilla.mozilla.org/show_bug.cgi?id=1375514
+        # prevents g-w from never reaching termination condition when we do our supersede reruns and device issues occur
+        # https://github.com/taskcluster/generic-worker/blob/d3dda694d0031e8f1cd085f06c3b0f810321dac2/main.go#L485
+        gw_resolved_count_file = "tasks-resolved-count.txt"
+        if os.path.exists(gw_resolved_count_file):
+            print("%s/INFO: removed gw_resolved_count_file at '%s'" % (script_name, gw_resolved_count_file))
+            os.remove(gw_resolved_count_file)
+
+        print("%s/INFO: command to run is: '%s'" % (script_name, " ".join(self.cmd_arr)))
+        proc = subprocess.Popen(self.cmd_arr,
+                                env=self.env,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT,
+                                )
+        proc.spawned = time.time()
+        proc.first_output = None
+        proc.previous = None
+        self.proc = proc
+        metrics.worker_started()
+        return proc
+
+    def read_output(self, proc):
+        """Read proc's output until EOF and return whether its task was
+        superseded."""
+        superseded = False
+        for line in proc.stdout:
+            if proc.first_output is None:
+                proc.first_output = time.time()
+                metrics.observe('run_gw_worker_startup_seconds', proc.first_output - proc.spawned)
+                if proc.previous:
+                    self.report_restart(proc.previous, proc)
+            stripped_line = line.rstrip().decode('utf-8', 'replace')
+            log_to_pt(stripped_line)
+            if 'has been superseded' in stripped_line.lower():
+                superseded = True
+        proc.stdout.close()
+        proc.output_ended = time.time()
+        return superseded
+
+    def reap(self, proc):
+        rc = proc.wait()
+        metrics.worker_exited(rc, time.time() - proc.spawned)
+        sys.stdout.flush()
+        return rc
+
+    def report_restart(self, previous, proc):
+        startup = proc.first_output - proc.spawned
+        metrics.observe('run_gw_time_between_tasks_seconds',
+                        proc.first_output - previous.output_ended)
+        log_to_pt("%s/INFO: superseded restart: next worker spawned %.2fs after the previous "
+                  "worker's output ended, its first output took %.2fs" % (
+                      script_name, proc.spawned - previous.output_ended, startup),
+                  print_to_screen=True)
+
+    def run(self):
+        proc = self.start_worker()
+        # continue until we run a non-superseded task
+        while True:
+            superseded = self.read_output(proc)
+            rc = self.reap(proc)
+            print("%s/INFO: %s" % (script_name, format_shipping_stats(log_shipper.stats())))
+            # exit if the rc is non-zero (even if superseded) or if we've processed a real job
+            # otherwise consume another task.
+            if rc != 0 or not superseded or self.stopping:
+                return rc
+            metrics.inc('run_gw_superseded_total')
+            log_to_pt("%s/INFO: task was superseded, running again..." % script_name, print_to_screen=True)
+            next_proc = self.start_worker()
+            next_proc.previous = proc
+            proc = next_proc
+
+
+def main():
+    global log_prefix, log_shipper, metrics
+
+    log_shipper = LogShipper(setup_logging(),
+                             overflow=os.environ.get('RUN_GW_LOG_OVERFLOW', 'drop'))
+
+    if len(sys.argv) > 1:
+        slot_dir = sys.argv[1]
+        os.chdir(slot_dir)
+    else:
+        slot_dir = '/builds/taskcluster'
+    scriptvars_json_file = os.path.join(slot_dir, 'scriptvars.json')
+    tc_worker_runner_config_file = os.path.join(slot_dir, 'worker-runner-config.yml')
+
+    cmd_str = "start-worker %s" % tc_worker_runner_config_file
+    cmd_arr = cmd_str.split(" ")
+    # testing mode, see tools/loadtest_run_gw.py
+    if 'RUN_GW_WORKER_COMMAND' in os.environ:
+        cmd_arr = os.environ['RUN_GW_WORKER_COMMAND'].split(" ")
+
+    # load json with env vars if it exists
+    scriptvars_json = None
+    if os.path.exists(scriptvars_json_file):
+        with open(scriptvars_json_file) as json_file:
+            scriptvars_json = json.load(json_file)
+        if len(sys.argv) > 1:
+            log_prefix = "%s/%s" % (hostname, scriptvars_json['DEVICE_NAME'])
+    else:
+        print("%s/INFO: '%s' does not exist." % (script_name, scriptvars_json_file))
+
+    # RUN_GW_METRICS_FILE and RUN_GW_METRICS_PORT export worker
+    # lifecycle metrics for a host agent, see Metrics.
+    labels = {'hostname': hostname}
+    if scriptvars_json and scriptvars_json.get('DEVICE_NAME'):
+        labels['worker_id'] = scriptvars_json['DEVICE_NAME']
+    metrics = Metrics(labels)
+    metrics_file = os.environ.get('RUN_GW_METRICS_FILE')
+    if metrics_file:
+        metrics.start_writer(metrics_file)
+    if os.environ.get('RUN_GW_METRICS_PORT'):
+        try:
+            metrics.start_server(int(os.environ['RUN_GW_METRICS_PORT']))
+        except (ValueError, OSError) as e:
+            print("%s/WARNING: %s serving metrics on port '%s'" % (
+                script_name, e, os.environ['RUN_GW_METRICS_PORT']))
+
+    supervisor = Supervisor(cmd_arr, scriptvars_json)
+    signal.signal(signal.SIGTERM, supervisor.handle_signal)
+    signal.signal(signal.SIGINT, supervisor.handle_signal)
+    try:
+        return supervisor.run()
+    finally:
+        log_shipper.close()
+        print("%s/INFO: %s" % (script_name, format_shipping_stats(log_shipper.stats())))
+        if metrics_file:
+            metrics.write(metrics_file)
+
+
+if __name__ == "__main__":
+    sys.exit(profiling.run('run_gw', main))
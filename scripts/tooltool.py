@@ -22,13 +22,20 @@
 # in which the manifest file resides and it should be called
 # 'manifest.tt'
 
+import BaseHTTPServer
+import SocketServer
+import errno
+import fnmatch
 import hashlib
 import httplib
 import json
 import logging
 import optparse
 import os
+import pipes
+import re
 import shutil
+import socket
 import sys
 import tarfile
 import tempfile
@@ -46,6 +53,50 @@ __version__ = '1'
 DEFAULT_MANIFEST_NAME = 'manifest.tt'
 TOOLTOOL_PACKAGE_SUFFIX = '.TOOLTOOL-PACKAGE'
 
+# priority classes of rate limited transfers, see Throttle.
+PRIORITY_HIGH = 'high'
+PRIORITY_BULK = 'bulk'
+# bytes transferred between two reservations from the rate limiters.
+THROTTLE_QUANTUM = 1024 * 64
+# seconds bulk transfers keep yielding after the last high priority
+# reservation.
+PRIORITY_HIGH_GRACE = 0.5
+# commands which are run by the daemon started with `serve` when
+# --socket or $TOOLTOOL_SOCKET names its socket.
+SERVE_COMMANDS = ('fetch', 'validate', 'purge', 'list')
+# seconds a mirror which could not be reached is tried after the others.
+MIRROR_RETRY_AFTER = 300
+DIGEST_MEMO_SIZE = 10000
+# directory in the working directory holding the readiness markers of
+# files fetched in the background, see fetch_background().
+MARKER_DIR = '.tooltool'
+# accesses of a digest after which it is promoted into the hot tier of
+# the cache, see HotCache.
+HOT_PROMOTE_HITS = 2
+# directory in the cache folder holding the chunk store, see ChunkStore.
+CHUNK_DIR = '.chunks'
+# directory in the cache folder of the proxy holding the chunk lists of
+# the blobs, see TooltoolProxy.
+CHUNK_LIST_DIR = '.chunk-lists'
+# content defined chunking: a gear hash of the last 32 bytes cuts a chunk
+# when its CHUNK_MASK bits are 0, giving chunks of about 80KB between
+# CHUNK_MIN_SIZE and CHUNK_MAX_SIZE. CHUNKER names these parameters,
+# clients and servers only exchange chunk lists made with the same ones.
+CHUNK_MIN_SIZE = 1024 * 16
+CHUNK_MAX_SIZE = 1024 * 256
+CHUNK_MASK = 0xFFFF0000
+CHUNKER = 'gear32-16k-64k-256k'
+CHUNK_GEAR = [int(hashlib.md5('tooltool-gear-%d' % i).hexdigest()[:8], 16) for i in range(256)]
+
+# (path, algorithm, stat) -> digest of files hashed by this process, so
+# that files which have not changed are not hashed again.
+_digest_memo = {}
+# base url -> time it could last not be reached.
+_mirror_failures = {}
+# set in the serve daemon, which keeps its hot tier in memory.
+_daemon = False
+_memory_hot_cache = None
+
 
 log = logging.getLogger(__name__)
 
@@ -80,7 +131,7 @@ class MissingFileException(ExceptionWithFilename):
 class FileRecord(object):
 
     def __init__(self, filename, size, digest, algorithm, unpack=False,
-                 version=None, visibility=None, setup=None):
+                 version=None, visibility=None, setup=None, include=None, exclude=None):
         object.__init__(self)
         if '/' in filename or '\\' in filename:
             log.error(
@@ -94,6 +145,9 @@ class FileRecord(object):
         self.version = version
         self.visibility = visibility
         self.setup = setup
+        # patterns of the archive members to unpack, or not to unpack.
+        self.include = include
+        self.exclude = exclude
 
     def __eq__(self, other):
         if self is other:
@@ -133,8 +187,7 @@ class FileRecord(object):
 
     def validate_digest(self):
         if self.present():
-            with open(self.filename, 'rb') as f:
-                return self.digest == digest_file(f, self.algorithm)
+            return self.digest == digest_path(self.filename, self.algorithm)
         else:
             log.debug(
                 "trying to validate digest on a missing file, %s', self.filename")
@@ -187,6 +240,10 @@ class FileRecordJSONEncoder(json.JSONEncoder):
                 rv['visibility'] = obj.visibility
             if obj.setup:
                 rv['setup'] = obj.setup
+            if obj.include:
+                rv['include'] = obj.include
+            if obj.exclude:
+                rv['exclude'] = obj.exclude
             return rv
 
     def default(self, f):
@@ -233,9 +290,11 @@ class FileRecordJSONDecoder(json.JSONDecoder):
                 version = obj.get('version', None)
                 visibility = obj.get('visibility', None)
                 setup = obj.get('setup')
+                include = obj.get('include')
+                exclude = obj.get('exclude')
                 rv = FileRecord(
                     obj['filename'], obj['size'], obj['digest'], obj['algorithm'],
-                    unpack, version, visibility, setup)
+                    unpack, version, visibility, setup, include, exclude)
                 log.debug("materialized %s" % rv)
                 return rv
         return obj
@@ -336,6 +395,36 @@ def digest_file(f, a):
     return h.hexdigest()
 
 
+def _digest_key(path, a):
+    st = os.stat(path)
+    return (os.path.realpath(path), a, st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+
+
+def remember_digest(path, a, digest):
+    """I record that the file at 'path' is known to have 'digest'."""
+    if len(_digest_memo) >= DIGEST_MEMO_SIZE:
+        _digest_memo.clear()
+    _digest_memo[_digest_key(path, a)] = digest
+
+
+def digest_path(path, a):
+    """I return digest_file() of the file at 'path', remembering it for
+    as long as the file's inode, size and mtime do not change."""
+    key = _digest_key(path, a)
+    if key not in _digest_memo:
+        with open(path, 'rb') as f:
+            remember_digest(path, a, digest_file(f, a))
+    return _digest_memo[key]
+
+
+def order_mirrors(base_urls):
+    """Return base_urls with the ones which could not be reached in the
+    last MIRROR_RETRY_AFTER seconds moved to the end."""
+    now = time.time()
+    return sorted(base_urls,
+                  key=lambda url: now - _mirror_failures.get(url, 0) < MIRROR_RETRY_AFTER)
+
+
 def execute(cmd):
     """Execute CMD, logging its stdout at the info level"""
     process = Popen(cmd, shell=True, stdout=PIPE)
@@ -403,7 +492,8 @@ def validate_manifest(manifest_file):
         return False
 
 
-def add_files(manifest_file, algorithm, filenames, version, visibility, unpack):
+def add_files(manifest_file, algorithm, filenames, version, visibility, unpack,
+              include=None, exclude=None):
     # returns True if all files successfully added, False if not
     # and doesn't catch library Exceptions.  If any files are already
     # tracked in the manifest, return will be False because they weren't
@@ -423,6 +513,8 @@ def add_files(manifest_file, algorithm, filenames, version, visibility, unpack):
         new_fr.version = version
         new_fr.visibility = visibility
         new_fr.unpack = unpack
+        new_fr.include = include
+        new_fr.exclude = exclude
         log.debug("appending a new file record to manifest file")
         add = True
         for fr in old_manifest.file_records:
@@ -458,13 +550,487 @@ def touch(f):
         log.warn('impossible to update utime of file %s' % f)
 
 
-def fetch_file(base_urls, file_record, grabchunk=1024 * 4, auth_file=None, region=None):
+class RateLimiter(object):
+    """Paces transfers to `rate` bytes per second.
+
+    Each reservation moves a virtual clock forward by the time needed to
+    transfer its bytes and returns how long the caller has to wait for
+    its turn. Bulk reservations also wait until no high priority
+    reservation has been made for PRIORITY_HIGH_GRACE seconds. If `path`
+    is given, the clock is kept in that file under an exclusive lock so
+    that every process using the same file shares the budget, e.g. all
+    of the containers on a host."""
+
+    def __init__(self, rate, path=None):
+        self.rate = float(rate)
+        self.path = path
+        self.lock = threading.Lock()
+        self.state = {'next': 0.0, 'high_until': 0.0}
+
+    def _reserve(self, state, nbytes, priority):
+        now = time.time()
+        start = max(now, state['next'])
+        if priority == PRIORITY_BULK:
+            start = max(start, state['high_until'])
+        state['next'] = start + nbytes / self.rate
+        if priority == PRIORITY_HIGH:
+            state['high_until'] = state['next'] + PRIORITY_HIGH_GRACE
+        return start - now
+
+    def reserve(self, nbytes, priority):
+        with self.lock:
+            if not self.path:
+                return self._reserve(self.state, nbytes, priority)
+            import fcntl
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0666)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                try:
+                    state = json.loads(os.read(fd, 1024))
+                except ValueError:
+                    state = dict(self.state)
+                delay = self._reserve(state, nbytes, priority)
+                data = json.dumps(state)
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.ftruncate(fd, 0)
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+            return delay
+
+
+class Throttle(object):
+    """Rate limits for transfers in this process and, optionally, for
+    all processes sharing host_rate_file. Files of at most
+    small_file_size bytes are transferred with high priority, larger
+    ones as bulk. Records the bytes transferred and the time spent
+    throttled per priority class."""
+
+    def __init__(self, rate=0, host_rate=0, host_rate_file=None, small_file_size=0):
+        self.limiters = []
+        if rate:
+            self.limiters.append(RateLimiter(rate))
+        if host_rate and host_rate_file:
+            self.limiters.append(RateLimiter(host_rate, host_rate_file))
+        self.small_file_size = small_file_size
+        self.lock = threading.Lock()
+        self.stats = {}
+        for priority in (PRIORITY_HIGH, PRIORITY_BULK):
+            self.stats[priority] = {'bytes': 0, 'throttled': 0.0}
+
+    def __nonzero__(self):
+        return bool(self.limiters)
+
+    def priority(self, size):
+        return PRIORITY_HIGH if size <= self.small_file_size else PRIORITY_BULK
+
+    def wait(self, nbytes, priority):
+        """Sleep until nbytes may be transferred and return the time
+        slept."""
+        delay = max(limiter.reserve(nbytes, priority) for limiter in self.limiters)
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            delay = 0.0
+        with self.lock:
+            self.stats[priority]['bytes'] += nbytes
+            self.stats[priority]['throttled'] += delay
+        return delay
+
+    def summary(self):
+        return ', '.join('%s priority %d bytes throttled %.1fs' % (
+            priority, self.stats[priority]['bytes'], self.stats[priority]['throttled'])
+            for priority in (PRIORITY_HIGH, PRIORITY_BULK))
+
+
+class ThrottledReader(object):
+    """File like object reading from f as fast as throttle allows."""
+
+    def __init__(self, f, throttle, priority):
+        self.f = f
+        self.throttle = throttle
+        self.priority = priority
+        self.pending = 0
+        self.throttled = 0.0
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.pending += len(data)
+        if self.pending >= THROTTLE_QUANTUM or (not data and self.pending):
+            self.throttled += self.throttle.wait(self.pending, self.priority)
+            self.pending = 0
+        return data
+
+    def fileno(self):
+        # httplib uses it to find the Content-Length of a request body.
+        return self.f.fileno()
+
+
+def make_throttle(options):
+    """Return the Throttle configured by the command line options, which
+    default to the TOOLTOOL_MAX_RATE, TOOLTOOL_HOST_MAX_RATE and
+    TOOLTOOL_HOST_RATE_FILE environment variables."""
+    def megabytes(name, env):
+        value = options.get(name)
+        if value is None:
+            value = float(os.environ.get(env) or 0)
+        return int(value * 1024 * 1024)
+    return Throttle(megabytes('max_rate', 'TOOLTOOL_MAX_RATE'),
+                    megabytes('host_max_rate', 'TOOLTOOL_HOST_MAX_RATE'),
+                    options.get('host_rate_file') or os.environ.get('TOOLTOOL_HOST_RATE_FILE'),
+                    int(options.get('small_file_size', 0) * 1024 * 1024))
+
+
+class HotCache(object):
+    """Hot tier in front of the cache folder for small, frequently used
+    blobs.
+
+    Blobs of at most max_file_size bytes are promoted from the cache
+    folder, or from a download, once they have been accessed
+    HOT_PROMOTE_HITS times, and the least used ones are evicted beyond
+    max_bytes. The tier lives in `folder`, normally on tmpfs, with an
+    index of access counts and per tier stats shared by all processes
+    using it, or in memory when `folder` is None, which is only useful
+    in the serve daemon. Blobs are verified before they are promoted, so
+    files materialized from the tier are not hashed again."""
+
+    INDEX = '.index.json'
+
+    def __init__(self, folder, max_bytes, max_file_size, promote_hits=HOT_PROMOTE_HITS):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.promote_hits = promote_hits
+        self.data = {}
+        self.memory_index = {'entries': {}, 'stats': {}}
+        # tier -> accesses served by it in this process
+        self.stats = {'hot': 0, 'disk': 0, 'download': 0}
+        self.lock = threading.Lock()
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder, 0700)
+
+    def _update_index(self, func):
+        with self.lock:
+            if not self.folder:
+                return func(self.memory_index)
+            import fcntl
+            fd = os.open(os.path.join(self.folder, self.INDEX), os.O_RDWR | os.O_CREAT, 0600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                data = ''
+                chunk = os.read(fd, 1024 * 64)
+                while chunk:
+                    data += chunk
+                    chunk = os.read(fd, 1024 * 64)
+                try:
+                    index = json.loads(data)
+                except ValueError:
+                    index = {'entries': {}, 'stats': {}}
+                rv = func(index)
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.ftruncate(fd, 0)
+                os.write(fd, json.dumps(index))
+            finally:
+                os.close(fd)
+            return rv
+
+    def _access(self, index, digest, tier):
+        entry = index['entries'].setdefault(digest, {'hits': 0, 'size': None})
+        entry['hits'] += 1
+        entry['last'] = time.time()
+        index['stats'][tier] = index['stats'].get(tier, 0) + 1
+        return entry
+
+    def materialize(self, digest, algorithm, dest):
+        """Write the blob to dest and return True if it is in the tier."""
+        try:
+            if self.folder:
+                shutil.copy(os.path.join(self.folder, digest), dest)
+            elif digest in self.data:
+                with open(dest, 'wb') as f:
+                    f.write(self.data[digest])
+            else:
+                return False
+        except IOError:
+            return False
+        remember_digest(dest, algorithm, digest)
+        self._update_index(lambda index: self._access(index, digest, 'hot'))
+        self.stats['hot'] += 1
+        return True
+
+    def record(self, digest, source, size, tier):
+        """Count an access to a blob served by `tier`, disk or download,
+        from the verified file at source, and promote it if it is used
+        often enough."""
+        self.stats[tier] += 1
+
+        def update(index):
+            entry = self._access(index, digest, tier)
+            if size > self.max_file_size or entry['size'] is not None or \
+               entry['hits'] < self.promote_hits:
+                return
+            try:
+                if self.folder:
+                    fd, temp_path = tempfile.mkstemp(dir=self.folder)
+                    os.close(fd)
+                    shutil.copy(source, temp_path)
+                    os.rename(temp_path, os.path.join(self.folder, digest))
+                else:
+                    with open(source, 'rb') as f:
+                        self.data[digest] = f.read()
+            except (IOError, OSError):
+                log.warning("Impossible to promote %s to the hot cache" % digest, exc_info=True)
+                return
+            entry['size'] = size
+            log.info("Promoted %s to the hot cache" % digest)
+            self._evict(index)
+
+        self._update_index(update)
+
+    def _evict(self, index):
+        stored = [(e['hits'], e['last'], d) for d, e in index['entries'].items()
+                  if e['size'] is not None]
+        total = sum(index['entries'][d]['size'] for _, _, d in stored)
+        for _, _, digest in sorted(stored):
+            if total <= self.max_bytes:
+                break
+            total -= index['entries'][digest]['size']
+            index['entries'][digest]['size'] = None
+            # the access count is kept so that it is promoted again if
+            # it stays in use.
+            if self.folder:
+                try:
+                    os.remove(os.path.join(self.folder, digest))
+                except OSError:
+                    pass
+            else:
+                self.data.pop(digest, None)
+
+    def summary(self):
+        totals = self._update_index(lambda index: dict(index['stats']))
+        accesses = sum(totals.values()) or 1
+        return 'this fetch: %s; overall hit rate: %s' % (
+            ', '.join('%s %d' % (tier, self.stats[tier]) for tier in ('hot', 'disk', 'download')),
+            ', '.join('%s %.0f%%' % (tier, 100.0 * totals.get(tier, 0) / accesses)
+                      for tier in ('hot', 'disk', 'download')))
+
+
+def make_hot_cache(options):
+    """Return the HotCache configured by the command line options, or
+    None. The serve daemon keeps a memory tier if no folder is given."""
+    global _memory_hot_cache
+    folder = options.get('hot_cache_folder') or os.environ.get('TOOLTOOL_HOT_CACHE_FOLDER')
+    max_bytes = int(options.get('hot_cache_size', 0) * 1024 * 1024)
+    max_file_size = int(options.get('hot_max_file_size', 0) * 1024 * 1024)
+    if not max_bytes:
+        return None
+    if folder:
+        return HotCache(folder, max_bytes, max_file_size)
+    if _daemon:
+        if _memory_hot_cache is None:
+            _memory_hot_cache = HotCache(None, max_bytes, max_file_size)
+        return _memory_hot_cache
+    return None
+
+
+def _chunk_cut(buf, end):
+    """Return the length of the first chunk of buf, scanning up to end.
+    This loop is where chunking spends its time, about 8MB/s on python
+    2.7, so it iterates over a slice rather than indexing buf."""
+    gear = CHUNK_GEAR
+    mask = CHUNK_MASK
+    h = 0
+    i = CHUNK_MIN_SIZE
+    for c in buf[CHUNK_MIN_SIZE:end]:
+        h = ((h << 1) + gear[c]) & 0xFFFFFFFF
+        i += 1
+        if not h & mask:
+            return i
+    return end
+
+
+def iter_chunks(f):
+    """Split the file object f into content defined chunks, yielding the
+    data of each chunk."""
+    buf = bytearray()
+    eof = False
+    while True:
+        while not eof and len(buf) < CHUNK_MAX_SIZE:
+            data = f.read(CHUNK_MAX_SIZE - len(buf))
+            if not data:
+                eof = True
+            buf.extend(data)
+        if not buf:
+            return
+        cut = _chunk_cut(buf, min(len(buf), CHUNK_MAX_SIZE))
+        yield str(buf[:cut])
+        del buf[:cut]
+
+
+def chunk_list(path):
+    """Return [[sha256, size], ...] of the chunks of the file at path."""
+    with open(path, 'rb') as f:
+        return [[hashlib.sha256(chunk).hexdigest(), len(chunk)] for chunk in iter_chunks(f)]
+
+
+class ChunkStore(object):
+    """Deduplicating store of cached files beneath the cache folder.
+
+    Files are split into content defined chunks which are stored once in
+    `folder`/chunks/, so versions of a file which differ in a few places
+    share most of their chunks. `folder`/files/<digest> lists the chunks
+    of a file, and is touched whenever the file is materialized so that
+    purge() removes the least recently used files first. The chunks are
+    verified when they are added; materialized files are verified by the
+    caller against the manifest like any other cached file."""
+
+    def __init__(self, folder):
+        self.folder = folder
+        for name in ('chunks', 'files'):
+            if not os.path.isdir(os.path.join(folder, name)):
+                os.makedirs(os.path.join(folder, name), 0700)
+        # chunks added and bytes written by this process
+        self.added = 0
+        self.added_bytes = 0
+
+    def recipe_path(self, digest):
+        return os.path.join(self.folder, 'files', digest)
+
+    def chunk_path(self, chunk_digest):
+        return os.path.join(self.folder, 'chunks', chunk_digest[:2], chunk_digest)
+
+    def has(self, digest):
+        return os.path.exists(self.recipe_path(digest))
+
+    def recipe(self, digest):
+        with open(self.recipe_path(digest)) as f:
+            return json.load(f)
+
+    def has_chunk(self, chunk_digest):
+        return os.path.exists(self.chunk_path(chunk_digest))
+
+    def add_chunk(self, chunk_digest, data):
+        if hashlib.sha256(data).hexdigest() != chunk_digest:
+            raise IOError('chunk %s has digest %s' % (chunk_digest,
+                                                      hashlib.sha256(data).hexdigest()))
+        path = self.chunk_path(chunk_digest)
+        if os.path.exists(path):
+            return
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path), 0700)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.partial-')
+        with os.fdopen(fd, 'wb') as out:
+            out.write(data)
+        os.rename(temp_path, path)
+        self.added += 1
+        self.added_bytes += len(data)
+
+    def add_recipe(self, digest, algorithm, size, chunks):
+        fd, temp_path = tempfile.mkstemp(dir=os.path.join(self.folder, 'files'),
+                                         prefix='.partial-')
+        with os.fdopen(fd, 'w') as out:
+            json.dump({'algorithm': algorithm, 'size': size, 'chunker': CHUNKER,
+                       'chunks': chunks}, out)
+        os.rename(temp_path, self.recipe_path(digest))
+
+    def add(self, path, digest, algorithm):
+        """Store the verified file at path, returning the number of bytes
+        of it which were not already stored."""
+        added_bytes = self.added_bytes
+        chunks = []
+        with open(path, 'rb') as f:
+            for data in iter_chunks(f):
+                chunk_digest = hashlib.sha256(data).hexdigest()
+                self.add_chunk(chunk_digest, data)
+                chunks.append([chunk_digest, len(data)])
+        self.add_recipe(digest, algorithm, sum(size for _, size in chunks), chunks)
+        return self.added_bytes - added_bytes
+
+    def materialize(self, digest, dest):
+        """Reassemble the file with digest into dest. Raises IOError if
+        it is not stored or a chunk is missing."""
+        recipe = self.recipe(digest)
+        try:
+            with open(dest, 'wb') as out:
+                for chunk_digest, _ in recipe['chunks']:
+                    with open(self.chunk_path(chunk_digest), 'rb') as f:
+                        shutil.copyfileobj(f, out)
+        except IOError:
+            if os.path.exists(dest):
+                os.remove(dest)
+            raise
+        touch(self.recipe_path(digest))
+
+    def remove(self, digest):
+        os.remove(self.recipe_path(digest))
+
+    def gc(self):
+        """Remove the chunks which are not used by any stored file and
+        return the number of bytes freed."""
+        used = set()
+        for name in os.listdir(os.path.join(self.folder, 'files')):
+            try:
+                with open(os.path.join(self.folder, 'files', name)) as f:
+                    used.update(chunk_digest for chunk_digest, _ in json.load(f)['chunks'])
+            except (IOError, ValueError):
+                # a partial recipe being written, its chunks are kept
+                # until the next gc.
+                pass
+        freed = 0
+        for dirpath, _, filenames in os.walk(os.path.join(self.folder, 'chunks')):
+            for name in filenames:
+                if name in used or name.startswith('.partial-'):
+                    continue
+                p = os.path.join(dirpath, name)
+                try:
+                    freed += os.path.getsize(p)
+                    os.remove(p)
+                except OSError:
+                    log.info("Impossible to remove %s" % p, exc_info=True)
+        return freed
+
+    def summary(self):
+        """Describe the bytes of the stored files, the bytes of their
+        chunks and the resulting dedupe ratio."""
+        files = logical = 0
+        for name in os.listdir(os.path.join(self.folder, 'files')):
+            if name.startswith('.partial-'):
+                continue
+            try:
+                logical += self.recipe(name)['size']
+                files += 1
+            except (IOError, ValueError):
+                pass
+        chunks = stored = 0
+        for dirpath, _, filenames in os.walk(os.path.join(self.folder, 'chunks')):
+            for name in filenames:
+                if not name.startswith('.partial-'):
+                    chunks += 1
+                    stored += os.path.getsize(os.path.join(dirpath, name))
+        return '%d files of %d bytes stored in %d chunks of %d bytes, dedupe ratio %.2f' % (
+            files, logical, chunks, stored, float(logical) / stored if stored else 1.0)
+
+
+def make_chunk_store(options):
+    """Return the ChunkStore in the cache folder if --chunk-store is set,
+    or None."""
+    if not options.get('chunk_store') or not options.get('cache_folder'):
+        return None
+    return ChunkStore(os.path.join(options['cache_folder'], CHUNK_DIR))
+
+
+def fetch_file(base_urls, file_record, grabchunk=1024 * 4, auth_file=None, region=None,
+               throttle=None):
     # A file which is requested to be fetched that exists locally will be
     # overwritten by this function
     fd, temp_path = tempfile.mkstemp(dir=os.getcwd())
     os.close(fd)
     fetched_path = None
-    for base_url in base_urls:
+    for base_url in order_mirrors(base_urls):
         # Generate the URL for the file on the server side
         url = urlparse.urljoin(base_url,
                                '%s/%s' % (file_record.algorithm, file_record.digest))
@@ -479,6 +1045,8 @@ def fetch_file(base_urls, file_record, grabchunk=1024 * 4, auth_file=None, regio
             _authorize(req, auth_file)
             f = urllib2.urlopen(req)
             log.debug("opened %s for reading" % url)
+            if throttle:
+                f = ThrottledReader(f, throttle, throttle.priority(file_record.size))
             with open(temp_path, 'wb') as out:
                 k = True
                 size = 0
@@ -492,12 +1060,19 @@ def fetch_file(base_urls, file_record, grabchunk=1024 * 4, auth_file=None, regio
                         k = False
                 log.info("File %s fetched from %s as %s" %
                          (file_record.filename, base_url, temp_path))
+                if throttle:
+                    log.info("File %s was throttled for %.1fs as %s priority" %
+                             (file_record.filename, f.throttled, f.priority))
                 fetched_path = temp_path
+                _mirror_failures.pop(base_url, None)
                 break
         except (urllib2.URLError, urllib2.HTTPError, ValueError) as e:
             log.info("...failed to fetch '%s' from %s" %
                      (file_record.filename, base_url))
             log.debug("%s" % e)
+            if not isinstance(e, urllib2.HTTPError):
+                # the mirror could not be reached, not just this file.
+                _mirror_failures[base_url] = time.time()
         except IOError:  # pragma: no cover
             log.info("failed to write to temporary file for '%s'" %
                      file_record.filename, exc_info=True)
@@ -513,6 +1088,83 @@ def fetch_file(base_urls, file_record, grabchunk=1024 * 4, auth_file=None, regio
         return None
 
 
+def _chunk_ranges(chunks, missing):
+    """Merge the consecutive chunks in missing into byte ranges,
+    returning [(first, last, [[sha256, size], ...]), ...]."""
+    ranges = []
+    offset = 0
+    for chunk_digest, size in chunks:
+        if chunk_digest in missing:
+            if ranges and ranges[-1][1] == offset - 1:
+                ranges[-1][1] += size
+                ranges[-1][2].append([chunk_digest, size])
+            else:
+                ranges.append([offset, offset + size - 1, [[chunk_digest, size]]])
+        offset += size
+    return ranges
+
+
+def fetch_file_delta(base_urls, file_record, chunk_store, auth_file=None, region=None,
+                     throttle=None):
+    """Fetch file_record by downloading only the chunks which are not in
+    chunk_store, for servers which provide the chunk list of a blob at
+    <algorithm>/<digest>.chunks and byte ranges of the blob. Returns the
+    name of a temporary file in the working directory holding the blob
+    like fetch_file(), or None if no server provided a chunk list."""
+    query = '?region=' + region if region is not None else ''
+    for base_url in order_mirrors(base_urls):
+        url = urlparse.urljoin(base_url, '%s/%s' % (file_record.algorithm, file_record.digest))
+        try:
+            req = urllib2.Request(url + '.chunks' + query)
+            _authorize(req, auth_file)
+            listing = json.load(urllib2.urlopen(req))
+        except (urllib2.URLError, urllib2.HTTPError, ValueError, socket.error) as e:
+            log.debug("no chunk list for %s from %s: %s" % (file_record.filename, base_url, e))
+            continue
+        if listing.get('chunker') != CHUNKER or \
+           sum(size for _, size in listing['chunks']) != file_record.size:
+            log.info("chunk list of %s from %s does not match, not using it" %
+                     (file_record.filename, base_url))
+            continue
+        missing = set(chunk_digest for chunk_digest, _ in listing['chunks']
+                      if not chunk_store.has_chunk(chunk_digest))
+        ranges = _chunk_ranges(listing['chunks'], missing)
+        fetched = 0
+        try:
+            for first, last, chunks in ranges:
+                req = urllib2.Request(url + query)
+                req.add_header('Range', 'bytes=%d-%d' % (first, last))
+                _authorize(req, auth_file)
+                f = urllib2.urlopen(req)
+                if f.getcode() != 206:
+                    raise IOError('%s does not serve byte ranges' % base_url)
+                if throttle:
+                    f = ThrottledReader(f, throttle, throttle.priority(file_record.size))
+                for chunk_digest, size in chunks:
+                    data = f.read(size)
+                    chunk_store.add_chunk(chunk_digest, data)
+                    fetched += len(data)
+        except (urllib2.URLError, urllib2.HTTPError, ValueError, IOError, socket.error) as e:
+            log.info("...failed to fetch the chunks of '%s' from %s: %s" %
+                     (file_record.filename, base_url, e))
+            continue
+        chunk_store.add_recipe(file_record.digest, file_record.algorithm, file_record.size,
+                               listing['chunks'])
+        fd, temp_path = tempfile.mkstemp(dir=os.getcwd())
+        os.close(fd)
+        try:
+            chunk_store.materialize(file_record.digest, temp_path)
+        except IOError:
+            log.info("failed to reassemble '%s'" % file_record.filename, exc_info=True)
+            return None
+        log.info("File %s fetched from %s as %s by downloading %d of %d bytes in %d of %d "
+                 "chunks" % (file_record.filename, base_url, temp_path, fetched,
+                             file_record.size, len(missing), len(listing['chunks'])))
+        _mirror_failures.pop(base_url, None)
+        return os.path.split(temp_path)[1]
+    return None
+
+
 def clean_path(dirname):
     """Remove a subtree if is exists. Helper for unpack_file()."""
     if os.path.exists(dirname):
@@ -520,31 +1172,132 @@ def clean_path(dirname):
         shutil.rmtree(dirname)
 
 
-def unpack_file(filename, setup=None):
+def member_selected(name, include=None, exclude=None):
+    """Whether the archive member `name` matches one of the `include`
+    patterns, if any, and none of the `exclude` patterns. As with tar,
+    '*' also matches '/'."""
+    if name.startswith('./'):
+        name = name[2:]
+    if include and not any(fnmatch.fnmatchcase(name, p) for p in include):
+        return False
+    return not (exclude and any(fnmatch.fnmatchcase(name, p) for p in exclude))
+
+
+def _log_selection(filename, extracted, skipped, skipped_bytes):
+    log.info('unpacked %d members of "%s", skipped %d members of %d bytes' %
+             (extracted, filename, skipped, skipped_bytes))
+
+
+def _list_tar_xz(filename):
+    """Return a list of (name, size) of the members of the .tar.xz
+    `filename`, listed by tar, or None if it cannot be listed. Names are
+    in tar's escaped form, which it unquotes again in a --files-from
+    list."""
+    process = Popen(['tar', '-tvJf', filename], stdout=PIPE)
+    members = []
+    for line in process.stdout:
+        # e.g. "-rw-r--r-- user/group 1234 2020-01-01 12:00 pkg/file"
+        fields = line.rstrip('\n').split(None, 5)
+        if len(fields) < 6:
+            continue
+        mode, size, name = fields[0], fields[2], fields[5]
+        if mode.startswith('l'):
+            name = name.split(' -> ', 1)[0]
+        elif mode.startswith('h'):
+            name = name.split(' link to ', 1)[0]
+        members.append((name, int(size) if size.isdigit() else 0))
+    if process.wait() != 0:
+        return None
+    return members
+
+
+def _untar_xz_selected(filename, include, exclude):
+    """Extract the members of the .tar.xz `filename` selected by
+    member_selected(). Return whether tar succeeded."""
+    members = _list_tar_xz(filename)
+    if members is None:
+        log.error('failed to list "%s"' % filename)
+        return False
+    selected = []
+    skipped = skipped_bytes = 0
+    for name, size in members:
+        if member_selected(name, include, exclude):
+            selected.append(name)
+        else:
+            skipped += 1
+            skipped_bytes += size
+    if selected:
+        fd, list_path = tempfile.mkstemp(dir=os.getcwd(), prefix='.members-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(''.join('%s\n' % name for name in selected))
+            # --no-recursion since a selected directory would otherwise
+            # bring along its skipped members.
+            if not execute('tar -Jxf %s --no-recursion -T %s 2>&1' % (
+                    pipes.quote(filename), pipes.quote(list_path))):
+                return False
+        finally:
+            os.remove(list_path)
+    _log_selection(filename, len(selected), skipped, skipped_bytes)
+    return True
+
+
+def unpack_file(filename, setup=None, include=None, exclude=None):
     """Untar `filename`, assuming it is uncompressed or compressed with bzip2,
     xz, gzip, or unzip a zip file. The file is assumed to contain a single
     directory with a name matching the base of the given filename.
-    Xz support is handled by shelling out to 'tar'."""
+    Xz support is handled by shelling out to 'tar'. If `include` or
+    `exclude` patterns are given, only the matching members are unpacked,
+    see member_selected()."""
+    selective = bool(include or exclude)
     if tarfile.is_tarfile(filename):
         tar_file, zip_ext = os.path.splitext(filename)
         base_file, tar_ext = os.path.splitext(tar_file)
         clean_path(base_file)
         log.info('untarring "%s"' % filename)
         tar = tarfile.open(filename)
-        tar.extractall()
+        if selective:
+            members = []
+            skipped = skipped_bytes = 0
+            for member in tar:
+                if member_selected(member.name, include, exclude):
+                    members.append(member)
+                else:
+                    skipped += 1
+                    skipped_bytes += member.size
+            tar.extractall(members=members)
+            _log_selection(filename, len(members), skipped, skipped_bytes)
+        else:
+            tar.extractall()
         tar.close()
     elif filename.endswith('.tar.xz'):
         base_file = filename.replace('.tar.xz', '')
         clean_path(base_file)
         log.info('untarring "%s"' % filename)
-        if not execute('tar -Jxf %s 2>&1' % filename):
+        if selective:
+            if not _untar_xz_selected(filename, include, exclude):
+                return False
+        elif not execute('tar -Jxf %s 2>&1' % pipes.quote(filename)):
             return False
     elif zipfile.is_zipfile(filename):
         base_file = filename.replace('.zip', '')
         clean_path(base_file)
         log.info('unzipping "%s"' % filename)
         z = zipfile.ZipFile(filename)
-        z.extractall()
+        if selective:
+            # only the selected members are read from the archive.
+            members = []
+            skipped = skipped_bytes = 0
+            for info in z.infolist():
+                if member_selected(info.filename, include, exclude):
+                    members.append(info)
+                else:
+                    skipped += 1
+                    skipped_bytes += info.file_size
+            z.extractall(members=members)
+            _log_selection(filename, len(members), skipped, skipped_bytes)
+        else:
+            z.extractall()
         z.close()
     else:
         log.error("Unknown archive extension for filename '%s'" % filename)
@@ -556,7 +1309,8 @@ def unpack_file(filename, setup=None):
 
 
 def fetch_files(manifest_file, base_urls, filenames=[], cache_folder=None,
-                auth_file=None, region=None):
+                auth_file=None, region=None, throttle=None, select=None, reserve=0,
+                hot_cache=None, chunk_store=None):
     # Lets load the manifest file
     try:
         manifest = open_manifest(manifest_file)
@@ -582,8 +1336,23 @@ def fetch_files(manifest_file, base_urls, filenames=[], cache_folder=None,
     # Setup for unpacked files.
     setup_files = {}
 
+    # Member patterns of unpacked files.
+    unpack_patterns = {}
+
+    records = manifest.file_records
+    if select is not None:
+        # only handle these records, see fetch_background()
+        records = [f for f in records if f.filename in select]
+    if throttle:
+        # fetch the small files before the bulk ones.
+        records = sorted(records, key=lambda f: throttle.priority(f.size) != PRIORITY_HIGH)
+
+    # fail now rather than after downloading if the files will not fit.
+    if not check_space(records, cache_folder, reserve):
+        return False
+
     # Lets go through the manifest and fetch the files that we want
-    for f in manifest.file_records:
+    for f in records:
         # case 1: files are already present
         if f.present():
             if f.validate():
@@ -598,6 +1367,17 @@ def fetch_files(manifest_file, base_urls, filenames=[], cache_folder=None,
                          "and try to fetch it" % f.filename)
                 os.remove(os.path.join(os.getcwd(), f.filename))
 
+        # check if file is in the hot tier of the cache
+        if hot_cache and f.filename not in present_files and \
+           hot_cache.materialize(f.digest, f.algorithm, os.path.join(os.getcwd(), f.filename)):
+            if FileRecord(f.filename, f.size, f.digest, f.algorithm).validate():
+                log.info("File %s retrieved from hot cache" % f.filename)
+                present_files.append(f.filename)
+                if f.unpack:
+                    unpack_files.append(f.filename)
+            else:
+                os.remove(os.path.join(os.getcwd(), f.filename))
+
         # check if file is already in cache
         if cache_folder and f.filename not in present_files:
             try:
@@ -613,6 +1393,9 @@ def fetch_files(manifest_file, base_urls, filenames=[], cache_folder=None,
                     present_files.append(f.filename)
                     if f.unpack:
                         unpack_files.append(f.filename)
+                    if hot_cache:
+                        hot_cache.record(f.digest, os.path.join(os.getcwd(), f.filename),
+                                         f.size, 'disk')
                 else:
                     # the file copied from the cache is invalid, better to
                     # clean up the cache version itself as well
@@ -624,6 +1407,28 @@ def fetch_files(manifest_file, base_urls, filenames=[], cache_folder=None,
                 log.info("File %s not present in local cache folder %s" %
                          (f.filename, cache_folder))
 
+        # check if file is in the chunk store of the cache
+        if chunk_store and f.filename not in present_files and chunk_store.has(f.digest):
+            try:
+                chunk_store.materialize(f.digest, os.path.join(os.getcwd(), f.filename))
+            except IOError:
+                log.info("File %s is incomplete in the chunk store" % f.filename)
+                chunk_store.remove(f.digest)
+            else:
+                if FileRecord(f.filename, f.size, f.digest, f.algorithm).validate():
+                    log.info("File %s retrieved from chunk store" % f.filename)
+                    present_files.append(f.filename)
+                    if f.unpack:
+                        unpack_files.append(f.filename)
+                    if hot_cache:
+                        hot_cache.record(f.digest, os.path.join(os.getcwd(), f.filename),
+                                         f.size, 'disk')
+                else:
+                    log.warn("File %s retrieved from the chunk store is invalid! I am deleting "
+                             "it from the store as well" % f.filename)
+                    os.remove(os.path.join(os.getcwd(), f.filename))
+                    chunk_store.remove(f.digest)
+
         # now I will try to fetch all files which are not already present and
         # valid, appending a suffix to avoid race conditions
         temp_file_name = None
@@ -633,7 +1438,12 @@ def fetch_files(manifest_file, base_urls, filenames=[], cache_folder=None,
         # either in the working dir or in the cache
         if (f.filename in filenames or len(filenames) == 0) and f.filename not in present_files:
             log.debug("fetching %s" % f.filename)
-            temp_file_name = fetch_file(base_urls, f, auth_file=auth_file, region=region)
+            if chunk_store:
+                temp_file_name = fetch_file_delta(base_urls, f, chunk_store, auth_file=auth_file,
+                                                  region=region, throttle=throttle)
+            if not temp_file_name:
+                temp_file_name = fetch_file(base_urls, f, auth_file=auth_file, region=region,
+                                            throttle=throttle)
             if temp_file_name:
                 fetched_files.append((f, temp_file_name))
             else:
@@ -641,6 +1451,14 @@ def fetch_files(manifest_file, base_urls, filenames=[], cache_folder=None,
         else:
             log.debug("skipping %s" % f.filename)
 
+        if f.include or f.exclude:
+            if f.unpack:
+                unpack_patterns[f.filename] = (f.include, f.exclude)
+            else:
+                log.error("'include' and 'exclude' require 'unpack' being set for %s" %
+                          f.filename)
+                failed_files.append(f.filename)
+
         if f.setup:
             if f.unpack:
                 setup_files[f.filename] = f.setup
@@ -667,9 +1485,26 @@ def fetch_files(manifest_file, base_urls, filenames=[], cache_folder=None,
             if localfile.unpack:
                 unpack_files.append(localfile.filename)
 
+            if hot_cache:
+                hot_cache.record(localfile.digest, os.path.join(os.getcwd(), localfile.filename),
+                                 localfile.size, 'download')
+
             # if I am using a cache and a new file has just been retrieved from a
             # remote location, I need to update the cache as well
-            if cache_folder:
+            if chunk_store:
+                try:
+                    if chunk_store.has(localfile.digest):
+                        # fetched by fetch_file_delta()
+                        touch(chunk_store.recipe_path(localfile.digest))
+                    else:
+                        added = chunk_store.add(os.path.join(os.getcwd(), localfile.filename),
+                                                localfile.digest, localfile.algorithm)
+                        log.info("Chunk store updated with %s, %d of its %d bytes were new" %
+                                 (localfile.filename, added, localfile.size))
+                except (OSError, IOError):
+                    log.warning('Impossible to add file %s to the chunk store' %
+                                localfile.filename, exc_info=True)
+            elif cache_folder:
                 log.info("Updating local cache %s..." % cache_folder)
                 try:
                     if not os.path.exists(cache_folder):
@@ -690,9 +1525,17 @@ def fetch_files(manifest_file, base_urls, filenames=[], cache_folder=None,
 
     # Unpack files that need to be unpacked.
     for filename in unpack_files:
-        if not unpack_file(filename, setup_files.get(filename)):
+        include, exclude = unpack_patterns.get(filename, (None, None))
+        if not unpack_file(filename, setup_files.get(filename), include, exclude):
             failed_files.append(filename)
 
+    if throttle:
+        log.info("transfer stats: %s" % throttle.summary())
+    if hot_cache:
+        log.info("cache stats: %s" % hot_cache.summary())
+    if chunk_store and fetched_files:
+        log.info("chunk store: %s" % chunk_store.summary())
+
     # If we failed to fetch or validate a file, we need to fail
     if len(failed_files) > 0:
         log.error("The following files failed: '%s'" %
@@ -701,6 +1544,141 @@ def fetch_files(manifest_file, base_urls, filenames=[], cache_folder=None,
     return True
 
 
+def _marker_path(filename, state):
+    return os.path.join(os.getcwd(), MARKER_DIR, '%s.%s' % (filename, state))
+
+
+def set_marker(filename, state, detail=''):
+    """Record that filename is pending, ok or failed."""
+    for other in ('pending', 'ok', 'failed'):
+        if other != state and os.path.exists(_marker_path(filename, other)):
+            os.remove(_marker_path(filename, other))
+    with open(_marker_path(filename, state), 'w') as f:
+        f.write(detail)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+def fetch_background(manifest_file, base_urls, critical, filenames=[], cache_folder=None,
+                     auth_file=None, region=None, throttle=None, reserve=0,
+                     hot_cache=None, chunk_store=None):
+    """Fetch the `critical` files of the manifest, then return while a
+    detached process fetches the others one by one, or only those in
+    `filenames` if it is not empty. The readiness of each of those is
+    recorded in MARKER_DIR, which the wait command checks."""
+    try:
+        manifest = open_manifest(manifest_file)
+    except InvalidManifest as e:
+        log.error("failed to load manifest file at '%s': %s" % (
+            manifest_file,
+            str(e),
+        ))
+        return False
+    names = [f.filename for f in manifest.file_records]
+    unknown = set(critical) - set(names)
+    if unknown:
+        log.error("critical files are not in the manifest: '%s'" % "', '".join(sorted(unknown)))
+        return False
+    records = [f for f in manifest.file_records
+               if not filenames or f.filename in filenames or f.filename in critical]
+    rest = [f.filename for f in records if f.filename not in critical]
+    if not check_space(records, cache_folder, reserve):
+        return False
+    if critical and not fetch_files(manifest_file, base_urls, cache_folder=cache_folder,
+                                    auth_file=auth_file, region=region, throttle=throttle,
+                                    select=critical, reserve=reserve,
+                                    hot_cache=hot_cache, chunk_store=chunk_store):
+        return False
+    if not rest:
+        return True
+
+    if not os.path.isdir(MARKER_DIR):
+        os.makedirs(MARKER_DIR)
+    for name in rest:
+        set_marker(name, 'pending')
+    log_path = os.path.join(os.getcwd(), MARKER_DIR, 'background.log')
+    log.info("fetching '%s' in the background, see %s" % ("', '".join(rest), log_path))
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid:
+        os.waitpid(pid, 0)
+        return True
+
+    # detach from the caller, which may be waiting for its output to
+    # end, and fork again so that the fetching process is not left as a
+    # zombie of a long lived parent such as the serve daemon.
+    try:
+        os.setsid()
+        if os.fork():
+            os._exit(0)
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(devnull, 0)
+        output = os.open(log_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0644)
+        os.dup2(output, 1)
+        os.dup2(output, 2)
+        sys.stdout = sys.__stdout__
+        handler = logging.StreamHandler(sys.__stderr__)
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s - %(message)s"))
+        log.handlers = [handler]
+        ok = True
+        for name in rest:
+            set_marker(name, 'pending', str(os.getpid()))
+        for name in rest:
+            if fetch_files(manifest_file, base_urls, cache_folder=cache_folder,
+                           auth_file=auth_file, region=region, throttle=throttle,
+                           select=[name], reserve=reserve, hot_cache=hot_cache,
+                           chunk_store=chunk_store):
+                set_marker(name, 'ok')
+            else:
+                set_marker(name, 'failed', 'see %s' % log_path)
+                ok = False
+    except Exception:
+        log.exception("background fetch failed:")
+        ok = False
+    sys.stdout.flush()
+    os._exit(0 if ok else 1)
+
+
+def wait_files(filenames, timeout=0):
+    """Wait until the files fetched in the background are ready. Files
+    which are not being fetched in the background only need to be
+    present. Fails if a file failed, or is not ready within timeout
+    seconds, if timeout is not 0."""
+    deadline = time.time() + timeout if timeout else None
+    for name in filenames:
+        while True:
+            if os.path.exists(_marker_path(name, 'ok')):
+                break
+            if os.path.exists(_marker_path(name, 'failed')):
+                with open(_marker_path(name, 'failed')) as f:
+                    log.error("%s failed to be fetched: %s" % (name, f.read()))
+                return False
+            try:
+                with open(_marker_path(name, 'pending')) as f:
+                    pid = f.read()
+            except IOError:
+                if os.path.exists(name):
+                    break
+                log.error("%s is not present and not being fetched" % name)
+                return False
+            if pid and not _pid_alive(int(pid)):
+                log.error("the background fetch of %s (pid %s) has gone away" % (name, pid))
+                return False
+            if deadline and time.time() > deadline:
+                log.error("timed out waiting for %s" % name)
+                return False
+            time.sleep(0.2)
+        log.info("%s is ready" % name)
+    return True
+
+
 def freespace(p):
     "Returns the number of bytes free under directory `p`"
     if sys.platform == 'win32':  # pragma: no cover
@@ -715,10 +1693,12 @@ def freespace(p):
         return r.f_frsize * r.f_bavail
 
 
-def purge(folder, gigs):
+def purge(folder, gigs, keep=()):
     """If gigs is non 0, it deletes files in `folder` until `gigs` GB are free,
     starting from older files.  If gigs is 0, a full purge will be performed.
-    No recursive deletion of files in subfolder is performed."""
+    No recursive deletion of files in subfolder is performed, except for
+    the files of the chunk store, whose chunks are removed once no file
+    uses them. Files named in `keep` are not deleted."""
 
     full_purge = bool(gigs == 0)
     gigs *= 1024 * 1024 * 1024
@@ -732,11 +1712,19 @@ def purge(folder, gigs):
         p = os.path.join(folder, f)
         # it deletes files in folder without going into subfolders,
         # assuming the cache has a flat structure
-        if not os.path.isfile(p):
+        if not os.path.isfile(p) or f in keep:
             continue
         mtime = os.path.getmtime(p)
         files.append((mtime, p))
 
+    chunk_store = None
+    if os.path.isdir(os.path.join(folder, CHUNK_DIR, 'files')):
+        chunk_store = ChunkStore(os.path.join(folder, CHUNK_DIR))
+        for f in os.listdir(os.path.join(chunk_store.folder, 'files')):
+            if f not in keep and not f.startswith('.partial-'):
+                p = chunk_store.recipe_path(f)
+                files.append((os.path.getmtime(p), p))
+
     # iterate files sorted by mtime
     for _, f in sorted(files):
         log.info("removing %s to free up space" % f)
@@ -744,8 +1732,468 @@ def purge(folder, gigs):
             os.remove(f)
         except OSError:
             log.info("Impossible to remove %s" % f, exc_info=True)
+        if chunk_store and f.startswith(chunk_store.folder):
+            # a file of the chunk store only frees the chunks no other
+            # file uses.
+            if full_purge:
+                continue
+            log.info("freed %d bytes of chunks" % chunk_store.gc())
         if not full_purge and freespace(folder) >= gigs:
             break
+    if chunk_store and full_purge:
+        chunk_store.gc()
+
+
+def _unpacked_size(path, record):
+    """Return the bytes unpacking the zip file at path for record writes,
+    or None if that is not known without reading the whole archive."""
+    if not zipfile.is_zipfile(path):
+        return None
+    z = zipfile.ZipFile(path)
+    try:
+        return sum(info.file_size for info in z.infolist()
+                   if member_selected(info.filename, record.include, record.exclude))
+    finally:
+        z.close()
+
+
+def check_space(records, cache_folder=None, reserve=0):
+    """Admission control for fetching records into the working directory.
+
+    Estimates the bytes the fetch still needs: the records which are not
+    present, a copy of each fetched record in the cache folder if that is
+    on the same filesystem, and the unpacked size of zip files which are
+    already available. If anything is needed and less than that plus
+    `reserve` is free, purges the cache folder of files the records do
+    not use. Returns False, with a report, if the fetch still does not
+    fit."""
+    cwd = os.getcwd()
+    same_fs = bool(cache_folder) and os.path.isdir(cache_folder) and \
+        os.stat(cache_folder).st_dev == os.stat(cwd).st_dev
+    needed = 0
+    report = []
+    unknown_unpack = []
+    for f in records:
+        local = f.present() and os.path.getsize(f.filename) == f.size
+        cached = bool(cache_folder) and (
+            os.path.exists(os.path.join(cache_folder, f.digest)) or
+            os.path.exists(os.path.join(cache_folder, CHUNK_DIR, 'files', f.digest)))
+        need = 0 if local else f.size
+        if not local and not cached and same_fs:
+            need += f.size
+        if f.unpack:
+            source = f.filename if local else (
+                os.path.join(cache_folder, f.digest) if cached else None)
+            unpacked = _unpacked_size(source, f) if source and os.path.exists(source) else None
+            if unpacked is None:
+                unknown_unpack.append(f.filename)
+            else:
+                need += unpacked
+        if need:
+            report.append("    %s: %d bytes%s" % (
+                f.filename, need, '' if local or cached else ' to download'))
+        needed += need
+
+    # the reserve only applies to fetches which write anything.
+    if not needed:
+        return True
+    free = freespace(cwd)
+    if free - needed >= reserve:
+        return True
+    log.info("fetch needs %d bytes and %d bytes should remain free, but only %d bytes are "
+             "free" % (needed, reserve, free))
+    if same_fs:
+        purge(cache_folder, (needed + reserve) / (1024. * 1024 * 1024),
+              keep=set(f.digest for f in records))
+        free = freespace(cwd)
+        if free - needed >= reserve:
+            return True
+    log.error("not enough disk space in %s for the fetch: %d bytes needed, %d bytes reserved, "
+              "%d bytes free" % (cwd, needed, reserve, free))
+    for line in report:
+        log.error(line)
+    if unknown_unpack:
+        log.error("    and the unknown unpacked size of '%s'" % "', '".join(unknown_unpack))
+    return False
+
+
+class _ProxyFill(object):
+    """A download of one digest from upstream into the proxy's cache,
+    which any number of clients stream from while it is in progress."""
+
+    def __init__(self, temp_path):
+        self.temp_path = temp_path
+        self.cond = threading.Condition()
+        # set once upstream has responded
+        self.started = False
+        self.length = None
+        self.written = 0
+        self.done = False
+        self.error = None
+
+
+class TooltoolProxy(object):
+    """Caching proxy for the sha512/<digest> API of the tooltool server.
+
+    Blobs are fetched from base_urls once into cache_folder, which has
+    the same layout as the --cache-folder of fetch, and streamed to every
+    client requesting them while they are still being fetched. The least
+    recently used blobs are removed when the cache grows above
+    max_bytes.
+
+    The proxy also serves byte ranges of cached blobs and their chunk
+    lists at <algorithm>/<digest>.chunks, which fetch_file_delta() uses
+    to download only the chunks a client is missing. Chunking is slow and
+    holds the GIL, so the chunk list of a blob is only computed once a
+    client asks for it, after the blob has been fetched and verified, in
+    a background thread which chunks one blob at a time. The lists are
+    kept in CHUNK_LIST_DIR next to the blobs; until a blob's list is
+    ready the clients fetch the whole blob."""
+
+    def __init__(self, cache_folder, base_urls, max_bytes, grabchunk=1024 * 64):
+        self.cache_folder = cache_folder
+        self.base_urls = base_urls
+        self.max_bytes = max_bytes
+        self.grabchunk = grabchunk
+        self.fills = {}
+        self.lock = threading.Lock()
+        # digests whose chunk list was requested and is not written yet.
+        self.chunk_lists_wanted = set()
+        self.chunk_list_lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'coalesced': 0, 'failures': 0,
+                      'bytes_served': 0, 'bytes_fetched': 0, 'evicted': 0}
+        if not os.path.exists(os.path.join(cache_folder, CHUNK_LIST_DIR)):
+            os.makedirs(os.path.join(cache_folder, CHUNK_LIST_DIR), 0700)
+
+    def _count(self, name, value=1):
+        with self.lock:
+            self.stats[name] += value
+
+    def lookup(self, algorithm, digest, query):
+        """Return (path, None) if the blob is cached, or (None, fill)
+        for the fill in progress, starting one if needed."""
+        path = os.path.join(self.cache_folder, digest)
+        with self.lock:
+            if digest in self.fills:
+                self.stats['coalesced'] += 1
+                return None, self.fills[digest]
+            if os.path.exists(path):
+                self.stats['hits'] += 1
+                touch(path)
+                return path, None
+            self.stats['misses'] += 1
+            fd, temp_path = tempfile.mkstemp(dir=self.cache_folder, prefix='.partial-')
+            os.close(fd)
+            fill = self.fills[digest] = _ProxyFill(temp_path)
+        thread = threading.Thread(target=self._fill, args=(fill, algorithm, digest, query))
+        thread.daemon = True
+        thread.start()
+        return None, fill
+
+    def chunk_list_path(self, digest):
+        return os.path.join(self.cache_folder, CHUNK_LIST_DIR, digest)
+
+    def _want_chunk_list(self, digest):
+        """Compute the chunk list of a blob in the background, or once
+        the blob is cached if it is not. Clients ask for the chunk list
+        before fetching the blob, so this is usually the latter."""
+        with self.lock:
+            if digest in self.chunk_lists_wanted:
+                return
+            self.chunk_lists_wanted.add(digest)
+            if digest in self.fills or \
+               not os.path.exists(os.path.join(self.cache_folder, digest)):
+                # _fill() starts it once the blob is cached.
+                return
+        self._start_chunk_list(digest)
+
+    def _start_chunk_list(self, digest):
+        thread = threading.Thread(target=self._chunk_list_job, args=(digest,))
+        thread.daemon = True
+        thread.start()
+
+    def _chunk_list_job(self, digest):
+        try:
+            with self.chunk_list_lock:
+                if not os.path.exists(self.chunk_list_path(digest)):
+                    self._write_chunk_list(digest)
+        finally:
+            with self.lock:
+                self.chunk_lists_wanted.discard(digest)
+
+    def _write_chunk_list(self, digest):
+        fd, temp_path = tempfile.mkstemp(dir=os.path.join(self.cache_folder, CHUNK_LIST_DIR),
+                                         prefix='.partial-')
+        try:
+            start = time.time()
+            with os.fdopen(fd, 'w') as out:
+                json.dump({'chunker': CHUNKER,
+                           'chunks': chunk_list(os.path.join(self.cache_folder, digest))}, out)
+            os.rename(temp_path, self.chunk_list_path(digest))
+            log.info("proxy: computed the chunk list of %s in %.1fs" % (digest, time.time() - start))
+        except (IOError, OSError) as e:
+            # evicted meanwhile, clients fetch the whole blob.
+            log.info("proxy: no chunk list for %s: %s" % (digest, e))
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+
+    def _fill(self, fill, algorithm, digest, query):
+        h = hashlib.new(algorithm)
+        try:
+            for base_url in self.base_urls:
+                url = urlparse.urljoin(base_url, '%s/%s' % (algorithm, digest))
+                if query:
+                    url += '?' + query
+                try:
+                    f = urllib2.urlopen(urllib2.Request(url))
+                    break
+                except (urllib2.URLError, urllib2.HTTPError, ValueError) as e:
+                    log.info("proxy: failed to fetch %s from %s: %s" % (digest, base_url, e))
+            else:
+                raise IOError('%s is not available upstream' % digest)
+            with fill.cond:
+                length = f.info().getheader('Content-Length')
+                fill.length = int(length) if length else None
+                fill.started = True
+                fill.cond.notify_all()
+            with open(fill.temp_path, 'wb') as out:
+                while True:
+                    indata = f.read(self.grabchunk)
+                    if not indata:
+                        break
+                    out.write(indata)
+                    out.flush()
+                    h.update(indata)
+                    with fill.cond:
+                        fill.written += len(indata)
+                        fill.cond.notify_all()
+            if h.hexdigest() != digest:
+                raise IOError('%s fetched from upstream has digest %s' % (digest, h.hexdigest()))
+            self._count('bytes_fetched', fill.written)
+            with fill.cond:
+                os.rename(fill.temp_path, os.path.join(self.cache_folder, digest))
+                fill.done = True
+                fill.cond.notify_all()
+            log.info("proxy: cached %s (%d bytes)" % (digest, fill.written))
+            with self.lock:
+                chunk_list_wanted = digest in self.chunk_lists_wanted
+            if chunk_list_wanted:
+                self._start_chunk_list(digest)
+        except Exception as e:
+            log.error("proxy: fetching %s failed: %s" % (digest, e))
+            self._count('failures')
+            with self.lock:
+                self.chunk_lists_wanted.discard(digest)
+            with fill.cond:
+                fill.error = str(e)
+                fill.done = True
+                fill.started = True
+                fill.cond.notify_all()
+            try:
+                os.remove(fill.temp_path)
+            except OSError:
+                pass
+        finally:
+            with self.lock:
+                del self.fills[digest]
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used blobs until the cache is within
+        max_bytes."""
+        files = []
+        total = 0
+        for name in os.listdir(self.cache_folder):
+            if name.startswith('.partial-') or name == CHUNK_LIST_DIR:
+                continue
+            p = os.path.join(self.cache_folder, name)
+            try:
+                st = os.stat(p)
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, name))
+            total += st.st_size
+        for _, size, name in sorted(files):
+            if total <= self.max_bytes:
+                break
+            p = os.path.join(self.cache_folder, name)
+            log.info("proxy: evicting %s" % p)
+            try:
+                # clients still streaming the blob keep their open file.
+                os.remove(p)
+                total -= size
+                self._count('evicted')
+            except OSError:
+                log.info("Impossible to remove %s" % p, exc_info=True)
+            try:
+                os.remove(self.chunk_list_path(name))
+            except OSError:
+                pass
+
+    def _stream_fill(self, fill, digest, wfile):
+        with fill.cond:
+            if fill.error:
+                raise IOError(fill.error)
+            if fill.done:
+                # the fill completed and was renamed since lookup().
+                return self._stream_file(open(os.path.join(self.cache_folder, digest), 'rb'),
+                                         wfile)
+            f = open(fill.temp_path, 'rb')
+        sent = 0
+        try:
+            while True:
+                with fill.cond:
+                    while sent == fill.written and not fill.done:
+                        fill.cond.wait(1)
+                    available = fill.written - sent
+                    error = fill.error
+                if error:
+                    raise IOError(error)
+                if available == 0:
+                    break
+                while available:
+                    data = f.read(min(available, self.grabchunk))
+                    wfile.write(data)
+                    sent += len(data)
+                    available -= len(data)
+        finally:
+            f.close()
+            self._count('bytes_served', sent)
+
+    def _stream_file(self, f, wfile):
+        with f:
+            shutil.copyfileobj(f, wfile, self.grabchunk)
+            self._count('bytes_served', f.tell())
+
+    def _stream_range(self, f, first, last, wfile):
+        with f:
+            f.seek(first)
+            remaining = last - first + 1
+            while remaining:
+                data = f.read(min(remaining, self.grabchunk))
+                if not data:
+                    break
+                wfile.write(data)
+                remaining -= len(data)
+        self._count('bytes_served', last - first + 1 - remaining)
+
+    def handle_chunks(self, request, digest):
+        """Send the chunk list of a blob, or 404 if it is not available
+        yet, in which case the client fetches the whole blob and the list
+        is computed for later clients."""
+        try:
+            with open(self.chunk_list_path(digest)) as f:
+                data = f.read()
+        except IOError:
+            self._want_chunk_list(digest)
+            request.send_error(404)
+            return
+        request.send_response(200)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(data)))
+        request.end_headers()
+        request.wfile.write(data)
+
+    def handle(self, request, algorithm, digest, query):
+        path, fill = self.lookup(algorithm, digest, query)
+        match = re.match(r'^bytes=(\d+)-(\d*)$', request.headers.getheader('Range') or '')
+        if path and match:
+            try:
+                f = open(path, 'rb')
+            except IOError:
+                # evicted since lookup()
+                request.send_error(404)
+                return
+            size = os.fstat(f.fileno()).st_size
+            first = int(match.group(1))
+            last = min(int(match.group(2) or size - 1), size - 1)
+            if first > last:
+                f.close()
+                request.send_error(416)
+                return
+            request.send_response(206)
+            request.send_header('Content-Type', 'application/octet-stream')
+            request.send_header('Content-Range', 'bytes %d-%d/%d' % (first, last, size))
+            request.send_header('Content-Length', str(last - first + 1))
+            request.end_headers()
+            try:
+                self._stream_range(f, first, last, request.wfile)
+            except (IOError, socket.error) as e:
+                log.info("proxy: stopped sending %s: %s" % (digest, e))
+            return
+        if fill:
+            with fill.cond:
+                while not fill.started:
+                    fill.cond.wait(1)
+                if fill.error:
+                    request.send_error(404, fill.error)
+                    return
+                length = fill.length
+        else:
+            # the blob may have been evicted since lookup(), the open
+            # file is streamed even if it is evicted later.
+            try:
+                f = open(path, 'rb')
+            except IOError:
+                request.send_error(404)
+                return
+            length = os.fstat(f.fileno()).st_size
+        request.send_response(200)
+        request.send_header('Content-Type', 'application/octet-stream')
+        if length is not None:
+            request.send_header('Content-Length', str(length))
+        request.end_headers()
+        try:
+            if fill:
+                self._stream_fill(fill, digest, request.wfile)
+            else:
+                self._stream_file(f, request.wfile)
+        except (IOError, socket.error) as e:
+            log.info("proxy: stopped sending %s: %s" % (digest, e))
+
+
+class _ProxyRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        parts = [part for part in path.split('/') if part]
+        if len(parts) < 2 or parts[-2] not in hashlib.algorithms or \
+           not re.match('^[0-9a-f]+(\\.chunks)?$', parts[-1]):
+            self.send_error(404)
+            return
+        if parts[-1].endswith('.chunks'):
+            self.server.proxy.handle_chunks(self, parts[-1][:-len('.chunks')])
+        else:
+            self.server.proxy.handle(self, parts[-2], parts[-1], query)
+
+    def log_message(self, format, *args):
+        log.debug("proxy: %s %s" % (self.address_string(), format % args))
+
+
+class _ProxyServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def serve_proxy(listen, cache_folder, base_urls, cache_size):
+    """Run a caching proxy for base_urls on listen, host:port, until
+    interrupted. Clients list it as their first --url. Since clients are
+    not authenticated, only public blobs are fetched."""
+    host, _, port = listen.rpartition(':')
+    proxy = TooltoolProxy(cache_folder, base_urls, int(cache_size * 1024 * 1024 * 1024))
+    server = _ProxyServer((host or '127.0.0.1', int(port)), _ProxyRequestHandler)
+    server.proxy = proxy
+    log.info("proxy: serving %s from %s on %s" % (', '.join(base_urls), cache_folder, listen))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        log.info("proxy: %s" % ', '.join('%s %d' % item for item in sorted(proxy.stats.items())))
+    return True
 
 
 def _log_api_error(e):
@@ -778,7 +2226,7 @@ def _send_batch(base_url, auth_file, batch, region):
     return json.load(resp)['result']
 
 
-def _s3_upload(filename, file):
+def _s3_upload(filename, file, throttle=None):
     # urllib2 does not support streaming, so we fall back to good old httplib
     url = urlparse.urlparse(file['put_url'])
     cls = httplib.HTTPSConnection if url.scheme == 'https' else httplib.HTTPConnection
@@ -787,7 +2235,10 @@ def _s3_upload(filename, file):
     conn = cls(host, port)
     try:
         req_path = "%s?%s" % (url.path, url.query) if url.query else url.path
-        conn.request('PUT', req_path, open(filename, "rb"),
+        body = open(filename, "rb")
+        if throttle:
+            body = ThrottledReader(body, throttle, throttle.priority(os.path.getsize(filename)))
+        conn.request('PUT', req_path, body,
                      {'Content-type': 'application/octet-stream'})
         resp = conn.getresponse()
         resp_body = resp.read()
@@ -824,7 +2275,7 @@ def _notify_upload_complete(base_url, auth_file, file):
         log.exception("While notifying server of upload completion:")
 
 
-def upload(manifest, message, base_urls, auth_file, region):
+def upload(manifest, message, base_urls, auth_file, region, throttle=None):
     try:
         manifest = open_manifest(manifest)
     except InvalidManifest:
@@ -865,7 +2316,7 @@ def upload(manifest, message, base_urls, auth_file, region):
         if 'put_url' in file:
             log.info("%s: starting upload" % (filename,))
             thd = threading.Thread(target=_s3_upload,
-                                   args=(filename, file))
+                                   args=(filename, file, throttle))
             thd.daemon = 1
             thd.start()
             threads[filename] = thd
@@ -888,6 +2339,9 @@ def upload(manifest, message, base_urls, auth_file, region):
                     success = False
                 del threads[filename]
 
+    if throttle:
+        log.info("transfer stats: %s" % throttle.summary())
+
     # notify the server that the uploads are completed.  If the notification
     # fails, we don't consider that an error (the server will notice
     # eventually)
@@ -899,6 +2353,135 @@ def upload(manifest, message, base_urls, auth_file, region):
     return success
 
 
+class _JobLogHandler(logging.Handler):
+    """Sends the log records of a job to the client of the daemon."""
+
+    def __init__(self, send):
+        logging.Handler.__init__(self)
+        self.send = send
+        self.setFormatter(logging.Formatter("%(levelname)s - %(message)s"))
+
+    def emit(self, record):
+        try:
+            self.send({'stderr': self.format(record) + '\n'})
+        except Exception:
+            self.handleError(record)
+
+
+class _JobOutput(object):
+    """Sends what a job prints to the client of the daemon."""
+
+    def __init__(self, send):
+        self.send = send
+
+    def write(self, data):
+        self.send({'stdout': data})
+
+    def flush(self):
+        pass
+
+
+class _ServeHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        request = json.loads(self.rfile.readline())
+
+        def send(message):
+            self.wfile.write(json.dumps(message) + '\n')
+            self.wfile.flush()
+
+        # jobs depend on the working directory, so they run one at a time.
+        with self.server.job_lock:
+            rc = run_job(request, send)
+        try:
+            send({'exit': rc})
+        except socket.error:
+            pass
+
+
+class _ServeServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+def run_job(request, send):
+    """Run the command line in request, a dict of argv, cwd and the
+    TOOLTOOL_ environment variables of the client, as main() would."""
+    handler = _JobLogHandler(send)
+    saved_cwd = os.getcwd()
+    saved_env = dict((k, v) for k, v in os.environ.items() if k.startswith('TOOLTOOL_'))
+    saved_stdout = sys.stdout
+    log.addHandler(handler)
+    try:
+        for k in saved_env:
+            del os.environ[k]
+        os.environ.update(request.get('env', {}))
+        os.chdir(request['cwd'])
+        sys.stdout = _JobOutput(send)
+        return main(request['argv'], _skip_logging=True, _serving=True)
+    except SystemExit as e:
+        return e.code
+    except Exception:
+        log.exception("job %s failed:" % request['argv'])
+        return 1
+    finally:
+        sys.stdout = saved_stdout
+        log.removeHandler(handler)
+        os.chdir(saved_cwd)
+        for k in [k for k in os.environ if k.startswith('TOOLTOOL_')]:
+            del os.environ[k]
+        os.environ.update(saved_env)
+
+
+def serve(socket_path):
+    """Run the commands in SERVE_COMMANDS for clients connecting to
+    socket_path until interrupted. Connection state, the digest memo and
+    mirror health are kept between the jobs, as well as the hot tier of
+    the cache when it is kept in memory."""
+    global _daemon
+    _daemon = True
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = _ServeServer(socket_path, _ServeHandler)
+    server.job_lock = threading.Lock()
+    log.info("serving on %s" % socket_path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+    return True
+
+
+def run_client(socket_path, argv):
+    """Run argv in the daemon listening on socket_path and return its
+    exit code, or None if the daemon is not available."""
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+    except socket.error as e:
+        log.debug("tooltool daemon %s is not available: %s" % (socket_path, e))
+        return None
+    f = client.makefile('rwb')
+    f.write(json.dumps({
+        'argv': argv,
+        'cwd': os.getcwd(),
+        'env': dict((k, v) for k, v in os.environ.items() if k.startswith('TOOLTOOL_')),
+    }) + '\n')
+    f.flush()
+    for line in f:
+        message = json.loads(line)
+        if 'exit' in message:
+            return message['exit']
+        for name, stream in (('stdout', sys.stdout), ('stderr', sys.stderr)):
+            if name in message:
+                stream.write(message[name].encode('utf-8'))
+                stream.flush()
+    log.error("tooltool daemon %s closed the connection" % socket_path)
+    return 1
+
+
 def process_command(options, args):
     """ I know how to take a list of program arguments and
     start doing the right thing with them"""
@@ -915,13 +2498,31 @@ def process_command(options, args):
     elif cmd == 'add':
         return add_files(options['manifest'], options['algorithm'], cmd_args,
                          options['version'], options['visibility'],
-                         options['unpack'])
+                         options['unpack'], options['include'], options['exclude'])
     elif cmd == 'purge':
         if options['cache_folder']:
             purge(folder=options['cache_folder'], gigs=options['size'])
         else:
             log.critical('please specify the cache folder to be purged')
             return False
+    elif cmd == 'fetch' and options['background']:
+        return fetch_background(
+            options['manifest'],
+            options['base_url'],
+            options['critical'] or [],
+            cmd_args,
+            cache_folder=options['cache_folder'],
+            auth_file=options.get("auth_file"),
+            region=options.get('region'),
+            throttle=make_throttle(options),
+            reserve=int(options['min_free_space'] * 1024 * 1024),
+            hot_cache=make_hot_cache(options),
+            chunk_store=make_chunk_store(options))
+    elif cmd == 'wait':
+        if not cmd_args:
+            log.critical('wait command requires the files to wait for')
+            return False
+        return wait_files(cmd_args, options['wait_timeout'])
     elif cmd == 'fetch':
         return fetch_files(
             options['manifest'],
@@ -929,7 +2530,27 @@ def process_command(options, args):
             cmd_args,
             cache_folder=options['cache_folder'],
             auth_file=options.get("auth_file"),
-            region=options.get('region'))
+            region=options.get('region'),
+            throttle=make_throttle(options),
+            reserve=int(options['min_free_space'] * 1024 * 1024),
+            hot_cache=make_hot_cache(options),
+            chunk_store=make_chunk_store(options))
+    elif cmd == 'serve':
+        if not options['socket']:
+            log.critical('serve command requires --socket')
+            return False
+        return serve(options['socket'])
+    elif cmd == 'proxy':
+        if not options['cache_folder']:
+            log.critical('proxy command requires a cache folder')
+            return False
+        if options.get('auth_file'):
+            # anyone reaching the proxy could read the internal blobs
+            # fetched with it.
+            log.critical('proxy command does not support --authentication-file')
+            return False
+        return serve_proxy(options['listen'], options['cache_folder'], options['base_url'],
+                           options['cache_size'])
     elif cmd == 'upload':
         if not options.get('message'):
             log.critical('upload command requires a message')
@@ -939,13 +2560,14 @@ def process_command(options, args):
             options.get('message'),
             options.get('base_url'),
             options.get('auth_file'),
-            options.get('region'))
+            options.get('region'),
+            throttle=make_throttle(options))
     else:
         log.critical('command "%s" is not implemented' % cmd)
         return False
 
 
-def main(argv, _skip_logging=False):
+def main(argv, _skip_logging=False, _serving=False):
     # Set up option parsing
     parser = optparse.OptionParser()
     parser.add_option('-q', '--quiet', default=logging.INFO,
@@ -968,6 +2590,12 @@ def main(argv, _skip_logging=False):
                       dest='unpack', action='store_true',
                       help='Request unpacking this file after fetch.'
                            ' This is helpful with tarballs.')
+    parser.add_option('--include', dest='include', action='append',
+                      help='Only unpack the archive members matching this pattern; '
+                           'may be repeated.')
+    parser.add_option('--exclude', dest='exclude', action='append',
+                      help='Do not unpack the archive members matching this pattern; '
+                           'may be repeated.')
     parser.add_option('--version', default=None,
                       dest='version', action='store',
                       help='Version string for this file. This annotates the '
@@ -984,6 +2612,63 @@ def main(argv, _skip_logging=False):
     parser.add_option('-s', '--size',
                       help='free space required (in GB)', dest='size',
                       type='float', default=0.)
+    parser.add_option('--listen', default='127.0.0.1:8081',
+                      help='host:port the proxy command listens on')
+    parser.add_option('--cache-size', dest='cache_size', type='float', default=20.,
+                      help='size in GB the proxy command keeps its cache folder within')
+    parser.add_option('--max-rate', dest='max_rate', type='float',
+                      help='limit fetches and uploads of this process to this many MB/s; '
+                           'defaults to $TOOLTOOL_MAX_RATE')
+    parser.add_option('--host-max-rate', dest='host_max_rate', type='float',
+                      help='limit fetches and uploads of all processes using '
+                           '--host-rate-file to this many MB/s; defaults to '
+                           '$TOOLTOOL_HOST_MAX_RATE')
+    parser.add_option('--host-rate-file', dest='host_rate_file',
+                      help='file shared by the processes of a host to coordinate '
+                           '--host-max-rate; defaults to $TOOLTOOL_HOST_RATE_FILE')
+    parser.add_option('--small-file-size', dest='small_file_size', type='float', default=16.,
+                      help='rate limited files up to this many MB are transferred '
+                           'before larger ones')
+    parser.add_option('--background', default=False, action='store_true',
+                      help='fetch: return once the --critical files are ready and '
+                           'fetch the others in the background; see the wait command')
+    parser.add_option('--critical', dest='critical', action='append',
+                      help='fetch: file which is needed before the fetch command '
+                           'returns with --background; may be repeated')
+    parser.add_option('--wait-timeout', dest='wait_timeout', type='float', default=0,
+                      help='wait: seconds to wait for the files, 0 waits forever')
+    parser.add_option('--socket', default=os.environ.get('TOOLTOOL_SOCKET'),
+                      help='unix socket of the daemon started with the serve command; '
+                           'the %s commands are run by the daemon if it is listening. '
+                           'Defaults to $TOOLTOOL_SOCKET' % ', '.join(SERVE_COMMANDS))
+    parser.add_option('--min-free-space', dest='min_free_space', type='float', default=256.,
+                      help='fetch: MB which must remain free after the fetch; the '
+                           'cache folder is purged or the fetch fails before '
+                           'downloading otherwise')
+    parser.add_option('--profile', choices=('cprofile', 'sample'),
+                      default=os.environ.get('BITBAR_PROFILE') or None,
+                      help='profile the command with cprofile or by sampling stacks, see '
+                           'profiling.py. Defaults to $BITBAR_PROFILE')
+    parser.add_option('--profile-dir', dest='profile_dir',
+                      default=os.environ.get('BITBAR_PROFILE_DIR'),
+                      help='directory the profile is written to. Defaults to '
+                           '$BITBAR_PROFILE_DIR')
+    parser.add_option('--chunk-store', dest='chunk_store', action='store_true',
+                      default=bool(os.environ.get('TOOLTOOL_CHUNK_STORE')),
+                      help='fetch: keep the files of the cache folder as deduplicated '
+                           'chunks, and only download the chunks which are missing from '
+                           'servers which provide chunk lists. Defaults to '
+                           '$TOOLTOOL_CHUNK_STORE')
+    parser.add_option('--hot-cache-folder', dest='hot_cache_folder',
+                      default=os.environ.get('TOOLTOOL_HOT_CACHE_FOLDER'),
+                      help='fetch: folder, preferably on tmpfs, holding the most used small '
+                           'files of the cache; the serve daemon keeps them in memory if '
+                           'unset. Defaults to $TOOLTOOL_HOT_CACHE_FOLDER')
+    parser.add_option('--hot-cache-size', dest='hot_cache_size', type='float', default=256.,
+                      help='fetch: MB of the hot cache tier, 0 disables it')
+    parser.add_option('--hot-max-file-size', dest='hot_max_file_size', type='float',
+                      default=4., help='fetch: MB above which files are not put in '
+                                       'the hot cache tier')
     parser.add_option('-r', '--region', help='Preferred AWS region for upload or fetch; '
                       'example: --region=us-west-2')
     parser.add_option('--message',
@@ -1028,6 +2713,31 @@ def main(argv, _skip_logging=False):
     if len(args) < 1:
         parser.error('You must specify a command')
 
+    if _serving and args[0] not in SERVE_COMMANDS:
+        # other commands, e.g. serve or proxy, would hold the daemon's
+        # job lock for as long as they run.
+        log.error("the tooltool daemon only runs %s, not %s" % (', '.join(SERVE_COMMANDS), args[0]))
+        return 1
+
+    if args[0] in SERVE_COMMANDS and options['socket'] and not _serving:
+        rc = run_client(options['socket'], argv)
+        if rc is not None:
+            return rc
+
+    if options['profile'] and not _serving:
+        # profiling.py is next to this script in the image, or in
+        # ../taskcluster in a checkout.
+        sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                     '..', 'taskcluster'))
+        try:
+            import profiling
+        except ImportError:
+            log.error('--profile requires profiling.py, running without profiling')
+        else:
+            return profiling.run('tooltool-%s' % args[0],
+                                 lambda: 0 if process_command(options, args) else 1,
+                                 mode=options['profile'], directory=options['profile_dir'])
+
     return 0 if process_command(options, args) else 1
 
 if __name__ == "__main__":  # pragma: no cover
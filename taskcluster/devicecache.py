@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Content addressed cache of files pushed to the device.
+
+Files are stored on the device in CACHE_DIR named by their sha512
+digest. CACHE_DIR is not removed by the cleanup performed by script.py
+before each task, so identical payloads pushed by later tasks are
+copied on the device instead of being transferred over adb again.
+
+Test harnesses find this script through the BITBAR_DEVICE_CACHE
+environment variable set by script.py:
+
+    $BITBAR_DEVICE_CACHE push <local path> <device path>
+
+Entries are evicted least recently used first whenever the free space
+on the device would otherwise fall below the reserve.
+
+"""
+
+import argparse
+import hashlib
+import os
+import posixpath
+import shlex
+import sys
+
+from mozdevice import ADBDevice, ADBError, ADBTimeoutError
+
+CACHE_DIR = '/sdcard/bitbar-cache'
+# free space in bytes to leave on the device after adding an entry.
+DEFAULT_RESERVE = 1024 * 1024 * 1024
+ADB_COMMAND_TIMEOUT = 10
+# conservative rate in bytes per second of copies on the device's
+# storage, used to derive the timeout of copying an entry.
+DEVICE_COPY_RATE = 5 * 1024 * 1024
+
+
+def digest_file(path, algorithm='sha512', chunk_size=1024 * 1024):
+    h = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        data = f.read(chunk_size)
+        while data:
+            h.update(data)
+            data = f.read(chunk_size)
+    return h.hexdigest()
+
+
+def device_free_space(device, path=CACHE_DIR):
+    """Return the number of bytes available to the shell user on the
+    filesystem containing path."""
+    output = device.shell_output('stat -f -c "%a %S" {}'.format(path),
+                                 timeout=ADB_COMMAND_TIMEOUT)
+    available, block_size = output.split()
+    return int(available) * int(block_size)
+
+
+def list_entries(device):
+    """Return a list of (mtime, size, path) for the cache entries sorted
+    from least to most recently used."""
+    output = device.shell_output(
+        'stat -c "%Y %s %n" {}/* 2>/dev/null'.format(CACHE_DIR),
+        timeout=ADB_COMMAND_TIMEOUT)
+    entries = []
+    for line in output.splitlines():
+        fields = line.split(None, 2)
+        if len(fields) != 3 or not fields[0].isdigit():
+            continue
+        entries.append((int(fields[0]), int(fields[1]), fields[2]))
+    return sorted(entries)
+
+
+def evict(device, needed=0, reserve=DEFAULT_RESERVE):
+    """Remove least recently used entries until at least needed +
+    reserve bytes are free on the device. Return the number of bytes
+    removed."""
+    device.mkdir(CACHE_DIR, parents=True, timeout=ADB_COMMAND_TIMEOUT)
+    free = device_free_space(device)
+    removed = 0
+    if free >= needed + reserve:
+        return removed
+    for _, size, path in list_entries(device):
+        print('devicecache: evicting {} ({} bytes)'.format(posixpath.basename(path), size))
+        device.rm(path, force=True, timeout=ADB_COMMAND_TIMEOUT)
+        removed += size
+        free += size
+        if free >= needed + reserve:
+            break
+    return removed
+
+
+def copy_timeout(size):
+    """Return the timeout of copying size bytes on the device."""
+    return ADB_COMMAND_TIMEOUT + size // DEVICE_COPY_RATE
+
+
+def _shell(device, cmd, timeout):
+    """Run cmd on the device, raising ADBError if it fails."""
+    if not device.shell_bool(cmd, timeout=timeout):
+        raise ADBError('{} failed'.format(cmd))
+
+
+def push(device, local, remote, reserve=DEFAULT_RESERVE):
+    """Copy local to remote on the device, pushing it into the cache
+    first if its content is not already cached. Return True if the file
+    was served from the cache."""
+    digest = digest_file(local)
+    size = os.path.getsize(local)
+    entry = posixpath.join(CACHE_DIR, digest)
+    hit = device.exists(entry, timeout=ADB_COMMAND_TIMEOUT)
+    if hit:
+        _shell(device, 'touch {}'.format(shlex.quote(entry)), ADB_COMMAND_TIMEOUT)
+    else:
+        evict(device, needed=size, reserve=reserve)
+        partial = entry + '.partial'
+        device.push(local, partial)
+        try:
+            _shell(device, 'mv {} {}'.format(shlex.quote(partial), shlex.quote(entry)),
+                   ADB_COMMAND_TIMEOUT)
+        except ADBError:
+            device.rm(partial, force=True, timeout=ADB_COMMAND_TIMEOUT)
+            raise
+    parent = posixpath.dirname(remote)
+    if parent:
+        device.mkdir(parent, parents=True, timeout=ADB_COMMAND_TIMEOUT)
+    _shell(device, 'cp {} {}'.format(shlex.quote(entry), shlex.quote(remote)),
+           copy_timeout(size))
+    print('devicecache: {} {} -> {}'.format('hit' if hit else 'miss', local, remote))
+    return hit
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Push files to the device through a '
+                                                 'content addressed cache on the device.')
+    parser.add_argument('--serial', default=os.environ.get('DEVICE_SERIAL'),
+                        help='device serial, defaults to $DEVICE_SERIAL')
+    parser.add_argument('--reserve-mb', type=int,
+                        default=int(os.environ.get('BITBAR_DEVICE_CACHE_RESERVE_MB',
+                                                   DEFAULT_RESERVE // (1024 * 1024))),
+                        help='free space in MB to leave on the device')
+    subparsers = parser.add_subparsers(dest='command')
+    push_parser = subparsers.add_parser('push', help='push a file through the cache')
+    push_parser.add_argument('local')
+    push_parser.add_argument('remote')
+    subparsers.add_parser('evict', help='evict entries until the reserve is free')
+    subparsers.add_parser('clear', help='remove all cache entries')
+    args = parser.parse_args()
+    if not args.command:
+        parser.error('a command is required')
+    reserve = args.reserve_mb * 1024 * 1024
+
+    try:
+        device = ADBDevice(device=args.serial)
+        if args.command == 'push':
+            push(device, args.local, args.remote, reserve=reserve)
+        elif args.command == 'evict':
+            evict(device, reserve=reserve)
+        elif args.command == 'clear':
+            device.rm(CACHE_DIR, recursive=True, force=True, timeout=ADB_COMMAND_TIMEOUT)
+    except (ADBError, ADBTimeoutError) as e:
+        print('devicecache: {}: {}'.format(e.__class__.__name__, e))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,254 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Host diagnostics collected in-process.
+
+collect() gathers filesystem usage, sockets and the tails of the adb
+server logs concurrently under a deadline, writes everything to a json
+artifact and prints a compact summary to the task log.
+
+"""
+
+import json
+import os
+import socket
+import struct
+import threading
+import time
+from glob import glob
+
+DEFAULT_DEADLINE = 5
+ADB_LOG_TAIL_BYTES = 16 * 1024
+ADB_LOG_SUMMARY_LINES = 10
+PSEUDO_FILESYSTEMS = frozenset([
+    'autofs', 'binfmt_misc', 'cgroup', 'cgroup2', 'configfs', 'debugfs',
+    'devpts', 'fusectl', 'hugetlbfs', 'mqueue', 'nsfs', 'proc', 'pstore',
+    'securityfs', 'sysfs', 'tracefs',
+])
+TCP_STATES = {
+    '01': 'ESTABLISHED', '02': 'SYN_SENT', '03': 'SYN_RECV',
+    '04': 'FIN_WAIT1', '05': 'FIN_WAIT2', '06': 'TIME_WAIT', '07': 'CLOSE',
+    '08': 'CLOSE_WAIT', '09': 'LAST_ACK', '0A': 'LISTEN', '0B': 'CLOSING',
+}
+
+
+def human_size(n):
+    for unit in ('B', 'K', 'M', 'G', 'T'):
+        if abs(n) < 1024 or unit == 'T':
+            break
+        n /= 1024.0
+    return '{:.1f}{}'.format(n, unit) if unit != 'B' else '{}B'.format(n)
+
+
+def collect_disk():
+    """Return the usage of each mounted filesystem, equivalent to df."""
+    disks = []
+    seen = set()
+    with open('/proc/self/mounts') as mounts:
+        for line in mounts:
+            fields = line.split()
+            if len(fields) < 3:
+                continue
+            device, mount, fstype = fields[0], fields[1].replace('\\040', ' '), fields[2]
+            if fstype in PSEUDO_FILESYSTEMS or mount in seen:
+                continue
+            seen.add(mount)
+            try:
+                st = os.statvfs(mount)
+            except OSError:
+                continue
+            size = st.f_frsize * st.f_blocks
+            if not size:
+                continue
+            avail = st.f_frsize * st.f_bavail
+            used = size - st.f_frsize * st.f_bfree
+            disks.append({
+                'filesystem': device,
+                'mount': mount,
+                'type': fstype,
+                'size': size,
+                'used': used,
+                'available': avail,
+                'percent': int(round(100.0 * used / (used + avail))) if used + avail else 0,
+            })
+    return disks
+
+
+def _socket_owners():
+    """Map socket inodes to 'pid/program' like netstat -p."""
+    owners = {}
+    for fd_dir in glob('/proc/[0-9]*/fd'):
+        pid = fd_dir.split('/')[2]
+        try:
+            with open('/proc/{}/comm'.format(pid)) as comm:
+                program = comm.read().strip()
+            fds = os.listdir(fd_dir)
+        except (IOError, OSError):
+            continue
+        for fd in fds:
+            try:
+                target = os.readlink(os.path.join(fd_dir, fd))
+            except OSError:
+                continue
+            if target.startswith('socket:['):
+                owners[target[8:-1]] = '{}/{}'.format(pid, program)
+    return owners
+
+
+def _decode_address(address, family):
+    host, port = address.split(':')
+    raw = bytes.fromhex(host)
+    if family == socket.AF_INET:
+        raw = struct.pack('<I', struct.unpack('>I', raw)[0])
+    else:
+        raw = b''.join(struct.pack('<I', struct.unpack('>I', raw[i:i + 4])[0])
+                       for i in range(0, 16, 4))
+    return '{}:{}'.format(socket.inet_ntop(family, raw), int(port, 16))
+
+
+def collect_sockets():
+    """Return the tcp and udp sockets from /proc/net, equivalent to
+    netstat -aop for inet sockets."""
+    owners = _socket_owners()
+    sockets = []
+    for proto, family in (('tcp', socket.AF_INET), ('tcp6', socket.AF_INET6),
+                          ('udp', socket.AF_INET), ('udp6', socket.AF_INET6)):
+        try:
+            with open('/proc/net/{}'.format(proto)) as table:
+                lines = table.readlines()[1:]
+        except IOError:
+            continue
+        for line in lines:
+            fields = line.split()
+            if len(fields) < 10:
+                continue
+            state = TCP_STATES.get(fields[3], fields[3]) if proto.startswith('tcp') else ''
+            sockets.append({
+                'proto': proto,
+                'local': _decode_address(fields[1], family),
+                'remote': _decode_address(fields[2], family),
+                'state': state,
+                'owner': owners.get(fields[9], ''),
+            })
+    return sockets
+
+
+def collect_adb_logs(tail_bytes=ADB_LOG_TAIL_BYTES):
+    """Return the size and the last tail_bytes of each adb server log."""
+    logs = []
+    for path in sorted(glob('/tmp/adb.*.log')):
+        try:
+            with open(path, 'rb') as log:
+                log.seek(0, os.SEEK_END)
+                size = log.tell()
+                log.seek(max(0, size - tail_bytes))
+                tail = log.read().decode('utf-8', 'replace')
+        except (IOError, OSError) as e:
+            logs.append({'path': path, 'error': str(e)})
+            continue
+        if size > tail_bytes:
+            # drop the partial first line.
+            tail = tail.split('\n', 1)[-1]
+        logs.append({'path': path, 'size': size, 'tail': tail})
+    return logs
+
+
+COLLECTORS = (
+    ('disk', collect_disk),
+    ('sockets', collect_sockets),
+    ('adb_logs', collect_adb_logs),
+)
+
+
+def _run_collectors(collectors, deadline):
+    results = {}
+    errors = {}
+    lock = threading.Lock()
+    # collectors which overrun the deadline keep running in the
+    # background, their results are dropped once we have returned.
+    finished = []
+
+    def run(name, collector):
+        try:
+            result = collector()
+            error = None
+        except Exception as e:
+            error = '{}: {}'.format(e.__class__.__name__, e)
+        with lock:
+            if finished:
+                return
+            if error is None:
+                results[name] = result
+            else:
+                errors[name] = error
+
+    threads = []
+    for name, collector in collectors:
+        thread = threading.Thread(target=run, args=(name, collector),
+                                  name='diagnostics-{}'.format(name))
+        thread.daemon = True
+        thread.start()
+        threads.append((name, thread))
+    end = time.time() + deadline
+    for name, thread in threads:
+        thread.join(max(0, end - time.time()))
+    with lock:
+        finished.append(True)
+        for name, thread in threads:
+            if name not in results and name not in errors:
+                errors[name] = 'exceeded deadline of {}s'.format(deadline)
+        return dict(results), dict(errors)
+
+
+def format_summary(label, data):
+    lines = ['diagnostics ({}) collected in {:.2f}s'.format(label, data['elapsed'])]
+    for disk in data.get('disk', []):
+        lines.append('  disk {}: {}% used, {} of {} available'.format(
+            disk['mount'], disk['percent'], human_size(disk['available']),
+            human_size(disk['size'])))
+    sockets = data.get('sockets')
+    if sockets is not None:
+        states = {}
+        for s in sockets:
+            if s['state']:
+                states[s['state']] = states.get(s['state'], 0) + 1
+        lines.append('  sockets: {} ({})'.format(
+            len(sockets), ', '.join('{} {}'.format(k, v) for k, v in sorted(states.items()))))
+        for s in sockets:
+            if s['state'] == 'LISTEN':
+                lines.append('    listening {} {} {}'.format(s['proto'], s['local'], s['owner']))
+    for log in data.get('adb_logs', []):
+        if 'error' in log:
+            lines.append('  adb log {}: {}'.format(log['path'], log['error']))
+            continue
+        lines.append('  adb log {}: {}'.format(log['path'], human_size(log['size'])))
+        for line in log['tail'].rstrip('\n').split('\n')[-ADB_LOG_SUMMARY_LINES:]:
+            lines.append('    {}'.format(line))
+    for name, error in sorted(data['errors'].items()):
+        lines.append('  {}: {}'.format(name, error))
+    return '\n'.join(lines)
+
+
+def collect(label, artifacts_dir=None, deadline=DEFAULT_DEADLINE, collectors=COLLECTORS):
+    """Run the collectors concurrently, waiting at most deadline seconds,
+    write the results to diagnostics-<label>.json in artifacts_dir and
+    print a summary. Return the collected data."""
+    start = time.time()
+    results, errors = _run_collectors(collectors, deadline)
+    data = dict(results)
+    data['label'] = label
+    data['time'] = start
+    data['elapsed'] = time.time() - start
+    data['errors'] = errors
+    if artifacts_dir:
+        path = os.path.join(artifacts_dir, 'diagnostics-{}.json'.format(label))
+        try:
+            if not os.path.isdir(artifacts_dir):
+                os.makedirs(artifacts_dir)
+            with open(path, 'w') as artifact:
+                json.dump(data, artifact, indent=2)
+        except (IOError, OSError) as e:
+            print('{} writing {}'.format(e, path))
+    print('\n{}\n'.format(format_summary(label, data)))
+    return data
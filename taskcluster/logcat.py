@@ -0,0 +1,163 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import re
+import subprocess
+import threading
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+READ_SIZE = 64 * 1024
+RESTART_DELAY = 5
+# threadtime format lines begin with 'MM-DD hh:mm:ss.mmm'
+TIMESTAMP_RE = re.compile(rb'^(\d\d-\d\d \d\d:\d\d:\d\d\.\d\d\d)')
+
+
+class _CompressedFile(object):
+    """Write-only compressed file using zstd if the zstandard package is
+    available or gzip otherwise. Each file is a complete stream which
+    can be decompressed on its own.
+
+    """
+    def __init__(self, path, level=3):
+        self.path = path
+        self.written = 0
+        self._fh = open(path, 'wb')
+        if zstandard:
+            self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+        else:
+            # wbits 31 produces a gzip stream.
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def write(self, data):
+        data = self._compressor.compress(data)
+        if data:
+            self._fh.write(data)
+            self.written += len(data)
+
+    def close(self):
+        data = self._compressor.flush()
+        self._fh.write(data)
+        self.written += len(data)
+        self._fh.close()
+
+
+class LogcatCapture(object):
+    """Stream `adb logcat` for a device into a compressed file while the
+    test command is running.
+
+    The output is rotated once the compressed size of the current file
+    exceeds max_bytes, keeping at most `backups` older files, so the
+    total space used is bounded by max_bytes * (backups + 1). If adb
+    exits, for example because the device disconnected, logcat is
+    restarted from the timestamp of the last line received until stop()
+    is called.
+
+    """
+    def __init__(self, serial, path, max_bytes, backups=2, adb='adb'):
+        self.serial = serial
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.adb = adb
+        self.restarts = 0
+        self.bytes_read = 0
+        if zstandard:
+            self.path = path + '.zst'
+        else:
+            self.path = path + '.gz'
+        self._proc = None
+        self._file = None
+        self._last_timestamp = None
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='logcat')
+        self._thread.daemon = True
+
+    def start(self):
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self._file = _CompressedFile(self.path)
+        self._thread.start()
+        print('logcat: capturing {} to {}'.format(self.serial, self.path))
+
+    def stop(self, timeout=10):
+        """Stop capturing and complete the compressed stream. Only the
+        first call has any effect."""
+        with self._lock:
+            if self._stopping.is_set():
+                return
+            self._stopping.set()
+            if self._proc and self._proc.poll() is None:
+                self._proc.terminate()
+        self._thread.join(timeout)
+        with self._lock:
+            if self._proc and self._proc.poll() is None:
+                self._proc.kill()
+            if self._file:
+                self._file.close()
+                self._file = None
+        print('logcat: captured {} bytes from {} with {} restarts'.format(
+            self.bytes_read, self.serial, self.restarts))
+
+    def _command(self):
+        cmd = [self.adb, '-s', self.serial, 'logcat', '-v', 'threadtime']
+        if self._last_timestamp:
+            cmd.extend(['-T', self._last_timestamp])
+        else:
+            # skip history left in the ring buffer by earlier tasks.
+            cmd.extend(['-T', '1'])
+        return cmd
+
+    def _rotate(self):
+        self._file.close()
+        for i in range(self.backups - 1, 0, -1):
+            src = '{}.{}'.format(self.path, i)
+            if os.path.exists(src):
+                os.rename(src, '{}.{}'.format(self.path, i + 1))
+        if self.backups > 0:
+            os.rename(self.path, self.path + '.1')
+        self._file = _CompressedFile(self.path)
+
+    def _run(self):
+        while not self._stopping.is_set():
+            with self._lock:
+                try:
+                    self._proc = subprocess.Popen(self._command(),
+                                                  stdout=subprocess.PIPE,
+                                                  stderr=subprocess.DEVNULL,
+                                                  close_fds=True)
+                except OSError as e:
+                    print('logcat: {} starting adb logcat'.format(e))
+                    return
+            fd = self._proc.stdout.fileno()
+            while True:
+                data = os.read(fd, READ_SIZE)
+                if not data:
+                    break
+                self.bytes_read += len(data)
+                end = data.rfind(b'\n', 0, len(data) - 1)
+                match = TIMESTAMP_RE.match(data[end + 1:])
+                if match:
+                    self._last_timestamp = match.group(1).decode()
+                with self._lock:
+                    if not self._file:
+                        break
+                    self._file.write(data)
+                    if self._file.written > self.max_bytes:
+                        self._rotate()
+            if self._proc.poll() is None:
+                self._proc.terminate()
+            self._proc.wait()
+            self._proc.stdout.close()
+            if self._stopping.wait(RESTART_DELAY):
+                break
+            self.restarts += 1
+            print('logcat: adb logcat exited with {}, restarting'.format(
+                self._proc.returncode))
@@ -0,0 +1,119 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Cancellation of the test command and everything it started.
+
+The command is started in its own process group so that signals can be
+forwarded to the whole tree and processes left behind by the command,
+such as adb forwarders or web servers, can be cleaned up. Since
+generic-worker aborts a task by killing script.py's process group, a
+guardian process is placed in the command's group which kills the group
+as soon as script.py goes away.
+
+"""
+
+import os
+import signal
+import subprocess
+import sys
+import time
+
+GUARDIAN = (
+    'import os, signal, sys\n'
+    'signal.signal(signal.SIGTERM, signal.SIG_IGN)\n'
+    'signal.signal(signal.SIGINT, signal.SIG_IGN)\n'
+    'sys.stdin.buffer.read()\n'
+    'os.killpg(os.getpgid(0), signal.SIGKILL)\n'
+)
+
+
+class ProcessGroup(object):
+    """Signal, escalate and clean up the process group led by proc.
+
+    proc must have been started with preexec_fn=os.setpgrp.
+
+    """
+    def __init__(self, proc):
+        self.pgid = proc.pid
+        self.cancel_signal = None
+        self.cancel_time = None
+        self.killed = False
+        self.guardian = None
+        try:
+            self.guardian = subprocess.Popen([sys.executable, '-c', GUARDIAN],
+                                             stdin=subprocess.PIPE,
+                                             preexec_fn=lambda: os.setpgid(0, self.pgid),
+                                             close_fds=True)
+        except (OSError, subprocess.SubprocessError) as e:
+            print('{} starting process group guardian'.format(e))
+
+    def signal(self, signum):
+        try:
+            os.killpg(self.pgid, signum)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    def cancel(self, signum, reason):
+        """Send signum to the group. check() escalates to SIGKILL if the
+        group has not exited after the grace period."""
+        print('script.py: {}, sending {} to process group {}'.format(
+            reason, signal.Signals(signum).name, self.pgid))
+        if self.cancel_time is None:
+            self.cancel_signal = signum
+            self.cancel_time = time.time()
+        self.signal(signum)
+
+    def check(self, grace):
+        """Kill the group if it was cancelled more than grace seconds ago."""
+        if self.cancel_time is not None and not self.killed and \
+           time.time() - self.cancel_time > grace:
+            print('script.py: process group {} did not exit within {}s of {}, killing'.format(
+                self.pgid, grace, signal.Signals(self.cancel_signal).name))
+            self.signal(signal.SIGKILL)
+            self.killed = True
+
+    def members(self):
+        """Return {pid: command line} for the live processes in the
+        group, excluding the guardian."""
+        members = {}
+        for name in os.listdir('/proc'):
+            if not name.isdigit():
+                continue
+            try:
+                with open('/proc/{}/stat'.format(name)) as f:
+                    stat = f.read()
+                fields = stat[stat.rindex(')') + 2:].split()
+                if int(fields[2]) != self.pgid or fields[0] == 'Z':
+                    continue
+                with open('/proc/{}/cmdline'.format(name), 'rb') as f:
+                    cmdline = f.read().replace(b'\0', b' ').decode('utf-8', 'replace').strip()
+            except (IOError, OSError, ValueError, IndexError):
+                continue
+            if self.guardian and int(name) == self.guardian.pid:
+                continue
+            members[int(name)] = cmdline
+        return members
+
+    def cleanup(self, grace):
+        """Terminate any processes left in the group after the command
+        exited, killing them if they survive grace seconds, then release
+        the guardian."""
+        members = self.members()
+        if members:
+            print('script.py: terminating processes left behind by the command:')
+            for pid, cmdline in sorted(members.items()):
+                print('    {} {}'.format(pid, cmdline))
+            self.signal(signal.SIGTERM)
+            end = time.time() + grace
+            while members and time.time() < end:
+                time.sleep(0.1)
+                members = self.members()
+            if members:
+                print('script.py: killing {} remaining processes'.format(len(members)))
+                self.signal(signal.SIGKILL)
+        if self.guardian:
+            # closing stdin makes the guardian kill what is left of the
+            # group, including itself.
+            self.guardian.stdin.close()
+            self.guardian.wait()
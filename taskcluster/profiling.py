@@ -0,0 +1,184 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Opt-in profiling of the entry points of the image.
+
+entrypoint.py, run_gw.py, script.py and tooltool.py run their main
+function through run(). When BITBAR_PROFILE is unset, which is the
+default, run() only calls it. Otherwise the process is profiled and, at
+exit, the profile is written to BITBAR_PROFILE_DIR as
+<name>-<pid>.<extension> and the BITBAR_PROFILE_TOP functions taking the
+most time are printed.
+
+BITBAR_PROFILE is one of
+
+    cprofile  deterministic profile of the main thread with cProfile,
+              written as pstats, e.g. for snakeviz or python -m pstats.
+    sample    samples the stacks of every thread each
+              BITBAR_PROFILE_INTERVAL seconds, written as collapsed
+              stacks for flamegraph.pl or speedscope. Its overhead does
+              not depend on the number of calls, which suits the long
+              running run_gw.py.
+
+This module is shared by the python 3 scripts and tooltool.py, which
+runs on python 2.7.
+
+"""
+
+import collections
+import os
+import sys
+import threading
+import time
+
+MODES = ('cprofile', 'sample')
+DEFAULT_DIR = '/builds/worker/profiles'
+DEFAULT_TOP = 20
+DEFAULT_INTERVAL = 0.005
+
+# the profiler of this process while it is running, see stop().
+_active = []
+
+
+class CProfiler(object):
+    extension = 'pstats'
+
+    def __init__(self):
+        import cProfile
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def write(self, path):
+        self.profile.dump_stats(path)
+
+    def print_top(self, top):
+        import pstats
+        pstats.Stats(self.profile, stream=sys.stdout).sort_stats('cumulative').print_stats(top)
+
+
+class StackSampler(object):
+    extension = 'collapsed'
+
+    def __init__(self, interval=DEFAULT_INTERVAL):
+        self.interval = interval
+        self.samples = 0
+        self.stacks = collections.Counter()
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profile-sampler')
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        self._thread.join(self.interval * 10 + 1)
+
+    def _run(self):
+        own = threading.current_thread().ident
+        while not self._stopping.is_set():
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename),
+                                                 code.co_firstlineno))
+                    frame = frame.f_back
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+            self._stopping.wait(self.interval)
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write('%s %d\n' % (stack, count))
+
+    def print_top(self, top):
+        inclusive = collections.Counter()
+        exclusive = collections.Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(';')
+            exclusive[frames[-1]] += count
+            for name in set(frames):
+                inclusive[name] += count
+        total = float(sum(self.stacks.values())) or 1
+        print('%d samples every %gs of all threads, functions by samples on the stack:' % (
+            self.samples, self.interval))
+        print('%8s %8s  %s' % ('total%', 'self%', 'function'))
+        for name, count in inclusive.most_common(top):
+            print('%7.1f%% %7.1f%%  %s' % (100 * count / total, 100 * exclusive[name] / total,
+                                          name))
+
+
+class Session(object):
+    """A running profiler and where its output goes."""
+
+    def __init__(self, profiler, name, directory, top):
+        self.profiler = profiler
+        self.name = name
+        self.directory = directory
+        self.top = top
+        self.start_time = time.time()
+
+    def finish(self):
+        self.profiler.stop()
+        path = os.path.join(self.directory, '%s-%d.%s' % (self.name, os.getpid(),
+                                                          self.profiler.extension))
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            self.profiler.write(path)
+        except (IOError, OSError) as e:
+            print('%s writing profile %s' % (e, path))
+            path = None
+        print('\n%s: profile of %.1fs%s' % (self.name, time.time() - self.start_time,
+                                           ' written to %s' % path if path else ''))
+        self.profiler.print_top(self.top)
+        sys.stdout.flush()
+
+
+def start(name, mode=None, directory=None):
+    """Start profiling this process as name if mode, which defaults to
+    BITBAR_PROFILE, is set. Returns whether it was started."""
+    mode = mode or os.environ.get('BITBAR_PROFILE')
+    if not mode or _active:
+        return False
+    if mode not in MODES:
+        print('%s: unknown profile mode %s, expected one of %s' % (name, mode, ', '.join(MODES)))
+        return False
+    if mode == 'sample':
+        profiler = StackSampler(float(os.environ.get('BITBAR_PROFILE_INTERVAL',
+                                                     DEFAULT_INTERVAL)))
+    else:
+        profiler = CProfiler()
+    directory = directory or os.environ.get('BITBAR_PROFILE_DIR') or DEFAULT_DIR
+    top = int(os.environ.get('BITBAR_PROFILE_TOP', DEFAULT_TOP))
+    _active.append(Session(profiler, name, directory, top))
+    profiler.start()
+    return True
+
+
+def stop():
+    """Stop the profiler started by start(), if any, writing and
+    printing its results. Processes which exec must call it first."""
+    if _active:
+        _active.pop().finish()
+
+
+def run(name, func, *args, **kwargs):
+    """Return func(*args), profiled as name if BITBAR_PROFILE is set.
+    mode and directory override BITBAR_PROFILE and BITBAR_PROFILE_DIR."""
+    if not start(name, kwargs.get('mode'), kwargs.get('directory')):
+        return func(*args)
+    try:
+        return func(*args)
+    finally:
+        stop()
@@ -0,0 +1,192 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Resource accounting for the test command's process tree.
+
+The exit of the command is collected with wait4() which reports the
+rusage of the command and every descendant it waited for. Descendants
+which are never waited for, such as daemonized servers, are covered by
+ProcessTreeSampler which periodically reads /proc for every process in
+the tree.
+
+"""
+
+import json
+import os
+import threading
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+SAMPLE_INTERVAL = 1.0
+
+
+def poll_rusage(proc):
+    """Non-blocking equivalent of proc.poll() which also returns the
+    rusage of the process once it has exited, or None."""
+    if proc.returncode is not None:
+        return proc.returncode, None
+    try:
+        pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+    except ChildProcessError:
+        # reaped elsewhere, let Popen sort out the return code.
+        return proc.poll(), None
+    if pid == 0:
+        return None, None
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    return proc.returncode, rusage
+
+
+def _read_proc_stat(pid):
+    """Return (ppid, cpu seconds, rss bytes) for pid."""
+    with open('/proc/{}/stat'.format(pid)) as f:
+        stat = f.read()
+    # the command name may contain spaces, the fields after it do not.
+    fields = stat[stat.rindex(')') + 2:].split()
+    ppid = int(fields[1])
+    cpu = (int(fields[11]) + int(fields[12])) / float(CLOCK_TICKS)
+    rss = int(fields[21]) * PAGE_SIZE
+    return ppid, cpu, rss
+
+
+def _read_proc_io(pid):
+    """Return (read bytes, write bytes) of block I/O for pid."""
+    read_bytes = write_bytes = 0
+    with open('/proc/{}/io'.format(pid)) as f:
+        for line in f:
+            if line.startswith('read_bytes:'):
+                read_bytes = int(line.split()[1])
+            elif line.startswith('write_bytes:'):
+                write_bytes = int(line.split()[1])
+    return read_bytes, write_bytes
+
+
+class ProcessTreeSampler(object):
+    """Periodically sample the process tree rooted at pid.
+
+    Records the peak total rss and process count of the tree, and the
+    last cpu time and block I/O seen for every process which was ever
+    part of it, so that processes which exit between samples are only
+    undercounted by their activity since their last sample.
+
+    """
+    def __init__(self, pid, interval=SAMPLE_INTERVAL):
+        self.pid = pid
+        self.interval = interval
+        self.samples = 0
+        self.peak_rss = 0
+        self.peak_processes = 0
+        self._cpu = {}
+        self._io = {}
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='resource-sampler')
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        self._thread.join(self.interval * 2)
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self.sample()
+            self._stopping.wait(self.interval)
+
+    def sample(self):
+        stats = {}
+        for name in os.listdir('/proc'):
+            if not name.isdigit():
+                continue
+            try:
+                stats[int(name)] = _read_proc_stat(name)
+            except (IOError, OSError, ValueError, IndexError):
+                continue
+        children = {}
+        for pid, (ppid, _, _) in stats.items():
+            children.setdefault(ppid, []).append(pid)
+        tree = []
+        pending = [self.pid] if self.pid in stats else []
+        while pending:
+            pid = pending.pop()
+            tree.append(pid)
+            pending.extend(children.get(pid, []))
+        rss = 0
+        for pid in tree:
+            _, cpu, pid_rss = stats[pid]
+            rss += pid_rss
+            self._cpu[pid] = cpu
+            try:
+                self._io[pid] = _read_proc_io(pid)
+            except (IOError, OSError, ValueError):
+                pass
+        self.samples += 1
+        self.peak_rss = max(self.peak_rss, rss)
+        self.peak_processes = max(self.peak_processes, len(tree))
+
+    def results(self):
+        return {
+            'samples': self.samples,
+            'peak_rss_bytes': self.peak_rss,
+            'peak_processes': self.peak_processes,
+            'processes_seen': len(self._cpu),
+            'cpu_seconds': sum(self._cpu.values()),
+            'read_bytes': sum(r for r, _ in self._io.values()),
+            'write_bytes': sum(w for _, w in self._io.values()),
+        }
+
+
+def report(path, wall_time, rusage, sampler, output_bytes):
+    """Write the resource usage of the command to path as json and
+    print a one line summary."""
+    data = {
+        'wall_seconds': wall_time,
+        'output_bytes': output_bytes,
+        'sampled': sampler.results() if sampler else None,
+        'rusage': None,
+    }
+    if rusage:
+        data['rusage'] = {
+            'user_seconds': rusage.ru_utime,
+            'system_seconds': rusage.ru_stime,
+            # ru_maxrss is in kilobytes on linux.
+            'max_rss_bytes': rusage.ru_maxrss * 1024,
+            'block_input_ops': rusage.ru_inblock,
+            'block_output_ops': rusage.ru_oublock,
+            'voluntary_context_switches': rusage.ru_nvcsw,
+            'involuntary_context_switches': rusage.ru_nivcsw,
+        }
+    try:
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        with open(path, 'w') as f:
+            json.dump(data, f, indent=2)
+    except (IOError, OSError) as e:
+        print('{} writing {}'.format(e, path))
+
+    summary = ['wall {:.1f}s'.format(wall_time),
+               'output {:.1f}MB'.format(output_bytes / 1048576.0)]
+    if data['rusage']:
+        r = data['rusage']
+        summary.extend([
+            'user {:.1f}s'.format(r['user_seconds']),
+            'sys {:.1f}s'.format(r['system_seconds']),
+            'max rss {:.0f}MB'.format(r['max_rss_bytes'] / 1048576.0),
+            'block io {}/{} ops'.format(r['block_input_ops'], r['block_output_ops']),
+            'ctx switches {}/{}'.format(r['voluntary_context_switches'],
+                                        r['involuntary_context_switches']),
+        ])
+    if data['sampled']:
+        s = data['sampled']
+        summary.extend([
+            'tree cpu {:.1f}s'.format(s['cpu_seconds']),
+            'tree peak rss {:.0f}MB'.format(s['peak_rss_bytes'] / 1048576.0),
+            'tree peak processes {}'.format(s['peak_processes']),
+        ])
+    print('script.py: resource usage: {}'.format(', '.join(summary)))
+    return data
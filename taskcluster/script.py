@@ -9,17 +9,71 @@ import json
 import logging
 import os
 import queue
+import signal
 import subprocess
 import sys
 import threading
 import time
 from datetime import datetime
-from glob import glob
 
 from mozdevice import ADBDevice, ADBError, ADBHost, ADBTimeoutError
 
+import devicecache
+import diagnostics
+import profiling
+import resource_usage
+import taskenv
+from process_group import ProcessGroup
+from logcat import LogcatCapture
+
 MAX_NETWORK_ATTEMPTS = 3
 ADB_COMMAND_TIMEOUT = 10
+VERSION_FILE = '/builds/worker/version'
+SCRIPTVARS_FILE = '/builds/taskcluster/scriptvars.json'
+# see dump_slots() in entrypoint.py
+SLOTS_DIR = '/builds/slots'
+
+# (phase, seconds) for each phase of main() in the order they ran.
+PHASE_TIMES = []
+
+# Per-model limits used by wait_for_quiesce() before the test command
+# is started. load is the 1 minute load average, temperatures are in
+# degrees Celsius. cpu_zones lists the prefixes of the thermal zone
+# types which are considered to be cpu sensors on the model. A limit of
+# None is not checked.
+QUIESCE_THRESHOLDS = {
+    "Pixel 2": {
+        "load": 3.0,
+        "cpu_temp": 45.0,
+        "battery_temp": 35.0,
+        "cpu_zones": ("tsens_tz_sensor",),
+    },
+    "Moto G (5)": {
+        "load": 3.0,
+        "cpu_temp": 45.0,
+        "battery_temp": 35.0,
+        "cpu_zones": ("tsens_tz_sensor",),
+    },
+    "SM-G930F": {
+        "load": 3.0,
+        "cpu_temp": 45.0,
+        "battery_temp": 35.0,
+        "cpu_zones": ("MNGS", "APOLLO"),
+    },
+    "Android SDK built for x86": {
+        "load": None,
+        "cpu_temp": None,
+        "battery_temp": None,
+        "cpu_zones": (),
+    },
+}
+QUIESCE_POLL_INTERVAL = 5
+# overall time allowed for the mandatory teardown steps, and the time
+# optional steps may continue after the mandatory steps are done.
+TEARDOWN_DEADLINE = 60
+TEARDOWN_OPTIONAL_GRACE = 5
+# seconds between SIGTERM and SIGKILL when cancelling the command.
+KILL_GRACE = 20
 
 
 def fatal(message, exception=None, retry=True):
@@ -38,17 +92,57 @@ def fatal(message, exception=None, retry=True):
     sys.exit(exit_code)
 
 
-def show_df():
+def end_phase(name, start):
+    """Record the time taken by phase name which began at start and
+    return the start time of the next phase."""
+    now = time.time()
+    PHASE_TIMES.append((name, now - start))
+    return now
+
+
+def find_scriptvars(task_cwd):
+    """Return the path of the scriptvars.json for this task. When the
+    container drives a DEVICE_POOL, each device's generic-worker runs its
+    tasks inside the device's slot directory which contains the
+    scriptvars.json for that device.
+
+    """
+    path = task_cwd
+    while path.startswith(SLOTS_DIR + '/'):
+        candidate = os.path.join(path, 'scriptvars.json')
+        if os.path.exists(candidate):
+            return candidate
+        path = os.path.dirname(path)
+    return SCRIPTVARS_FILE
+
+
+def get_artifacts_dir(env, task_cwd):
+    """Return the directory where script.py writes its own artifacts.
+    workspace/logs is uploaded as public/logs by the Bitbar tasks.
+
+    """
+    return env.get('BITBAR_ARTIFACTS_DIR', os.path.join(task_cwd, 'workspace', 'logs'))
+
+
+def env_int(env, name, default):
+    """Return the integer value of the environment variable name, or
+    default if it is unset, empty or not an integer."""
+    value = env.get(name, '')
+    if not value:
+        return default
     try:
-        print('\ndf -h\n%s\n\n' % subprocess.check_output(
-            ['df', '-h'],
-            stderr=subprocess.STDOUT).decode())
-    except subprocess.CalledProcessError as e:
-        print('{} attempting df'.format(e))
+        return int(value)
+    except ValueError:
+        print('ignoring {}={!r}, expected an integer, using {}'.format(name, value, default))
+        return default
 
 
 def get_device_type(device):
     device_type = device.shell_output("getprop ro.product.model", timeout=ADB_COMMAND_TIMEOUT)
+    return check_device_type(device_type)
+
+
+def check_device_type(device_type):
     if device_type == "Pixel 2":
         pass
     elif device_type == "Moto G (5)":
@@ -121,15 +215,161 @@ def enable_charging(device, device_type):
         print("{}: {}".format(e.__class__.__name__, e))
 
 
-def _monitor_readline(process, q):
+def get_device_thermals(device, cpu_zones):
+    """Return a dict containing the device's 1 minute load average, the
+    maximum temperature of the thermal zones matching cpu_zones and the
+    battery temperature. Values which could not be read are None.
+
+    """
+    output = device.shell_output(
+        "cat /proc/loadavg; "
+        "cat /sys/class/power_supply/battery/temp; "
+        "for z in /sys/class/thermal/thermal_zone*; do "
+        "echo zone $(cat $z/type) $(cat $z/temp); done",
+        timeout=ADB_COMMAND_TIMEOUT)
+    readings = {"load": None, "cpu_temp": None, "battery_temp": None}
+    lines = output.splitlines()
+    try:
+        readings["load"] = float(lines[0].split()[0])
+    except (IndexError, ValueError):
+        pass
+    try:
+        # battery temperature is reported in tenths of a degree.
+        readings["battery_temp"] = float(lines[1].strip()) / 10
+    except (IndexError, ValueError):
+        pass
+    for line in lines:
+        fields = line.split()
+        if len(fields) != 3 or fields[0] != "zone" or not fields[1].startswith(cpu_zones):
+            continue
+        try:
+            temp = float(fields[2])
+        except ValueError:
+            continue
+        # most kernels report millidegrees, some report degrees.
+        if temp > 1000:
+            temp /= 1000
+        if readings["cpu_temp"] is None or temp > readings["cpu_temp"]:
+            readings["cpu_temp"] = temp
+    return readings
+
+
+def wait_for_quiesce(device, device_type, timeout):
+    """Wait up to timeout seconds for the device's load, cpu and
+    battery temperatures to fall below the limits in
+    QUIESCE_THRESHOLDS for device_type. The test is started regardless
+    of the outcome; the gate only reduces noise in performance results.
+
+    """
+    thresholds = QUIESCE_THRESHOLDS.get(device_type)
+    if not thresholds:
+        print("wait_for_quiesce: no thresholds for device '%s', skipping." % device_type)
+        return
+    limits = dict((k, v) for k, v in thresholds.items() if k != "cpu_zones" and v is not None)
+    if not limits:
+        print("wait_for_quiesce: no limits for device '%s', skipping." % device_type)
+        return
+
+    start = time.time()
+    waited_for = set()
     while True:
-        bail = True
-        if process.poll() is None:
-            bail = False
-        out = process.stdout.readline().decode()
-        q.put(out)
-        if q.empty() and bail:
-            break
+        try:
+            readings = get_device_thermals(device, thresholds["cpu_zones"])
+        except (ADBError, ADBTimeoutError) as e:
+            print("TEST-WARNING | bitbar | Error while reading device thermals.")
+            print("{}: {}".format(e.__class__.__name__, e))
+            return
+        over = sorted(k for k, limit in limits.items()
+                      if readings[k] is not None and readings[k] > limit)
+        elapsed = time.time() - start
+        if not over:
+            if waited_for:
+                print("wait_for_quiesce: device quiesced after {:.0f}s waiting for {}.".format(
+                    elapsed, ", ".join(sorted(waited_for))))
+            else:
+                print("wait_for_quiesce: device is quiet {}".format(json.dumps(readings)))
+            return
+        waited_for.update(over)
+        if elapsed >= timeout:
+            print("TEST-WARNING | bitbar | device did not quiesce within {}s: {}".format(
+                timeout, ", ".join("{} {} > {}".format(k, readings[k], limits[k]) for k in over)))
+            return
+        print("wait_for_quiesce: waiting for {}".format(
+            ", ".join("{} {} > {}".format(k, readings[k], limits[k]) for k in over)))
+        time.sleep(min(QUIESCE_POLL_INTERVAL, max(0, timeout - elapsed)))
+
+
+def run_teardown(chains, deadline):
+    """Run the teardown steps and return once the mandatory steps are done
+    or deadline seconds have passed.
+
+    chains is a list of lists of (name, function, mandatory) steps. The
+    steps of a chain are run in order, the chains are run concurrently.
+    Chains without mandatory steps are given at most
+    TEARDOWN_OPTIONAL_GRACE more seconds. Steps which did not finish in
+    time are reported but left running in daemon threads. If a step
+    calls fatal(), the remaining steps are still run and the process
+    exits with its status once the teardown is finished.
+
+    """
+    timings = {}
+    exit_codes = []
+
+    def run_chain(chain):
+        for name, func, _ in chain:
+            step_start = time.time()
+            try:
+                func()
+            except Exception as e:
+                print('{} during teardown step {}'.format(e, name))
+            except SystemExit as e:
+                # sys.exit() in this thread would only end the thread.
+                exit_codes.append(e.code)
+            timings[name] = time.time() - step_start
+
+    start = time.time()
+    threads = []
+    for chain in chains:
+        thread = threading.Thread(target=run_chain, args=(chain,),
+                                  name='teardown-{}'.format(chain[0][0]))
+        thread.daemon = True
+        thread.start()
+        threads.append((chain, thread))
+    end = start + deadline
+    for chain, thread in threads:
+        if any(mandatory for _, _, mandatory in chain):
+            thread.join(max(0, end - time.time()))
+    end = min(end, time.time() + TEARDOWN_OPTIONAL_GRACE)
+    for chain, thread in threads:
+        thread.join(max(0, end - time.time()))
+
+    report = []
+    for chain, _ in threads:
+        for name, _, mandatory in chain:
+            if name in timings:
+                report.append('{} {:.1f}s'.format(name, timings[name]))
+            elif mandatory:
+                report.append('{} overran'.format(name))
+            else:
+                report.append('{} unfinished'.format(name))
+    print('script.py: teardown finished in {:.1f}s ({})'.format(
+        time.time() - start, ', '.join(report)))
+    overran = [name for chain, _ in threads for name, _, mandatory in chain
+               if mandatory and name not in timings]
+    if overran:
+        print('TEST-WARNING | bitbar | teardown exceeded {}s deadline: {}'.format(
+            deadline, ', '.join(overran)))
+    if exit_codes:
+        sys.exit(exit_codes[0])
+
+
+def _monitor_readline(process, q, counters):
+    # read until EOF rather than polling the process, which would reap
+    # it before main() can collect its rusage.
+    for line in iter(process.stdout.readline, b''):
+        counters['output_bytes'] += len(line)
+        counters['last_output'] = time.time()
+        q.put(line.decode())
 
 
 def main():
@@ -142,22 +382,30 @@ def main():
                         level=logging.INFO,
                         stream=sys.stdout)
 
+    del PHASE_TIMES[:]
+    phase_start = time.time()
     print('\nscript.py: starting')
-    with open('/builds/worker/version') as versionfile:
-        version = versionfile.read().strip()
+    task_cwd = os.getcwd()
+    scriptvars_path = find_scriptvars(task_cwd)
+    taskenv_path = os.path.join(os.path.dirname(scriptvars_path), taskenv.FILENAME)
+    snapshot = taskenv.load(taskenv_path)
+    if snapshot:
+        version = snapshot['image_version']
+        scriptvarsenv = snapshot['scriptvars']
+    else:
+        with open(VERSION_FILE) as versionfile:
+            version = versionfile.read().strip()
+        with open(scriptvars_path) as scriptvars:
+            scriptvarsenv = json.loads(scriptvars.read())
     print('\nDockerfile version {}'.format(version))
 
     taskcluster_debug = '*'
 
-    task_cwd = os.getcwd()
     print('Current working directory: {}'.format(task_cwd))
-
-    with open('/builds/taskcluster/scriptvars.json') as scriptvars:
-        scriptvarsenv = json.loads(scriptvars.read())
-        print('Bitbar test run: https://mozilla.testdroid.com/#testing/device-session/{}/{}/{}'.format(
-            scriptvarsenv['TESTDROID_PROJECT_ID'],
-            scriptvarsenv['TESTDROID_BUILD_ID'],
-            scriptvarsenv['TESTDROID_RUN_ID']))
+    print('Bitbar test run: https://mozilla.testdroid.com/#testing/device-session/{}/{}/{}'.format(
+        scriptvarsenv['TESTDROID_PROJECT_ID'],
+        scriptvarsenv['TESTDROID_BUILD_ID'],
+        scriptvarsenv['TESTDROID_RUN_ID']))
 
     env = dict(os.environ)
 
@@ -169,19 +417,14 @@ def main():
     path += ':/builds/worker/android-sdk-linux/tools/bin:/builds/worker/android-sdk-linux/platform-tools'
 
     env['PATH'] = os.environ['PATH'] = path
-    env['NEED_XVFB'] = 'false'
-    env['DEVICE_NAME'] = scriptvarsenv['DEVICE_NAME']
-    env['ANDROID_DEVICE'] = scriptvarsenv['ANDROID_DEVICE']
-    env['DEVICE_SERIAL'] = scriptvarsenv['DEVICE_SERIAL']
-    env['HOST_IP'] = scriptvarsenv['HOST_IP']
-    env['DEVICE_IP'] = scriptvarsenv['DEVICE_IP']
-    env['DOCKER_IMAGE_VERSION'] = scriptvarsenv['DOCKER_IMAGE_VERSION']
+    env.update(snapshot['env'] if snapshot else taskenv.task_env(scriptvarsenv))
+    device_pool = scriptvarsenv.get('DEVICE_POOL', '')
 
     if 'HOME' not in env:
         env['HOME'] = '/builds/worker'
         print('setting HOME to {}'.format(env['HOME']))
 
-    show_df()
+    phase_start = end_phase('environment', phase_start)
 
     # If we are running normal tests we will be connected via usb and
     # there should be only one device connected.  If we are running
@@ -197,31 +440,51 @@ def main():
             adbhost.command_output(["connect", env['DEVICE_SERIAL']])
         devices = adbhost.devices()
         print(json.dumps(devices, indent=4))
-        if len(devices) != 1:
+        if device_pool:
+            # the adb server is shared by all of the devices in the pool.
+            if env['DEVICE_SERIAL'] not in [d['device_serial'] for d in devices]:
+                fatal('Device {} is not connected.'.format(env['DEVICE_SERIAL']), retry=True)
+        elif len(devices) != 1:
             fatal('Must have exactly one connected device. {} found.'.format(len(devices)), retry=True)
     except (ADBError, ADBTimeoutError) as e:
         fatal('{} Unable to obtain attached devices'.format(e), retry=True)
 
-    try:
-        for f in glob('/tmp/adb.*.log'):
-            print('\n{}:\n'.format(f))
-            with open(f) as afile:
-                print(afile.read())
-    except Exception as e:
-        print('{} while reading adb logs'.format(e))
+    phase_start = end_phase('adb_host', phase_start)
+
+    artifacts_dir = get_artifacts_dir(env, task_cwd)
+    diagnostics.collect('setup', artifacts_dir)
+    phase_start = end_phase('diagnostics', phase_start)
 
     print('Connecting to Android device {}'.format(env['DEVICE_SERIAL']))
     try:
         device = ADBDevice(device=env['DEVICE_SERIAL'])
-        android_version = device.get_prop('ro.build.version.release')
-        print('Android device version (ro.build.version.release):  {}'.format(android_version))
-        # this can explode if an unknown device, explode now vs in an hour...
-        device_type = get_device_type(device)
         # set device to UTC
         if device.is_rooted:
             device.shell_output('setprop persist.sys.timezone "UTC"', timeout=ADB_COMMAND_TIMEOUT)
-        # show date for visual confirmation
-        device_datetime = device.shell_output("date", timeout=ADB_COMMAND_TIMEOUT)
+        # show date for visual confirmation. The boot_id read along with
+        # it tells whether the device fingerprint in the snapshot is
+        # still valid.
+        output = device.shell_output('cat {}; date'.format(taskenv.BOOT_ID_PATH),
+                                     timeout=ADB_COMMAND_TIMEOUT)
+        boot_id, _, device_datetime = output.partition('\n')
+        boot_id = boot_id.strip()
+        fingerprint = taskenv.valid_device(snapshot, env['DEVICE_SERIAL'], boot_id)
+        if fingerprint:
+            android_version = fingerprint['android_version']
+            device_type = fingerprint['model']
+        else:
+            android_version = device.get_prop('ro.build.version.release')
+            device_type = get_device_type(device)
+            if snapshot and boot_id:
+                snapshot['device'] = taskenv.device_fingerprint(
+                    env['DEVICE_SERIAL'], device_type, android_version, boot_id)
+                try:
+                    taskenv.write(taskenv_path, snapshot)
+                except (IOError, OSError) as e:
+                    print('{} updating {}'.format(e, taskenv_path))
+        print('Android device version (ro.build.version.release):  {}'.format(android_version))
+        # this can explode if an unknown device, explode now vs in an hour...
+        check_device_type(device_type)
         print('Android device datetime:  {}'.format(device_datetime))
 
         # clean up the device.
@@ -233,79 +496,177 @@ def main():
     except (ADBError, ADBTimeoutError) as e:
         fatal("{} attempting to clean up device".format(e), retry=True)
 
+    # the device cache survives the clean up above, but must not fill
+    # the device.
+    env['BITBAR_DEVICE_CACHE'] = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                              'devicecache.py')
+    reserve_mb = env_int(env, 'BITBAR_DEVICE_CACHE_RESERVE_MB',
+                         devicecache.DEFAULT_RESERVE // (1024 * 1024))
+    try:
+        devicecache.evict(device, reserve=reserve_mb * 1024 * 1024)
+    except (ADBError, ADBTimeoutError) as e:
+        print('{} attempting to trim device cache'.format(e))
+
+    phase_start = end_phase('device_setup', phase_start)
+
     if taskcluster_debug:
         env['DEBUG'] = taskcluster_debug
 
     print('environment = {}'.format(json.dumps(env, indent=4)))
 
-    # run the payload's command and ensure that:
-    # - all output is printed
-    # - no deadlock occurs between proc.poll() and sys.stdout.readline()
-    #   - more info
-    #     - https://bugzilla.mozilla.org/show_bug.cgi?id=1611936
-    #     - https://stackoverflow.com/questions/58471094/python-subprocess-readline-hangs-cant-use-normal-options
-    print("script.py: running command '%s'" % ' '.join(extra_args))
-    rc = None
-    proc = subprocess.Popen(extra_args,
-                            # use standard os buffer size
-                            bufsize=-1,
-                            env=env,
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.STDOUT,
-                            close_fds=True)
-    # Create the queue instance
-    q = queue.Queue()
-    # Kick off the monitoring thread
-    thread = threading.Thread(target=_monitor_readline, args=(proc, q))
-    thread.daemon = True
-    thread.start()
-    start = datetime.now()
-    while True:
-        time.sleep(0.1)
-        bail = True
-        rc = proc.poll()
-        if rc is None:
-            bail = False
-            # Re-set the thread timer
-            start = datetime.now()
-        out = ""
-        while not q.empty():
-            out += q.get()
-        if out:
-            print(out.rstrip())
-
-        # In the case where the thread is still alive and reading, and
-        # the process has exited and finished, give it up to X seconds
-        # to finish reading
-        if bail and thread.is_alive() and (datetime.now() - start).total_seconds() < 5:
-            bail = False
-        if bail:
-            break
-    print("script.py: command finished")
-
-    # enable charging on device if it is disabled
-    #   see https://bugzilla.mozilla.org/show_bug.cgi?id=1565324
-    enable_charging(device, device_type)
-
+    # optionally wait for the device to cool down and settle before
+    # starting performance sensitive tests.
+    quiesce_timeout = env_int(env, 'BITBAR_QUIESCE_TIMEOUT', 0)
+    if quiesce_timeout > 0:
+        wait_for_quiesce(device, device_type, quiesce_timeout)
+        phase_start = end_phase('quiesce', phase_start)
+
+    logcat = None
+    if env.get('BITBAR_LOGCAT', '0') == '1':
+        logcat = LogcatCapture(
+            env['DEVICE_SERIAL'],
+            os.path.join(artifacts_dir, 'logcat.log'),
+            env_int(env, 'BITBAR_LOGCAT_MAX_MB', 32) * 1024 * 1024)
+        try:
+            logcat.start()
+        except OSError as e:
+            print('{} attempting to start logcat capture'.format(e))
+            logcat = None
+
+    # optionally abort the command if it produces no output for this
+    # many seconds.
+    no_output_timeout = env_int(env, 'BITBAR_NO_OUTPUT_TIMEOUT', 0)
+
+    # logcat is stopped even if the command cannot be run or teardown
+    # fails, since the compressed stream is only complete once it is.
     try:
+        # run the payload's command and ensure that:
+        # - all output is printed
+        # - no deadlock occurs between proc.poll() and sys.stdout.readline()
+        #   - more info
+        #     - https://bugzilla.mozilla.org/show_bug.cgi?id=1611936
+        #     - https://stackoverflow.com/questions/58471094/python-subprocess-readline-hangs-cant-use-normal-options
+        print("script.py: running command '%s'" % ' '.join(extra_args))
+        rc = None
+        proc = subprocess.Popen(extra_args,
+                                # use standard os buffer size
+                                bufsize=-1,
+                                env=env,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT,
+                                close_fds=True,
+                                # run the command in its own process group
+                                preexec_fn=os.setpgrp)
+        command_start = time.time()
+        command_wall_time = None
+        rusage = None
+        counters = {'output_bytes': 0, 'last_output': command_start}
+        group = ProcessGroup(proc)
+
+        # the handler only records the signal since printing from it
+        # can raise a reentrant call RuntimeError if the signal arrives
+        # while the main thread is printing. The polling loop below
+        # forwards it to the group.
+        received = []
+
+        def forward_signal(signum, frame):
+            received.append(signum)
+
+        previous_handlers = dict((signum, signal.signal(signum, forward_signal))
+                                 for signum in (signal.SIGTERM, signal.SIGINT))
+        sampler = resource_usage.ProcessTreeSampler(proc.pid)
+        sampler.start()
+        # Create the queue instance
+        q = queue.Queue()
+        # Kick off the monitoring thread
+        thread = threading.Thread(target=_monitor_readline, args=(proc, q, counters))
+        thread.daemon = True
+        thread.start()
+        start = datetime.now()
+        while True:
+            time.sleep(0.1)
+            bail = True
+            rc, exit_rusage = resource_usage.poll_rusage(proc)
+            if exit_rusage:
+                rusage = exit_rusage
+            if rc is not None and command_wall_time is None:
+                command_wall_time = time.time() - command_start
+            if rc is None:
+                bail = False
+                # Re-set the thread timer
+                start = datetime.now()
+                while received:
+                    signum = received.pop(0)
+                    group.cancel(signum, 'received {}'.format(signal.Signals(signum).name))
+                if no_output_timeout and group.cancel_time is None and \
+                   time.time() - counters['last_output'] > no_output_timeout:
+                    print('TEST-UNEXPECTED-FAIL | bitbar | command produced no output for {}s'.format(
+                        no_output_timeout))
+                    for pid, cmdline in sorted(group.members().items()):
+                        print('    {} {}'.format(pid, cmdline))
+                    diagnostics.collect('hang', artifacts_dir)
+                    group.cancel(signal.SIGTERM, 'no output watchdog expired')
+                group.check(KILL_GRACE)
+            out = ""
+            while not q.empty():
+                out += q.get()
+            if out:
+                print(out.rstrip())
+
+            # In the case where the thread is still alive and reading, and
+            # the process has exited and finished, give it up to X seconds
+            # to finish reading
+            if bail and thread.is_alive() and (datetime.now() - start).total_seconds() < 5:
+                bail = False
+            if bail:
+                break
+        print("script.py: command finished")
+        for signum, handler in previous_handlers.items():
+            signal.signal(signum, handler)
+        group.cleanup(KILL_GRACE)
+        sampler.stop()
+        resource_usage.report(os.path.join(artifacts_dir, 'resource-usage.json'),
+                              command_wall_time, rusage, sampler, counters['output_bytes'])
+        phase_start = end_phase('command', phase_start)
+
+        def disconnect_wifi():
+            try:
+                device.command_output(["usb"])
+                adbhost.command_output(["disconnect", env['DEVICE_SERIAL']])
+            except (ADBError, ADBTimeoutError) as e:
+                print('{} attempting adb usb and disconnect'.format(e))
+
+        def kill_server():
+            try:
+                adbhost.kill_server()
+            except (ADBError, ADBTimeoutError) as e:
+                print('{} attempting adb kill-server'.format(e))
+
+        # enable charging on device if it is disabled
+        #   see https://bugzilla.mozilla.org/show_bug.cgi?id=1565324
+        device_chain = [('enable_charging', lambda: enable_charging(device, device_type), True)]
         if env['DEVICE_SERIAL'].endswith(':5555'):
-            device.command_output(["usb"])
-            adbhost.command_output(["disconnect", env['DEVICE_SERIAL']])
-        adbhost.kill_server()
-    except (ADBError, ADBTimeoutError) as e:
-        print('{} attempting adb kill-server'.format(e))
-
-    try:
-        print('\nnetstat -aop\n%s\n\n' % subprocess.check_output(
-            ['netstat', '-aop'],
-            stderr=subprocess.STDOUT).decode())
-    except subprocess.CalledProcessError as e:
-        print('{} attempting netstat'.format(e))
-
-    show_df()
+            device_chain.append(('disconnect_wifi', disconnect_wifi, True))
+        if not device_pool:
+            # other devices in the pool are still using the adb server.
+            device_chain.append(('kill_server', kill_server, True))
+        chains = [device_chain,
+                  [('diagnostics', lambda: diagnostics.collect('teardown', artifacts_dir), False)]]
+        if logcat:
+            chains.append([('logcat', logcat.stop, True)])
+        run_teardown(chains, TEARDOWN_DEADLINE)
+    finally:
+        if logcat:
+            logcat.stop()
+    end_phase('teardown', phase_start)
+    print('script.py: phase times: {}'.format(
+        ', '.join('{} {:.1f}s'.format(name, elapsed) for name, elapsed in PHASE_TIMES)))
 
     print('script.py: exiting with exitcode {}.'.format(rc))
     return rc
 
 if __name__ == "__main__":
-    sys.exit(main())
+    # profiles go with the task's other artifacts unless
+    # BITBAR_PROFILE_DIR is set, see profiling.py.
+    sys.exit(profiling.run('script', main, directory=os.environ.get('BITBAR_PROFILE_DIR') or
+                           get_artifacts_dir(os.environ, os.getcwd())))
@@ -0,0 +1,135 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Snapshot of the task environment written by entrypoint.py.
+
+entrypoint.py writes FILENAME next to each scriptvars.json when the
+container starts. It contains the scriptvars, the variables script.py
+adds to the task environment and the image version. script.py loads it
+with a single read instead of deriving these on every task.
+
+entrypoint.py does not talk to the device, since starting the adb server
+before the Bitbar adbkey is linked would leave the device unauthorized.
+The first task instead adds a fingerprint of the device to the snapshot.
+It is only valid while the device has not rebooted: script.py reads the
+device's boot_id in the same adb call which shows the device's date and
+probes the device again if it has changed, updating the snapshot for
+later tasks.
+
+"""
+
+import json
+import os
+import time
+
+VERSION = 1
+FILENAME = 'taskenv.json'
+BOOT_ID_PATH = '/proc/sys/kernel/random/boot_id'
+
+# scriptvars which are passed to the test command.
+TASK_ENV_NAMES = (
+    'DEVICE_NAME',
+    'ANDROID_DEVICE',
+    'DEVICE_SERIAL',
+    'HOST_IP',
+    'DEVICE_IP',
+    'DOCKER_IMAGE_VERSION',
+)
+
+SCHEMA = {
+    'version': int,
+    'created': float,
+    'image_version': str,
+    'scriptvars': dict,
+    'env': dict,
+    'device': (dict, type(None)),
+}
+DEVICE_SCHEMA = {
+    'serial': str,
+    'model': str,
+    'android_version': str,
+    'boot_id': str,
+    'probed': float,
+}
+
+
+def task_env(scriptvars):
+    """Return the variables derived from scriptvars which script.py adds
+    to the environment of the test command."""
+    env = {'NEED_XVFB': 'false'}
+    for name in TASK_ENV_NAMES:
+        env[name] = scriptvars[name]
+    if scriptvars.get('DEVICE_POOL'):
+        env['DEVICE_POOL'] = scriptvars['DEVICE_POOL']
+        env['TOOLTOOL_CACHE'] = scriptvars['TOOLTOOL_CACHE']
+    return env
+
+
+def device_fingerprint(serial, model, android_version, boot_id):
+    return {
+        'serial': serial,
+        'model': model,
+        'android_version': android_version,
+        'boot_id': boot_id,
+        'probed': time.time(),
+    }
+
+
+def build(scriptvars, image_version, device=None):
+    return {
+        'version': VERSION,
+        'created': time.time(),
+        'image_version': image_version,
+        'scriptvars': scriptvars,
+        'env': task_env(scriptvars),
+        'device': device,
+    }
+
+
+def validate(snapshot):
+    """Raise ValueError if snapshot does not match the current schema."""
+    if not isinstance(snapshot, dict):
+        raise ValueError('snapshot is not an object')
+    if snapshot.get('version') != VERSION:
+        raise ValueError('snapshot version {} is not {}'.format(snapshot.get('version'), VERSION))
+    for schema, data in ((SCHEMA, snapshot), (DEVICE_SCHEMA, snapshot.get('device'))):
+        if data is None:
+            continue
+        for key, kind in schema.items():
+            if not isinstance(data.get(key), kind):
+                raise ValueError('{} is missing or has the wrong type'.format(key))
+    for name in TASK_ENV_NAMES:
+        if not isinstance(snapshot['env'].get(name), str):
+            raise ValueError('env {} is missing or has the wrong type'.format(name))
+
+
+def write(path, snapshot):
+    # write atomically since script.py may update the snapshot while
+    # another task is starting.
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(snapshot, f, indent=2)
+    os.rename(tmp_path, path)
+
+
+def load(path):
+    """Return the validated snapshot in path, or None if it does not
+    exist or is not valid."""
+    try:
+        with open(path) as f:
+            snapshot = json.load(f)
+        validate(snapshot)
+    except (IOError, OSError, ValueError) as e:
+        print('not using task environment snapshot {}: {}'.format(path, e))
+        return None
+    return snapshot
+
+
+def valid_device(snapshot, serial, boot_id):
+    """Return the device fingerprint in snapshot if it belongs to serial
+    and the device has not rebooted since it was probed, else None."""
+    device = snapshot.get('device') if snapshot else None
+    if device and device['serial'] == serial and device['boot_id'] == boot_id:
+        return device
+    return None
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Run taskcluster/script.py end to end against fake devices and report
+the time spent in each phase.
+
+    tools/bench_script.py --iterations 5 --latency 0.05 --latency rm=0.5
+
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'taskcluster'))
+
+import fake_mozdevice  # noqa: E402
+import taskenv  # noqa: E402
+
+DEFAULT_COMMAND = [sys.executable, '-c',
+                   'import time\n'
+                   'for i in range(1000):\n'
+                   '    print("synthetic test output line %d" % i)\n'
+                   'time.sleep(0.5)\n']
+
+
+def parse_latency(values):
+    default = 0.0
+    latency = {}
+    for value in values:
+        if '=' in value:
+            name, seconds = value.split('=', 1)
+            latency[name] = float(seconds)
+        else:
+            default = float(value)
+    return default, latency
+
+
+def write_fixtures(workdir, serial, snapshot):
+    version = os.path.join(workdir, 'version')
+    with open(version, 'w') as f:
+        f.write('bench\n')
+    variables = {
+        'ANDROID_DEVICE': 'bench',
+        'DEVICE_IP': '127.0.0.1',
+        'DEVICE_NAME': 'bench-device',
+        'DEVICE_SERIAL': serial,
+        'DOCKER_IMAGE_VERSION': 'bench',
+        'HOST_IP': '127.0.0.1',
+        'TESTDROID_BUILD_ID': '0',
+        'TESTDROID_PROJECT_ID': '0',
+        'TESTDROID_RUN_ID': '0',
+    }
+    scriptvars = os.path.join(workdir, 'scriptvars.json')
+    with open(scriptvars, 'w') as f:
+        json.dump(variables, f)
+    if snapshot:
+        # like entrypoint.py, without the device fingerprint which the
+        # first iteration adds.
+        taskenv.write(os.path.join(workdir, taskenv.FILENAME),
+                      taskenv.build(variables, 'bench'))
+    return version, scriptvars
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=3)
+    parser.add_argument('--model', default='Pixel 2',
+                        help='value of ro.product.model reported by the fake device')
+    parser.add_argument('--latency', action='append', default=[],
+                        help='seconds per adb command, or command=seconds for one '
+                             'command; may be repeated')
+    parser.add_argument('--timeout', action='append', default=[],
+                        help='command which times out; may be repeated')
+    parser.add_argument('--fail', action='append', default=[],
+                        help='command which fails once per iteration; may be repeated')
+    parser.add_argument('--adb-timeout', type=float, default=10,
+                        help='seconds a timing out command takes')
+    parser.add_argument('--taskenv', action='store_true',
+                        help='write a task environment snapshot as entrypoint.py does')
+    parser.add_argument('--output', help='write the results as json to this file')
+    parser.add_argument('command', nargs=argparse.REMAINDER,
+                        help='test command to run, defaults to a synthetic command')
+    args = parser.parse_args()
+    default_latency, latency = parse_latency(args.latency)
+    command = args.command or DEFAULT_COMMAND
+
+    config = fake_mozdevice.install()
+    import script
+
+    workdir = tempfile.mkdtemp(prefix='bench_script_')
+    cwd = os.getcwd()
+    serial = 'FAKE0001'
+    script.VERSION_FILE, script.SCRIPTVARS_FILE = write_fixtures(
+        workdir, serial, args.taskenv)
+    results = []
+    real_stdout = sys.stdout
+    try:
+        os.chdir(workdir)
+        for i in range(args.iterations):
+            config.__init__(serials=[serial], props={'ro.product.model': args.model},
+                            latency=latency, default_latency=default_latency,
+                            timeouts=args.timeout,
+                            failures=dict((name, 1) for name in args.fail),
+                            timeout=args.adb_timeout)
+            sys.argv = ['script.py'] + command
+            start = time.time()
+            with open(os.path.join(workdir, 'script-{}.log'.format(i)), 'w') as log:
+                sys.stdout = log
+                try:
+                    rc = script.main()
+                except SystemExit as e:
+                    rc = e.code
+                finally:
+                    sys.stdout = real_stdout
+            results.append({
+                'rc': rc,
+                'total': time.time() - start,
+                'phases': list(script.PHASE_TIMES),
+                'adb_calls': len(config.calls),
+            })
+            print('iteration {}: rc {} in {:.2f}s, {} adb calls'.format(
+                i, rc, results[-1]['total'], results[-1]['adb_calls']))
+    finally:
+        os.chdir(cwd)
+
+    phases = []
+    for result in results:
+        for name, _ in result['phases']:
+            if name not in phases:
+                phases.append(name)
+    print('\n{:<16} {:>8} {:>8} {:>8}'.format('phase', 'mean', 'min', 'max'))
+    for name in phases + ['total']:
+        if name == 'total':
+            values = [r['total'] for r in results]
+        else:
+            values = [elapsed for r in results for n, elapsed in r['phases'] if n == name]
+        print('{:<16} {:>8.3f} {:>8.3f} {:>8.3f}'.format(
+            name, sum(values) / len(values), min(values), max(values)))
+    print('\nlogs are in {}'.format(workdir))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,182 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Stand-in for the parts of mozdevice used by taskcluster/script.py.
+
+install() registers this module as `mozdevice` so that script.py and
+its helpers can be run without a device attached. Each command sleeps
+for a configurable latency and can be made to time out or fail:
+
+    import fake_mozdevice
+    fake_mozdevice.install(fake_mozdevice.FakeConfig(
+        latency={'rm': 0.5}, failures={'kill_server': 1}))
+
+"""
+
+import sys
+import threading
+import time
+
+DEFAULT_PROPS = {
+    'ro.product.model': 'Pixel 2',
+    'ro.build.version.release': '9',
+}
+
+
+class ADBError(Exception):
+    pass
+
+
+class ADBTimeoutError(Exception):
+    pass
+
+
+class FakeConfig(object):
+    """Behaviour of the fake devices.
+
+    latency maps a command name (devices, connect, kill_server,
+    command_output, shell_output, shell_bool, rm, get_prop, is_rooted,
+    get_info, exists, mkdir, push) to the seconds it takes;
+    default_latency is used for the others. timeouts is a set of
+    command names which sleep for their timeout and then raise
+    ADBTimeoutError. failures maps command names to the number of calls
+    which raise ADBError before the command succeeds. shell maps
+    shell command prefixes to their output. Shell commands joined with
+    '; ' are answered one after the other. boot_id is reported by
+    /proc/sys/kernel/random/boot_id.
+
+    """
+    def __init__(self, serials=('FAKE0001',), props=None, rooted=True,
+                 latency=None, default_latency=0.0, timeouts=(), failures=None,
+                 shell=None, timeout=10, boot_id='fake-boot-id'):
+        self.serials = list(serials)
+        self.props = dict(DEFAULT_PROPS)
+        self.props.update(props or {})
+        self.rooted = rooted
+        self.latency = dict(latency or {})
+        self.default_latency = default_latency
+        self.timeouts = set(timeouts)
+        self.failures = dict(failures or {})
+        self.shell = dict(shell or {})
+        self.timeout = timeout
+        self.boot_id = boot_id
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def call(self, name, *args, **kwargs):
+        """Account for a call of command name, sleeping and raising as
+        configured."""
+        start = time.time()
+        with self._lock:
+            self.calls.append((name, args, start))
+            failing = self.failures.get(name, 0)
+            if failing:
+                self.failures[name] = failing - 1
+        if name in self.timeouts:
+            time.sleep(kwargs.get('timeout') or self.timeout)
+            raise ADBTimeoutError('fake timeout in {}'.format(name))
+        time.sleep(self.latency.get(name, self.default_latency))
+        if failing:
+            raise ADBError('fake failure in {}'.format(name))
+
+    def shell_output(self, cmd):
+        if '; ' in cmd:
+            return '\n'.join(self.shell_output(part) for part in cmd.split('; '))
+        if cmd.startswith('getprop '):
+            return self.props.get(cmd.split()[1], '')
+        for prefix, output in self.shell.items():
+            if cmd.startswith(prefix):
+                return output
+        if cmd.startswith('stat -f'):
+            # 4 GB available in 4 KB blocks.
+            return '1048576 4096'
+        if cmd == 'cat /proc/sys/kernel/random/boot_id':
+            return self.boot_id
+        if cmd == 'date':
+            return time.strftime('%a %b %d %H:%M:%S UTC %Y', time.gmtime())
+        return ''
+
+
+config = FakeConfig()
+
+
+class ADBHost(object):
+    def __init__(self, adb='adb', verbose=False, timeout=300, **kwargs):
+        self.verbose = verbose
+
+    def command_output(self, cmds, timeout=None):
+        if cmds and cmds[0] == 'connect':
+            return self.connect(cmds[1], timeout=timeout)
+        config.call('command_output', *cmds, timeout=timeout)
+        return ''
+
+    def connect(self, serial, timeout=None):
+        config.call('connect', serial, timeout=timeout)
+        if serial not in config.serials:
+            config.serials.append(serial)
+        return 'connected to {}'.format(serial)
+
+    def devices(self, timeout=None):
+        config.call('devices', timeout=timeout)
+        return [{'device_serial': serial, 'state': 'device'} for serial in config.serials]
+
+    def kill_server(self, timeout=None):
+        config.call('kill_server', timeout=timeout)
+
+
+class ADBDevice(object):
+    def __init__(self, device=None, adb='adb', verbose=False, timeout=300, **kwargs):
+        if device is None:
+            device = config.serials[0]
+        self._device_serial = device
+        self.files = {}
+
+    @property
+    def is_rooted(self):
+        config.call('is_rooted')
+        return config.rooted
+
+    def command_output(self, cmds, timeout=None):
+        config.call('command_output', *cmds, timeout=timeout)
+        return ''
+
+    def shell_output(self, cmd, env=None, cwd=None, timeout=None, root=False):
+        config.call('shell_output', cmd, timeout=timeout)
+        return config.shell_output(cmd)
+
+    def shell_bool(self, cmd, env=None, cwd=None, timeout=None, root=False):
+        config.call('shell_bool', cmd, timeout=timeout)
+        return True
+
+    def get_prop(self, prop, timeout=None):
+        config.call('get_prop', prop, timeout=timeout)
+        return config.props.get(prop, '')
+
+    def get_info(self, directive=None, timeout=None):
+        config.call('get_info', directive, timeout=timeout)
+        return {'id': self._device_serial}
+
+    def rm(self, path, recursive=False, force=False, timeout=None, root=False):
+        config.call('rm', path, timeout=timeout)
+
+    def exists(self, path, timeout=None, root=False):
+        config.call('exists', path, timeout=timeout)
+        return path in self.files
+
+    def mkdir(self, path, parents=False, timeout=None, root=False):
+        config.call('mkdir', path, timeout=timeout)
+
+    def push(self, local, remote, timeout=None):
+        config.call('push', local, remote, timeout=timeout)
+        self.files[remote] = local
+
+
+def install(new_config=None):
+    """Register this module as mozdevice, optionally replacing the
+    configuration. Must be called before script.py is imported."""
+    global config
+    if new_config is not None:
+        config = new_config
+    sys.modules['mozdevice'] = sys.modules[__name__]
+    return config
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Stand-in for start-worker which emits generic-worker like output.
+
+    fake_start_worker.py --lines 100000 --rate 0 --superseded --linger 2
+
+"""
+
+import argparse
+import json
+import os
+import resource
+import sys
+import time
+
+LINE = '2020/01/01 00:00:00 Task fakeTaskId: synthetic generic-worker output line {:08d} {}\n'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--lines', type=int, default=100000,
+                        help='number of lines to emit')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='lines per second, 0 for as fast as possible')
+    parser.add_argument('--padding', type=int, default=40,
+                        help='extra bytes per line')
+    parser.add_argument('--startup', type=float, default=0,
+                        help='seconds to wait before emitting anything')
+    parser.add_argument('--superseded', action='store_true',
+                        help='report that the task has been superseded')
+    parser.add_argument('--linger', type=float, default=0,
+                        help='seconds to stay alive after closing stdout')
+    parser.add_argument('--exit-code', type=int, default=0)
+    parser.add_argument('--stats-file',
+                        help='append json with this process\' cpu time and timestamps')
+    args = parser.parse_args()
+
+    started = time.time()
+    time.sleep(args.startup)
+    out = sys.stdout
+    padding = 'x' * args.padding
+    interval = 1.0 / args.rate if args.rate else 0
+    next_line = time.time()
+    out.write('Claiming task fakeTaskId\n')
+    first_output = time.time()
+    for i in range(args.lines):
+        out.write(LINE.format(i, padding))
+        if interval:
+            next_line += interval
+            delay = next_line - time.time()
+            if delay > 0:
+                out.flush()
+                time.sleep(delay)
+    if args.superseded:
+        out.write('Task fakeTaskId has been superseded\n')
+    out.write('Resolved task fakeTaskId\n')
+    out.flush()
+    finished = time.time()
+    # close stdout before exiting, like a worker shutting down its
+    # logging before it is reaped.
+    os.close(out.fileno())
+    time.sleep(args.linger)
+
+    if args.stats_file:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        with open(args.stats_file, 'a') as f:
+            f.write(json.dumps({
+                'cpu_seconds': usage.ru_utime + usage.ru_stime,
+                'started': started,
+                'first_output': first_output,
+                'finished': finished,
+                'exited': time.time(),
+            }) + '\n')
+    return args.exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Measure the cpu used by scripts/run_gw.py while it supervises a fake
+start-worker which emits output at a high rate, and the idle gap between
+superseded tasks.
+
+    tools/loadtest_run_gw.py --lines 200000 --linger 2
+    tools/loadtest_run_gw.py --lines 1000 --supersedes 5 --startup 1
+
+The cpu time reported for run_gw.py excludes the fake worker's own cpu
+time. The gap between tasks is the time from one fake worker's last line
+of output to the next fake worker's first line.
+
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+RUN_GW = os.path.join(os.path.dirname(HERE), 'scripts', 'run_gw.py')
+FAKE_WORKER = os.path.join(HERE, 'fake_start_worker.py')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--lines', type=int, default=200000)
+    parser.add_argument('--rate', type=float, default=0,
+                        help='lines per second, 0 for as fast as possible')
+    parser.add_argument('--linger', type=float, default=2,
+                        help='seconds the fake worker stays alive after closing stdout')
+    parser.add_argument('--startup', type=float, default=0,
+                        help='seconds the fake worker takes before its first output')
+    parser.add_argument('--supersedes', type=int, default=0,
+                        help='number of superseded tasks before a real one')
+    parser.add_argument('--run-gw', default=RUN_GW,
+                        help='supervisor to test, defaults to scripts/run_gw.py')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='loadtest_run_gw_')
+    stats_file = os.path.join(workdir, 'worker-stats.jsonl')
+    counter_file = os.path.join(workdir, 'supersedes')
+    with open(counter_file, 'w') as f:
+        f.write(str(args.supersedes))
+    # the fake worker reports superseded until the counter runs out.
+    worker = os.path.join(workdir, 'start-worker')
+    with open(worker, 'w') as f:
+        f.write('#!/bin/sh\n'
+                'n=$(cat {counter})\n'
+                'superseded=\n'
+                'if [ "$n" -gt 0 ]; then echo $((n - 1)) > {counter}; superseded=--superseded; fi\n'
+                'exec {python} {fake} --lines {lines} --rate {rate} --linger {linger} '
+                '--startup {startup} '
+                '--stats-file {stats} $superseded\n'.format(
+                    counter=counter_file, python=sys.executable, fake=FAKE_WORKER,
+                    lines=args.lines, rate=args.rate, linger=args.linger, startup=args.startup,
+                    stats=stats_file))
+    os.chmod(worker, 0o755)
+
+    env = dict(os.environ)
+    env['RUN_GW_WORKER_COMMAND'] = worker
+    start = time.time()
+    with open(os.path.join(workdir, 'run_gw.log'), 'w') as log:
+        proc = subprocess.Popen([sys.executable, args.run_gw], cwd=workdir, env=env,
+                                stdout=log, stderr=subprocess.STDOUT)
+        _, status, rusage = os.wait4(proc.pid, 0)
+    wall = time.time() - start
+
+    with open(stats_file) as f:
+        runs = sorted((json.loads(line) for line in f), key=lambda run: run['started'])
+    gaps = [run['first_output'] - previous['finished']
+            for previous, run in zip(runs, runs[1:])]
+    worker_cpu = sum(run['cpu_seconds'] for run in runs)
+    supervisor_cpu = rusage.ru_utime + rusage.ru_stime - worker_cpu
+    lines = args.lines * len(runs)
+    print('worker runs:        {}'.format(len(runs)))
+    print('lines:              {}'.format(lines))
+    print('wall time:          {:.2f}s'.format(wall))
+    print('supervisor cpu:     {:.2f}s ({:.1f}% of wall, {:.2f}us per line)'.format(
+        supervisor_cpu, 100 * supervisor_cpu / wall, 1e6 * supervisor_cpu / max(lines, 1)))
+    print('worker cpu:         {:.2f}s'.format(worker_cpu))
+    if gaps:
+        print('gap between tasks:  mean {:.2f}s, min {:.2f}s, max {:.2f}s'.format(
+            sum(gaps) / len(gaps), min(gaps), max(gaps)))
+    print('exit status:        {}'.format(os.WEXITSTATUS(status)))
+    print('output in {}'.format(workdir))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Build the Bitbar test zip files from the repository.
+
+    tools/package.py [--output-dir build] [--force]
+
+The tree is walked once, skipping the paths matched by zipexclude.lst.
+mozilla-docker-<label>-public.zip contains everything but the licenses
+directory and the Stackdriver credentials, mozilla-docker-<label>.zip is
+a copy of it with those appended, so every file is compressed once.
+Entries are sorted and have a fixed timestamp so that the same tree
+produces the same archives, and files which are already compressed are
+stored as is.
+
+The sha256 and mode of every file, and the mode of every directory, are
+recorded in build/manifest.json. If the tree has not changed since the
+last build, the previous zip files are reused and version is not
+rewritten.
+
+"""
+
+import argparse
+import fnmatch
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+import zipfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# top level directories and files which are only in the private zip.
+PRIVATE_PATHS = ('licenses', 'stackdriver_credentials.json')
+MANIFEST = 'manifest.json'
+# the version file is rewritten by every build and is not part of the
+# tree's content.
+VERSION = 'version'
+COMPRESSED_EXTENSIONS = ('.7z', '.apk', '.bz2', '.gz', '.jar', '.jpeg', '.jpg', '.png',
+                         '.tgz', '.whl', '.xz', '.zip', '.zst')
+COMPRESSED_MAGIC = (b'PK\x03\x04', b'\x1f\x8b', b'BZh', b'\xfd7zXZ', b'(\xb5/\xfd')
+
+
+def read_excludes(path):
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def excluded(path, patterns):
+    # like zip -x, * also matches /.
+    return any(fnmatch.fnmatchcase(path, pattern) for pattern in patterns)
+
+
+def walk(root, patterns):
+    """Return the sorted relative paths of the files and directories
+    under root which are not excluded. Directories end with /."""
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        reldir = os.path.relpath(dirpath, root)
+        prefix = '' if reldir == '.' else reldir + '/'
+        # excluded directories, such as .git and build, are not walked.
+        dirnames[:] = [name for name in dirnames
+                       if not excluded(prefix + name + '/', patterns)]
+        paths.extend(prefix + name + '/' for name in dirnames)
+        paths.extend(prefix + name for name in filenames
+                     if not excluded(prefix + name, patterns))
+    return sorted(paths)
+
+
+def digest_file(path, chunk_size=1024 * 1024):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        data = f.read(chunk_size)
+        while data:
+            h.update(data)
+            data = f.read(chunk_size)
+    return h.hexdigest()
+
+
+def is_private(path):
+    return path.split('/', 1)[0] in PRIVATE_PATHS
+
+
+def is_compressed(path):
+    if path.lower().endswith(COMPRESSED_EXTENSIONS):
+        return True
+    with open(path, 'rb') as f:
+        return f.read(6).startswith(COMPRESSED_MAGIC)
+
+
+def zip_date_time():
+    # SOURCE_DATE_EPOCH, see https://reproducible-builds.org/specs/source-date-epoch/
+    epoch = int(os.environ.get('SOURCE_DATE_EPOCH', '315532800'))
+    return time.gmtime(max(epoch, 315532800))[:6]
+
+
+def add_entries(archive, root, paths, date_time):
+    for path in paths:
+        fullpath = os.path.join(root, path)
+        info = zipfile.ZipInfo(path, date_time)
+        info.create_system = 3
+        info.external_attr = (os.stat(fullpath).st_mode & 0xFFFF) << 16
+        if path.endswith('/'):
+            info.external_attr |= 0x10
+            archive.writestr(info, b'')
+            continue
+        if is_compressed(fullpath):
+            info.compress_type = zipfile.ZIP_STORED
+        else:
+            info.compress_type = zipfile.ZIP_DEFLATED
+        with open(fullpath, 'rb') as f:
+            archive.writestr(info, f.read())
+
+
+def load_manifest(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output-dir', default=os.path.join(ROOT, 'build'))
+    parser.add_argument('--exclude-file', default=os.path.join(ROOT, 'zipexclude.lst'))
+    parser.add_argument('--label', default=time.strftime('%Y%m%dT%H%M%S'),
+                        help='label of the zip files and contents of version, '
+                             'defaults to the current datetime')
+    parser.add_argument('--force', action='store_true',
+                        help='build even if the tree has not changed')
+    args = parser.parse_args()
+
+    start = time.time()
+    paths = walk(ROOT, read_excludes(args.exclude_file))
+    # the modes are part of the archives, so a chmod changes the tree.
+    files = {}
+    for path in paths:
+        if path == VERSION:
+            continue
+        fullpath = os.path.join(ROOT, path)
+        entry = {'mode': oct(os.stat(fullpath).st_mode)}
+        if not path.endswith('/'):
+            entry['sha256'] = digest_file(fullpath)
+        files[path] = entry
+    tree_hash = hashlib.sha256(json.dumps(files, sort_keys=True).encode()).hexdigest()
+
+    manifest_path = os.path.join(args.output_dir, MANIFEST)
+    previous = load_manifest(manifest_path)
+    if previous and previous.get('tree_hash') == tree_hash and not args.force and \
+       all(os.path.exists(os.path.join(args.output_dir, name))
+           for name in previous['archives'].values()):
+        print('tree is unchanged since {}, not rebuilding:'.format(previous['label']))
+        for name in sorted(previous['archives'].values()):
+            print('    {}'.format(os.path.join(args.output_dir, name)))
+        return 0
+
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+    with open(os.path.join(ROOT, VERSION), 'w') as f:
+        f.write(args.label + '\n')
+    if VERSION not in paths:
+        paths = sorted(paths + [VERSION])
+
+    date_time = zip_date_time()
+    archives = {
+        'public': 'mozilla-docker-{}-public.zip'.format(args.label),
+        'private': 'mozilla-docker-{}.zip'.format(args.label),
+    }
+    public_path = os.path.join(args.output_dir, archives['public'])
+    private_path = os.path.join(args.output_dir, archives['private'])
+    with zipfile.ZipFile(public_path, 'w') as archive:
+        add_entries(archive, ROOT, [p for p in paths if not is_private(p)], date_time)
+    shutil.copyfile(public_path, private_path)
+    with zipfile.ZipFile(private_path, 'a') as archive:
+        add_entries(archive, ROOT, [p for p in paths if is_private(p)], date_time)
+
+    manifest = {
+        'label': args.label,
+        'tree_hash': tree_hash,
+        'archives': archives,
+        'files': files,
+    }
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    for path in (private_path, public_path):
+        print('{} {} bytes'.format(path, os.path.getsize(path)))
+    print('built in {:.2f}s'.format(time.time() - start))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())